@@ -1,11 +1,18 @@
 import os
 
 from celery import Celery
+from kombu import Queue
+
+from compliance.utils.serialization import register_compact_serializer
 
 # Set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
-app = Celery('backend')
+# Before the configuration is loaded, since it may select the serializer
+register_compact_serializer()
+
+# All tasks expire and offload their results according to the settings
+app = Celery('backend', task_cls='compliance.utils.results:ResultPolicyTask')
 
 # Using a string here means the worker doesn't have to serialize
 # the configuration object to child processes.
@@ -13,6 +20,45 @@ app = Celery('backend')
 #   should have a `CELERY_` prefix.
 app.config_from_object('django.conf:settings', namespace='CELERY')
 
+# Queue of every task, so that short tasks never wait behind long scans. Tasks without a route,
+# e.g., the periodic maintenance, go to the default queue "celery"
+TASK_ROUTES = {
+    # nmap subprocesses, network-bound and running for up to hours
+    "compliance.tasks.nmap_top_ports_scan_task": {"queue": "nmap"},
+    "compliance.tasks.nmap_vulners_scan_task": {"queue": "nmap"},
+    # waiting for the scanned hosts and websites or the NVD, EPSS and CISA APIs
+    "compliance.tasks.ping_ips_task": {"queue": "api"},
+    "compliance.tasks.check_https_connection_task": {"queue": "api"},
+    "compliance.tasks.technologies_vulnerability_scan_task": {"queue": "api"},
+    "compliance.tasks.refresh_kev_catalog_task": {"queue": "api"},
+    # CPU-bound PDF rendering
+    "compliance.tasks.generate_report_task": {"queue": "pdf"},
+}
+
+# Worker settings per queue. A worker started with CELERY_WORKER_PROFILE=<queue> only consumes that
+# queue, with a pool and concurrency suited for its tasks. Without a profile, a worker consumes all queues
+WORKER_PROFILES = {
+    # one scan per process, i.e., a long scan never holds back prefetched ones
+    "nmap": {"worker_pool": "prefork", "worker_concurrency": 4, "worker_prefetch_multiplier": 1},
+    # threads, since the tasks mostly wait for I/O
+    "api": {"worker_pool": "threads", "worker_concurrency": 32, "worker_prefetch_multiplier": 4},
+    # one process per CPU
+    "pdf": {"worker_pool": "prefork", "worker_concurrency": os.cpu_count(), "worker_prefetch_multiplier": 1},
+    "celery": {"worker_pool": "prefork", "worker_concurrency": 2, "worker_prefetch_multiplier": 4},
+}
+
+
+def apply_worker_profile(app, profile):
+    if profile not in WORKER_PROFILES:
+        raise ValueError(f"Unknown worker profile {profile}, use one of {', '.join(WORKER_PROFILES)}")
+    app.conf.update(WORKER_PROFILES[profile], task_queues=[Queue(profile, routing_key=profile)])
+
+
+app.conf.task_routes = TASK_ROUTES
+app.conf.task_queues = [Queue(queue, routing_key=queue) for queue in WORKER_PROFILES]
+if os.getenv("CELERY_WORKER_PROFILE"):
+    apply_worker_profile(app, os.getenv("CELERY_WORKER_PROFILE"))
+
 # Load task modules from all registered Django apps.
 app.autodiscover_tasks()
 
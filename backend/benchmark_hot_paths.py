@@ -0,0 +1,208 @@
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import urllib3
+
+from compliance.evaluation.fake_services import FakeApiServer, TlsServerFarm
+from compliance.utils import utils
+from compliance.utils.instrumentation import PeakRssSampler
+from cve_prioritizer.cve_prioritizer import cve_prioritizer_wrapper
+from cve_prioritizer.cve_prioritizer.scripts import helpers
+from cve_prioritizer.cve_prioritizer.scripts.rate_limiter import RateLimiter
+
+BENCHMARKS = ["check_https_connections", "prioritize_cves", "check_technology_for_cves"]
+
+
+def percentile(values, p):
+    # nearest-rank percentile
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def run_check_https_connections(inputs):
+    latencies = []
+    for website in inputs:
+        start = time.perf_counter()
+        utils.check_https_connections([website])
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def run_prioritize_cves(inputs):
+    # the CVEs are enriched concurrently, so the latency of every single CVE is recorded
+    # by wrapping enrich_cve for the duration of the run
+    latencies = []
+    enrich_cve = cve_prioritizer_wrapper.enrich_cve
+
+    def timed_enrich_cve(cve_id):
+        start = time.perf_counter()
+        try:
+            return enrich_cve(cve_id)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    cve_prioritizer_wrapper.enrich_cve = timed_enrich_cve
+    try:
+        cve_prioritizer_wrapper.prioritize_cves(inputs)
+    finally:
+        cve_prioritizer_wrapper.enrich_cve = enrich_cve
+    return latencies
+
+
+def run_check_technology_for_cves(inputs):
+    latencies = []
+    for technology in inputs:
+        start = time.perf_counter()
+        utils.check_technology_for_cves(technology["product"], technology["version"], technology["vendor"])
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def build_inputs(benchmark, size, tls_farm):
+    if benchmark == "check_https_connections":
+        return tls_farm.sample(size)
+    if benchmark == "prioritize_cves":
+        return [f"CVE-2023-{10000 + i}" for i in range(size)]
+    return [{"vendor": "vendor", "product": f"product_{i}", "version": "1.0"} for i in range(size)]
+
+
+def run_benchmark(benchmark, size, repeat, tls_farm):
+    runner = globals()[f"run_{benchmark}"]
+    latencies = []
+    wall_times = []
+    peak_rss = 0
+
+    for _ in range(repeat):
+        inputs = build_inputs(benchmark, size, tls_farm)
+        # the code under test prints extensively, which would dominate the measurements
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            with PeakRssSampler(interval=0.005) as sampler:
+                start = time.perf_counter()
+                latencies.extend(runner(inputs))
+                wall_times.append(time.perf_counter() - start)
+        peak_rss = max(peak_rss, sampler.peak_rss)
+
+    return {
+        "benchmark": benchmark,
+        "size": size,
+        "repeat": repeat,
+        "throughput": size * repeat / sum(wall_times),
+        "p50_latency": percentile(latencies, 50),
+        "p99_latency": percentile(latencies, 99),
+        "peak_rss": peak_rss,
+    }
+
+
+def find_regressions(results, baseline, tolerance):
+    """
+    Compares the results with a previous run. Throughput may not drop, and latency and memory
+    may not grow, by more than the given tolerance (e.g., 0.25 = 25%).
+    """
+    baseline_results = {(result["benchmark"], result["size"]): result for result in baseline["results"]}
+    regressions = []
+
+    for result in results:
+        previous = baseline_results.get((result["benchmark"], result["size"]))
+        if previous is None:
+            continue
+
+        if result["throughput"] < previous["throughput"] * (1 - tolerance):
+            regressions.append((result, "throughput", previous["throughput"]))
+        for metric in ["p50_latency", "p99_latency", "peak_rss"]:
+            if result[metric] > previous[metric] * (1 + tolerance):
+                regressions.append((result, metric, previous[metric]))
+
+    return regressions
+
+
+def main():
+    """
+    Benchmarks the scanning and enrichment hot paths against local stand-ins of NVD, EPSS and
+    a set of HTTPS servers, i.e., without internet access. For every benchmark and input size,
+    the throughput (inputs per second), the p50/p99 latency of a single input (seconds) and the
+    peak RSS of the process (bytes) are reported and saved to evaluation/results.
+
+    Example: python benchmark_hot_paths.py --sizes 1 10 100 --latency 0.05 --baseline previous.json
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the scanning and enrichment hot paths")
+    parser.add_argument("--benchmarks", nargs="+", choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1, 10, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark and size")
+    parser.add_argument("--latency", type=float, default=0.05, help="Latency of the fake APIs in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Additional random latency in seconds")
+    parser.add_argument("--nvd-rate-limit", type=int, nargs=2, metavar=("REQUESTS", "SECONDS"),
+                        help="Let the fake NVD API answer with 429 above this rate")
+    parser.add_argument("--client-rate-limit", type=int, nargs=2, metavar=("REQUESTS", "SECONDS"),
+                        default=[1000, 1], help="Rate limit of the NVD client (Default 1000 1)")
+    parser.add_argument("--kev-ratio", type=float, default=0.05, help="Share of CVEs listed in the KEV catalog")
+    parser.add_argument("--output", type=str, help="Result file (Default evaluation/results/benchmark_<date>.json)")
+    parser.add_argument("--baseline", type=str, help="Result file of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed regression (Default 0.25)")
+    args = parser.parse_args()
+
+    # check_https_connections deliberately follows redirects without verifying certificates
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            FakeApiServer(args.latency, args.jitter, args.nvd_rate_limit) as fake_api, \
+            TlsServerFarm() as tls_farm:
+
+        # route all API clients to the fake server
+        helpers.NIST_BASE_URL = fake_api.nvd_url
+        helpers.EPSS_URL = fake_api.epss_url
+        utils.NIST_BASE_URL = fake_api.nvd_url
+        helpers.nvd_rate_limiter = RateLimiter(*args.client_rate_limit)
+
+        kev_file = os.path.join(tmp_dir, "kev.json")
+        kev_every = int(1 / args.kev_ratio) if args.kev_ratio > 0 else None
+        with open(kev_file, "w") as f:
+            json.dump({"vulnerabilities": [
+                {"cveID": f"CVE-2023-{10000 + i}"} for i in range(max(args.sizes)) if kev_every and i % kev_every == 0
+            ]}, f)
+        os.environ["CISA_KEV_FILE"] = kev_file
+
+        for benchmark in args.benchmarks:
+            for size in args.sizes:
+                result = run_benchmark(benchmark, size, args.repeat, tls_farm)
+                results.append(result)
+                print(f"{benchmark:<28}{size:>6} inputs  {result['throughput']:>10.2f}/s  "
+                      f"p50 {result['p50_latency'] * 1000:>9.2f}ms  p99 {result['p99_latency'] * 1000:>9.2f}ms  "
+                      f"peak RSS {result['peak_rss'] / (1024 * 1024):>8.2f}MB")
+
+        api_requests = dict(fake_api.request_counts)
+
+    output = {
+        "date": datetime.now().isoformat(),
+        "config": {key: value for key, value in vars(args).items() if key not in ["output", "baseline"]},
+        "api_requests": api_requests,
+        "results": results,
+    }
+
+    output_file = args.output
+    if not output_file:
+        results_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "compliance", "evaluation", "results")
+        output_file = os.path.join(results_dir, f"benchmark_{datetime.now().strftime('%d_%m_%Y--%H_%M_%S')}.json")
+    with open(output_file, "w") as f:
+        json.dump(output, f, indent=4)
+    print(f"Results saved to {output_file}")
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for result, metric, previous in regressions:
+            print(f"Regression: {result['benchmark']} with {result['size']} inputs, "
+                  f"{metric} {result[metric]:.4f} (baseline {previous:.4f})")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,3 +4,21 @@ from django.apps import AppConfig
 class ComplianceConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "compliance"
+
+    def ready(self):
+        # connects the signal handlers
+        from compliance import signals  # noqa: F401
+
+        # the vendored cve_prioritizer records its API calls in the metrics of the tasks and stops its
+        # requests together with the tasks
+        from compliance.utils import cancellation, instrumentation, metrics
+        from cve_prioritizer.cve_prioritizer.scripts import hooks
+
+        hooks.install(
+            api_call=instrumentation.api_call,
+            record_api_retry=instrumentation.record_api_retry,
+            record_cache_lookup=metrics.record_cache_lookup,
+            stop_reason=cancellation.stop_reason,
+            remaining=cancellation.remaining,
+            sleep=cancellation.sleep,
+        )
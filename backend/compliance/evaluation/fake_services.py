@@ -0,0 +1,293 @@
+"""
+Local stand-ins for the external services used by CERTSec, so that the hot paths can be
+benchmarked reproducibly without internet access:
+
+- FakeApiServer answers NVD (CVE and CPE queries) and EPSS requests with synthetic but
+  deterministic data, optionally with an artificial latency and NVD-like 429 responses
+- TlsServerFarm serves HTTPS on localhost with a valid, an expired, a self-signed and a
+  wrong-host certificate, all (except the self-signed one) issued by a throw-away CA
+"""
+import collections
+import datetime
+import hashlib
+import json
+import os
+import random
+import ssl
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+
+def _score(cve_id, salt, upper):
+    # deterministic pseudo-random value in [0, upper) for a CVE
+    digest = hashlib.sha256(f"{salt}:{cve_id}".encode()).digest()
+    return int.from_bytes(digest[:4], "big") / 2 ** 32 * upper
+
+
+def _nvd_vulnerability(cve_id):
+    base_score = round(_score(cve_id, "cvss", 10), 1)
+    severity = "CRITICAL" if base_score >= 9 else "HIGH" if base_score >= 7 else "MEDIUM" if base_score >= 4 else "LOW"
+    return {
+        "cve": {
+            "id": cve_id,
+            "vulnStatus": "Analyzed",
+            "metrics": {
+                "cvssMetricV31": [{"cvssData": {"baseScore": base_score, "baseSeverity": severity}}]
+            },
+        }
+    }
+
+
+class FakeApiServer:
+    """
+    Serves /nvd (NVD CVE API 2.0) and /epss (FIRST EPSS API) on localhost.
+
+    latency: seconds every response is delayed by, jitter: additional random delay (uniform)
+    rate_limit: (max_requests, period) of the NVD endpoint, exceeding requests get a 429
+    cves_per_product: number of CVEs returned for a virtualMatchString query
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, rate_limit=None, cves_per_product=20):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.cves_per_product = cves_per_product
+        self.request_counts = collections.Counter()
+        self._nvd_requests = collections.deque()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    @property
+    def nvd_url(self):
+        return self.base_url + "/nvd"
+
+    @property
+    def epss_url(self):
+        return self.base_url + "/epss"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _is_rate_limited(self):
+        if not self.rate_limit:
+            return False
+
+        max_requests, period = self.rate_limit
+        with self._lock:
+            now = time.monotonic()
+            while self._nvd_requests and now - self._nvd_requests[0] >= period:
+                self._nvd_requests.popleft()
+            if len(self._nvd_requests) >= max_requests:
+                return True
+            self._nvd_requests.append(now)
+            return False
+
+    def _nvd_response(self, query):
+        if "cveId" in query:
+            cve_id = query["cveId"][0]
+            return {"totalResults": 1, "vulnerabilities": [_nvd_vulnerability(cve_id)]}
+
+        cpe = query.get("virtualMatchString", [""])[0]
+        seed = int(hashlib.sha256(cpe.encode()).hexdigest()[:6], 16)
+        cve_ids = [f"CVE-2020-{seed + i}" for i in range(self.cves_per_product)]
+        return {"totalResults": len(cve_ids), "vulnerabilities": [_nvd_vulnerability(cve) for cve in cve_ids]}
+
+    def _epss_response(self, query):
+        cve_id = query.get("cve", [""])[0]
+        return {
+            "total": 1,
+            "data": [
+                {
+                    "cve": cve_id,
+                    "epss": f"{_score(cve_id, 'epss', 1):.5f}",
+                    "percentile": f"{_score(cve_id, 'percentile', 1):.5f}",
+                }
+            ],
+        }
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                server.request_counts[url.path] += 1
+
+                time.sleep(server.latency + random.uniform(0, server.jitter))
+
+                if url.path == "/nvd":
+                    if server._is_rate_limited():
+                        server.request_counts["429"] += 1
+                        return self._send(429, {"message": "Too Many Requests"})
+                    return self._send(200, server._nvd_response(query))
+                if url.path == "/epss":
+                    return self._send(200, server._epss_response(query))
+                return self._send(404, {"message": "Not Found"})
+
+            def _send(self, status_code, body):
+                payload = json.dumps(body).encode()
+                self.send_response(status_code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class _OkHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TlsServerFarm:
+    """
+    Starts one HTTPS server per certificate kind ("good", "expired", "self_signed", "wrong_host")
+    on localhost. The throw-away CA is exported through SSL_CERT_FILE while the farm is running,
+    so that ssl.create_default_context() trusts it like a public CA.
+    """
+
+    KINDS = ["good", "expired", "self_signed", "wrong_host"]
+
+    def __init__(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self._servers = {}
+        self._previous_cert_file = None
+        self.websites = {}
+
+    def __enter__(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        ca_key, ca_cert = self._create_ca(now)
+
+        ca_file = os.path.join(self._tmp_dir.name, "ca.pem")
+        with open(ca_file, "wb") as f:
+            f.write(ca_cert.public_bytes(serialization.Encoding.PEM))
+
+        certificates = {
+            "good": self._create_certificate("localhost", now, ca_key, ca_cert),
+            "expired": self._create_certificate(
+                "localhost", now, ca_key, ca_cert,
+                not_before=now - datetime.timedelta(days=30), not_after=now - datetime.timedelta(days=1)
+            ),
+            "self_signed": self._create_certificate("localhost", now),
+            "wrong_host": self._create_certificate("wrong.host.invalid", now, ca_key, ca_cert),
+        }
+
+        for kind, (key, cert) in certificates.items():
+            cert_file = os.path.join(self._tmp_dir.name, f"{kind}.pem")
+            with open(cert_file, "wb") as f:
+                f.write(cert.public_bytes(serialization.Encoding.PEM))
+                f.write(key.private_bytes(
+                    serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+                ))
+
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(cert_file)
+
+            server = ThreadingHTTPServer(("127.0.0.1", 0), _OkHandler)
+            server.daemon_threads = True
+            server.socket = context.wrap_socket(server.socket, server_side=True)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+            self._servers[kind] = server
+            self.websites[kind] = f"https://localhost:{server.server_port}/"
+
+        self._previous_cert_file = os.environ.get("SSL_CERT_FILE")
+        os.environ["SSL_CERT_FILE"] = ca_file
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for server in self._servers.values():
+            server.shutdown()
+            server.server_close()
+
+        if self._previous_cert_file is None:
+            os.environ.pop("SSL_CERT_FILE", None)
+        else:
+            os.environ["SSL_CERT_FILE"] = self._previous_cert_file
+        self._tmp_dir.cleanup()
+
+    def sample(self, count):
+        # round-robin over the certificate kinds
+        return [self.websites[self.KINDS[i % len(self.KINDS)]] for i in range(count)]
+
+    @staticmethod
+    def _create_ca(now):
+        key = ec.generate_private_key(ec.SECP256R1())
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "CERTSec Benchmark CA")])
+        cert = (
+            x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=30))
+            .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+            .add_extension(
+                x509.KeyUsage(
+                    digital_signature=True, content_commitment=False, key_encipherment=False,
+                    data_encipherment=False, key_agreement=False, key_cert_sign=True, crl_sign=True,
+                    encipher_only=False, decipher_only=False,
+                ),
+                critical=True,
+            )
+            .sign(key, hashes.SHA256())
+        )
+        return key, cert
+
+    @staticmethod
+    def _create_certificate(hostname, now, ca_key=None, ca_cert=None, not_before=None, not_after=None):
+        key = ec.generate_private_key(ec.SECP256R1())
+        subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, hostname)])
+
+        # without a CA the certificate signs itself
+        issuer = ca_cert.subject if ca_cert else subject
+        signing_key = ca_key or key
+
+        cert = (
+            x509.CertificateBuilder()
+            .subject_name(subject)
+            .issuer_name(issuer)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(not_before or now - datetime.timedelta(days=1))
+            .not_valid_after(not_after or now + datetime.timedelta(days=30))
+            .add_extension(x509.SubjectAlternativeName([x509.DNSName(hostname)]), critical=False)
+            .sign(signing_key, hashes.SHA256())
+        )
+        return key, cert
@@ -0,0 +1,44 @@
+# Generated by Django 4.2.1 on 2026-10-19 13:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("compliance", "0002_seed_db"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CveEnrichment",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("task_id", models.CharField(max_length=255)),
+                ("cve_id", models.CharField(max_length=50)),
+                ("epss", models.FloatField(blank=True, null=True)),
+                ("percentile", models.IntegerField(blank=True, null=True)),
+                ("cvss_base_score", models.FloatField(blank=True, null=True)),
+                (
+                    "cvss_version",
+                    models.CharField(blank=True, max_length=50, null=True),
+                ),
+                (
+                    "cvss_severity",
+                    models.CharField(blank=True, max_length=50, null=True),
+                ),
+                ("cisa_kev", models.BooleanField(default=False)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                "unique_together": {("task_id", "cve_id")},
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.1 on 2026-10-19 13:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("compliance", "0003_cveenrichment"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="assessment",
+            index=models.Index(
+                fields=["company", "-attempted_at"],
+                name="compliance__company_b4b722_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="assessmentrequirement",
+            index=models.Index(
+                fields=["assessment", "fulfilled"],
+                name="compliance__assessm_65cba5_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,205 @@
+# Generated by Django 4.2.1 on 2026-10-19 13:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("compliance", "0004_assessment_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ScanRun",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("task_id", models.CharField(max_length=255, unique=True)),
+                ("task_name", models.CharField(max_length=250)),
+                (
+                    "automated_requirement_type",
+                    models.CharField(
+                        choices=[
+                            ("https_protocol_checker", "HTTPS Protocol Checker"),
+                            (
+                                "unauthorized_access_checker",
+                                "Unauthorized Access Checker",
+                            ),
+                            ("vulnerability_checker", "Vulnerabilitiy Checker"),
+                        ],
+                        max_length=250,
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="AssessmentScan",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("task_id", models.CharField(max_length=255)),
+                (
+                    "assessment",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="scans",
+                        to="compliance.assessment",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("assessment", "task_id")},
+            },
+        ),
+        migrations.CreateModel(
+            name="HostResult",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("host", models.CharField(max_length=255)),
+                ("status", models.CharField(blank=True, max_length=50, null=True)),
+                ("description", models.TextField(blank=True, null=True)),
+                ("error", models.TextField(blank=True, null=True)),
+                ("details", models.JSONField(blank=True, default=dict)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="cveenrichment",
+            name="scan_run",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="cve_enrichments",
+                to="compliance.scanrun",
+            ),
+        ),
+        migrations.CreateModel(
+            name="PortResult",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("port", models.CharField(max_length=50)),
+                ("protocol", models.CharField(blank=True, max_length=50, null=True)),
+                ("state", models.CharField(blank=True, max_length=50, null=True)),
+                (
+                    "service_name",
+                    models.CharField(blank=True, max_length=250, null=True),
+                ),
+                (
+                    "service_product",
+                    models.CharField(blank=True, max_length=250, null=True),
+                ),
+                (
+                    "service_version",
+                    models.CharField(blank=True, max_length=250, null=True),
+                ),
+                ("details", models.JSONField(blank=True, default=dict)),
+                (
+                    "host",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="ports",
+                        to="compliance.hostresult",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name="hostresult",
+            name="scan_run",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="hosts",
+                to="compliance.scanrun",
+            ),
+        ),
+        migrations.CreateModel(
+            name="Finding",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("cve_id", models.CharField(max_length=50)),
+                ("cvss", models.FloatField(blank=True, null=True)),
+                ("is_exploit", models.BooleanField(blank=True, null=True)),
+                ("priority", models.CharField(blank=True, max_length=50, null=True)),
+                (
+                    "host",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="findings",
+                        to="compliance.hostresult",
+                    ),
+                ),
+                (
+                    "port",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="findings",
+                        to="compliance.portresult",
+                    ),
+                ),
+                (
+                    "scan_run",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="findings",
+                        to="compliance.scanrun",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="hostresult",
+            index=models.Index(fields=["host"], name="compliance__host_198d03_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="finding",
+            index=models.Index(fields=["cve_id"], name="compliance__cve_id_4006c1_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="finding",
+            index=models.Index(
+                fields=["priority"], name="compliance__priorit_222aa5_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.1 on 2026-10-19 13:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("compliance", "0006_scan_batches"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scanrun",
+            name="stopped",
+            field=models.CharField(blank=True, max_length=50, null=True),
+        ),
+        migrations.AlterField(
+            model_name="scanchunk",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "Pending"),
+                    ("queued", "Queued"),
+                    ("done", "Done"),
+                    ("failed", "Failed"),
+                    ("cancelled", "Cancelled"),
+                ],
+                default="pending",
+                max_length=50,
+            ),
+        ),
+    ]
@@ -28,6 +28,10 @@ class Assessment(models.Model):
     attempted_at = models.DateTimeField(auto_now_add=True)
     valid_until = models.DateTimeField(null=True, blank=True)
 
+    class Meta:
+        # assessments of a company, newest first
+        indexes = [models.Index(fields=["company", "-attempted_at"])]
+
 
 '''
 Unique type for each automated requirement
@@ -51,3 +55,145 @@ class AssessmentRequirement(models.Model):
     assessment = models.ForeignKey(Assessment, related_name="assessment_requirements", on_delete=models.CASCADE)
     requirement = models.ForeignKey(Requirement, related_name="assessment_requirements", on_delete=models.CASCADE)
     fulfilled = models.BooleanField(default=False)
+
+    class Meta:
+        # (un)fulfilled requirements of an assessment, e.g., for the report
+        indexes = [models.Index(fields=["assessment", "fulfilled"])]
+
+
+'''
+A finished scan task (ping, HTTPS check, port scan or vulnerability scan). Unlike the Celery result,
+it does not expire, and the results are stored normalized, i.e., they can be queried over all scans,
+e.g., for the appendix of the reports
+'''
+class ScanRun(models.Model):
+    task_id = models.CharField(max_length=255, unique=True)
+    task_name = models.CharField(max_length=250)
+    automated_requirement_type = models.CharField(max_length=250, choices=AutomatedRequirementType.choices)
+    # "cancelled" or "deadline" if the scan stopped early, i.e., the results are partial
+    stopped = models.CharField(max_length=50, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+'''
+A scan task submitted with an assessment. It is linked by its task id, i.e., also while the scan is
+still running and before its ScanRun exists, and a scan shared by several assessments, e.g., because
+identical requests have been deduplicated, is linked to each of them
+'''
+class AssessmentScan(models.Model):
+    assessment = models.ForeignKey(Assessment, related_name="scans", on_delete=models.CASCADE)
+    task_id = models.CharField(max_length=255)
+
+    class Meta:
+        unique_together = ["assessment", "task_id"]
+
+
+'''
+A scanned target of a scan run, i.e., an IP address, a website or a technology
+'''
+class HostResult(models.Model):
+    scan_run = models.ForeignKey(ScanRun, related_name="hosts", on_delete=models.CASCADE)
+    host = models.CharField(max_length=255)
+    # e.g., the protocol of an HTTPS check or whether a ping has been answered
+    status = models.CharField(max_length=50, null=True, blank=True)
+    description = models.TextField(null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+    # further task-specific values, e.g., the vendor, product and version of a technology
+    details = models.JSONField(default=dict, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["host"])]
+
+
+class PortResult(models.Model):
+    host = models.ForeignKey(HostResult, related_name="ports", on_delete=models.CASCADE)
+    port = models.CharField(max_length=50)
+    protocol = models.CharField(max_length=50, null=True, blank=True)
+    state = models.CharField(max_length=50, null=True, blank=True)
+    service_name = models.CharField(max_length=250, null=True, blank=True)
+    service_product = models.CharField(max_length=250, null=True, blank=True)
+    service_version = models.CharField(max_length=250, null=True, blank=True)
+    # further values reported by nmap, e.g., the reason or the CPEs of the port scan
+    details = models.JSONField(default=dict, blank=True)
+
+
+'''
+A CVE found on a port (nmap) or for a technology (NVD). The NVD and EPSS data of the CVE is stored
+once per scan run as CveEnrichment
+'''
+class Finding(models.Model):
+    scan_run = models.ForeignKey(ScanRun, related_name="findings", on_delete=models.CASCADE)
+    host = models.ForeignKey(HostResult, related_name="findings", on_delete=models.CASCADE)
+    port = models.ForeignKey(PortResult, related_name="findings", on_delete=models.CASCADE, null=True, blank=True)
+    cve_id = models.CharField(max_length=50)
+    # reported by nmap vulners
+    cvss = models.FloatField(null=True, blank=True)
+    is_exploit = models.BooleanField(null=True, blank=True)
+    # with the thresholds of the scan, None if the CVE could not be prioritized
+    priority = models.CharField(max_length=50, null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["cve_id"]), models.Index(fields=["priority"])]
+
+
+'''
+Raw NVD and EPSS data collected for a CVE during a scan. Storing it allows to
+re-apply different EPSS/CVSS thresholds without querying the APIs again
+'''
+class CveEnrichment(models.Model):
+    task_id = models.CharField(max_length=255)
+    scan_run = models.ForeignKey(ScanRun, related_name="cve_enrichments", on_delete=SET_NULL, null=True, blank=True)
+    cve_id = models.CharField(max_length=50)
+    epss = models.FloatField(null=True, blank=True)
+    percentile = models.IntegerField(null=True, blank=True)
+    cvss_base_score = models.FloatField(null=True, blank=True)
+    cvss_version = models.CharField(max_length=50, null=True, blank=True)
+    cvss_severity = models.CharField(max_length=50, null=True, blank=True)
+    cisa_kev = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ["task_id", "cve_id"]
+
+    def as_enrichment(self):
+        # same format as returned by cve_prioritizer's enrich_cve
+        return {
+            "epss": self.epss,
+            "percentile": self.percentile,
+            "cvss_baseScore": self.cvss_base_score,
+            "cvss_version": self.cvss_version,
+            "cvss_severity": self.cvss_severity,
+            "cisa_kev": self.cisa_kev,
+        }
+
+
+'''
+A bulk scan of a company, e.g., a rescan of all its hosts. Its targets are split into chunks, which
+are queued fair-share with the chunks of the other companies (see compliance/utils/scheduling.py)
+'''
+class ScanBatch(models.Model):
+    company = models.ForeignKey(Company, related_name="scan_batches", on_delete=models.CASCADE)
+    task_name = models.CharField(max_length=250)
+    # keyword arguments of the task, the same for every chunk
+    parameters = models.JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+class ScanChunk(models.Model):
+    class Status(models.TextChoices):
+        PENDING = "pending"
+        QUEUED = "queued"
+        DONE = "done"
+        FAILED = "failed"
+        CANCELLED = "cancelled"
+
+    batch = models.ForeignKey(ScanBatch, related_name="chunks", on_delete=models.CASCADE)
+    # generated up front, i.e., the chunks can be polled and linked to assessments before they are queued
+    task_id = models.CharField(max_length=255, unique=True)
+    targets = models.JSONField()
+    status = models.CharField(max_length=50, choices=Status.choices, default=Status.PENDING)
+    queued_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "queued_at"])]
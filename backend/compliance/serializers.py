@@ -2,7 +2,22 @@ from rest_framework import serializers
 from .models import Company, Certificate, Category, Assessment, Requirement, AssessmentRequirement
 
 
-class CompanySerializer(serializers.ModelSerializer):
+class DynamicFieldsMixin:
+    """
+    Allows to restrict the serialized fields, e.g., AssessmentSerializer(assessments, fields=["id", "passed"]).
+    Unknown field names are ignored.
+    """
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop("fields", None)
+        super().__init__(*args, **kwargs)
+
+        if fields is not None:
+            for field_name in set(self.fields) - set(fields):
+                self.fields.pop(field_name)
+
+
+class CompanySerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Company
         fields = ["name"]
@@ -15,7 +30,18 @@ class CertificateSerializer(serializers.ModelSerializer):
         fields = ["id", "name", "description", "next_certificate"]
 
     def get_next_certificate(self, obj):
-        return CertificateSerializer(obj.next_certificate).data
+        # the views pass all certificates in the context (see certificates_context),
+        # otherwise walking the chain of next certificates costs one query per certificate
+        certificates = self.context.get("certificates")
+        if certificates is not None:
+            next_certificate = certificates.get(obj.next_certificate_id)
+        else:
+            next_certificate = obj.next_certificate
+        return CertificateSerializer(next_certificate, context=self.context).data
+
+
+def certificates_context():
+    return {"certificates": Certificate.objects.in_bulk()}
 
 
 '''
@@ -28,7 +54,7 @@ class SimpleCategorySerializer(serializers.ModelSerializer):
         fields = ["id", "name", "description"]
 
 
-class RequirementSerializer(serializers.ModelSerializer):
+class RequirementSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Requirement
         fields = ["id", "description", "category", "is_automated_requirement", "automated_requirement_type"]
@@ -49,10 +75,10 @@ class CategorySerializer(serializers.ModelSerializer):
     # TODO: try if it works and replace serializer defined at the beginning
     requirements = serializers.SerializerMethodField()
     def get_requirements(self, obj):
-        return RequirementSerializer(obj.requirements.all(), many=True).data
+        return RequirementSerializer(obj.requirements.all(), many=True, context=self.context).data
 
 
-class AssessmentRequirementSerializer(serializers.ModelSerializer):
+class AssessmentRequirementSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     requirement = serializers.SerializerMethodField()
 
     class Meta:
@@ -60,10 +86,10 @@ class AssessmentRequirementSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
     def get_requirement(self, obj):
-        return RequirementSerializer(obj.requirement).data
+        return RequirementSerializer(obj.requirement, context=self.context).data
 
 
-class AssessmentSerializer(serializers.ModelSerializer):
+class AssessmentSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     assessment_requirements = serializers.SerializerMethodField()
     certificate = serializers.SerializerMethodField()
     company = serializers.SerializerMethodField()
@@ -72,10 +98,10 @@ class AssessmentSerializer(serializers.ModelSerializer):
         fields = ["id", "company", "certificate", "passed", "attempted_at", "valid_until", "assessment_requirements"]
 
     def get_assessment_requirements(self, obj):
-        return AssessmentRequirementSerializer(obj.assessment_requirements.all(), many=True).data
+        return AssessmentRequirementSerializer(obj.assessment_requirements.all(), many=True, context=self.context).data
 
     def get_certificate(self, obj):
-        return CertificateSerializer(obj.certificate).data
+        return CertificateSerializer(obj.certificate, context=self.context).data
 
     def get_company(self, obj):
         return CompanySerializer(obj.company).data
@@ -0,0 +1,12 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from compliance.models import Certificate, Category, Requirement
+from compliance.utils.catalog import invalidate_catalog
+
+
+@receiver([post_save, post_delete], sender=Certificate)
+@receiver([post_save, post_delete], sender=Category)
+@receiver([post_save, post_delete], sender=Requirement)
+def _invalidate_catalog(sender, **kwargs):
+    invalidate_catalog()
@@ -1,19 +1,24 @@
-import nmap3
-import time
-import psutil
 import os
 import json
-import resource
 from ping3 import ping
 from datetime import datetime
 
+from compliance.models import CveEnrichment
+from compliance.utils import cancellation, instrumentation
+from compliance.utils.cancellation import StoppableNmap, TaskStopped
+from compliance.utils.metrics import record_cache_lookup
+from compliance.utils.reports import generate_report
+from compliance.utils.results import delete_expired_result_files
+from compliance.utils.scan_results import store_scan_result
+from compliance.utils.scheduling import dispatch_chunks
 from compliance.utils.utils import check_technology_for_cves, check_https_connections
 from cve_prioritizer.cve_prioritizer import cve_prioritizer_wrapper
+from cve_prioritizer.cve_prioritizer.scripts.kev import refresh_kev_catalog
 from celery import shared_task
 
 
-@shared_task()
-def ping_ips_task(ip_addresses):
+@shared_task(bind=True)
+def ping_ips_task(self, ip_addresses):
     results = {}
 
     # TODO: Remove - only for testing purposes
@@ -21,6 +26,9 @@ def ping_ips_task(ip_addresses):
     #     raise Exception("This is a simulated Exception")
 
     for ip in ip_addresses:
+        # the hosts pinged so far are stored as a partial result
+        if cancellation.stop_reason():
+            break
         try:
             delay = ping(ip)
             if delay is None:
@@ -43,14 +51,14 @@ def ping_ips_task(ip_addresses):
                 "connection_established": "Error",
                 "description": f"Error: {str(e)}"
             }
-    return results
+    return _store_scan_run(self, results)
 
 
-@shared_task()
-def nmap_top_ports_scan_task(ip_addresses):
+@shared_task(bind=True)
+def nmap_top_ports_scan_task(self, ip_addresses):
     print("Scanning following ip_addresses: " + str(ip_addresses))
 
-    nm = nmap3.Nmap()
+    nm = StoppableNmap()
     response = {}
 
     # ftp, ssh, telnet, smtp, http, https
@@ -59,7 +67,12 @@ def nmap_top_ports_scan_task(ip_addresses):
         print(f"ip: {ip}")
 
         ports = []
-        scan_results = nm.scan_top_ports(ip)
+        try:
+            scan_results = nm.scan_top_ports(ip)
+        except TaskStopped as e:
+            # the hosts scanned so far are stored as a partial result
+            print(f"Scan stopped at {ip}: {e.reason}")
+            break
         print(f"nmap_top_ports_scan - scan_result: {scan_results}")
 
         for port in scan_results[ip]["ports"]:
@@ -69,94 +82,51 @@ def nmap_top_ports_scan_task(ip_addresses):
 
     print(f"\n response: {response}\n")
     print("\n Scan common ports has finished! \n")
-    return response
+    return _store_scan_run(self, response)
 
 
-@shared_task()
-def check_https_connection_task(websites, is_evaluation=False):
+@shared_task(bind=True)
+def check_https_connection_task(self, websites, is_evaluation=False):
     print("start https check call")
     # TODO: Remove - only for testing purposes
     # if websites:
     #     raise Exception("This is a simulated failure")
 
-    # get the process that we want to analyze
-    process = psutil.Process(os.getpid())
-    # record the initial cpu percent
-    cpu_percent_initial = process.cpu_percent(interval=None)
-    # memory_initial = process.memory_info().rss
-    memory_initial = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
-
-    # record the start time
-    start_time = time.time()
-
-    results = check_https_connections(websites)
-
-    # record the final cpu percent and memory used
-    cpu_percent_final = process.cpu_percent(interval=None)
-    memory_final = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
-
-
-    # record the end time
-    end_time = time.time()
-
-    metrics = {
-        "number_websites": len(websites),
-        "cpu_percent": cpu_percent_final - cpu_percent_initial,
-        "memory_used": memory_final - memory_initial,
-        "execution_time": end_time - start_time
-    }
+    with instrumentation.stage("https_check"):
+        results = check_https_connections(websites)
 
     if is_evaluation:
-        # Get absolute path to the directory where we want to save the results
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        results_dir = os.path.join(base_dir, 'evaluation', 'results')
-
-        # Ensure the directory exists
-        os.makedirs(results_dir, exist_ok=True)
-
-        # Build the filename
-        filename = f"scheduled_metrics_{len(websites)}_websites_{datetime.now().strftime('%d_%m_%Y--%H_%M_%S')}.json"
-        file_path = os.path.join(results_dir, filename)
-
-        print(f"Saving results to {file_path}")  # Just for debugging
-
-        # Try to save metrics to a JSON file in the specified directory
-        try:
-            with open(file_path, 'w') as f:
-                json.dump(metrics, f, indent=4)
-            print("Results saved.")  # Just for debugging
-        except Exception as e:
-            print(f"Failed to save results: {e}")  # Print out any
+        metrics = {"number_websites": len(websites), **instrumentation.current_metrics().snapshot()}
+        _save_evaluation_metrics(
+            metrics, f"scheduled_metrics_{len(websites)}_websites_{datetime.now().strftime('%d_%m_%Y--%H_%M_%S')}.json"
+        )
 
     print("Finished check https call")
-    return results
+    return _store_scan_run(self, results)
 
 
-@shared_task()
-def nmap_vulners_scan_task(ip_addresses, is_evaluation=False):
+@shared_task(bind=True)
+def nmap_vulners_scan_task(self, ip_addresses, is_evaluation=False):
     print("Scanning following ip_addresses: " + str(ip_addresses))
 
-    # get the process that we want to analyze
-    process = psutil.Process(os.getpid())
-    # record the initial cpu percent
-    cpu_percent_initial = process.cpu_percent(interval=None)
-    memory_initial = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
-
-    # record the start time
-    start_time = time.time()
-
     # TODO: Remove - only for testing purposes
     # if ip_addresses:
     #     raise Exception("This is a simulated Exception")
 
-    nm = nmap3.Nmap()
+    nm = StoppableNmap()
     response = {}
 
     for ip in ip_addresses:
         print(f"ip: {str(ip)}")
 
         # scan_results = nm.nmap_version_detection(ip, args=" -p80 --script vulners")
-        scan_results = nm.nmap_version_detection(ip, args=" --script vulners")
+        try:
+            with instrumentation.stage("nmap_scan"):
+                scan_results = nm.nmap_version_detection(ip, args=" --script vulners")
+        except TaskStopped as e:
+            # the CVEs of the hosts scanned so far are prioritized as far as the deadline allows
+            print(f"Scan stopped at {ip}: {e.reason}")
+            break
         ip_details = scan_results[ip]
 
         vulnerabilities_response = {}
@@ -193,53 +163,29 @@ def nmap_vulners_scan_task(ip_addresses, is_evaluation=False):
 
         response[ip] = vulnerabilities_response
 
-    _prioritize_nmap_cves(response)
-
-    # record the final cpu percent and memory used
-    cpu_percent_final = process.cpu_percent(interval=None)
-    memory_final = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
-    # record the end time
-    end_time = time.time()
-
-    metrics = {
-        "number_ips": len(ip_addresses),
-        "cpu_percent": cpu_percent_final - cpu_percent_initial,
-        "memory_used": memory_final - memory_initial,
-        "execution_time": end_time - start_time
-    }
+    with instrumentation.stage("prioritize_cves"):
+        _prioritize_nmap_cves(response, self.request.id)
 
     if is_evaluation:
-        # Get absolute path to the directory where we want to save the results
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        results_dir = os.path.join(base_dir, 'evaluation', 'results')
-
-        # Ensure the directory exists
-        os.makedirs(results_dir, exist_ok=True)
-
-        # Build the filename
-        filename = f"scheduled_metrics_{len(ip_addresses)}_ip_addresses_{datetime.now().strftime('%d_%m_%Y--%H_%M_%S')}.json"
-        file_path = os.path.join(results_dir, filename)
-
-        print(f"Saving results to {file_path}")  # Just for debugging
-
-        # Try to save metrics to a JSON file in the specified directory
-        try:
-            with open(file_path, 'w') as f:
-                json.dump(metrics, f, indent=4)
-            print("Results saved to {file_path}")
-        except Exception as e:
-            print(f"Failed to save results to {file_path}: {e}")
+        metrics = {"number_ips": len(ip_addresses), **instrumentation.current_metrics().snapshot()}
+        _save_evaluation_metrics(
+            metrics,
+            f"scheduled_metrics_{len(ip_addresses)}_ip_addresses_{datetime.now().strftime('%d_%m_%Y--%H_%M_%S')}.json"
+        )
 
     print("\n IP Addresses Vulnerability Scan has finished! \n")
-    return response
+    return _store_scan_run(self, response)
 
 
-@shared_task()
-def technologies_vulnerability_scan_task(technologies):
+@shared_task(bind=True)
+def technologies_vulnerability_scan_task(self, technologies):
     print(f"\n Scanning following technologies for vulnerabilities: {technologies}! \n")
 
     response = []
     for technology in technologies:
+        # the technologies checked so far are stored as a partial result
+        if cancellation.stop_reason():
+            break
         print(f"\n technology: {technology} \n")
 
         if not all(key in technology for key in ("product", "version", "vendor")):
@@ -248,7 +194,8 @@ def technologies_vulnerability_scan_task(technologies):
         technology_response = {**technology, "vulnerabilities": {}}
 
         print(f"technology: {technology}")
-        scan_result = check_technology_for_cves(technology["product"], technology["version"], technology["vendor"])
+        with instrumentation.stage("nvd_lookup"):
+            scan_result = check_technology_for_cves(technology["product"], technology["version"], technology["vendor"])
         print(f"\n ============ scan result: {scan_result}\n")
 
         if "error" in scan_result:
@@ -263,43 +210,124 @@ def technologies_vulnerability_scan_task(technologies):
             cves_list = [cve["cve"]["id"] for cve in vulnerabilities]
             print(f"\n ==========================================================================\n")
             print(f"\n cves_list: {cves_list}\n")
-            technology_response = _prioritize_technology_cves(technology_response, cves_list)
+            with instrumentation.stage("prioritize_cves"):
+                technology_response = _prioritize_technology_cves(technology_response, cves_list, self.request.id)
         response.append(technology_response)
 
     print("\n Technologies Vulnerability Scan has finished! \n")
-    return response
+    return _store_scan_run(self, response)
+
+
+@shared_task()
+def refresh_kev_catalog_task():
+    number_kev_cves = refresh_kev_catalog()
+    print(f"CISA KEV catalog loaded with {number_kev_cves} CVEs")
+    return number_kev_cves
+
+
+@shared_task()
+def delete_expired_results_task():
+    deleted_files = delete_expired_result_files()
+    print(f"Deleted {deleted_files} expired result files")
+    return deleted_files
+
+
+@shared_task()
+def dispatch_scan_chunks_task():
+    # the chunks are queued whenever a chunk has finished, periodically only in case one got lost
+    return dispatch_chunks()
+
+
+@shared_task()
+def generate_report_task(assessment_id, force_refresh=False, scan_task_ids=None):
+    print(f"Generating report for assessment {assessment_id}")
+    # the report is downloaded from reports/<report id>/
+    report_id = generate_report(assessment_id, force_refresh, scan_task_ids)
+    print("Report has been generated")
+    return {"assessment_id": assessment_id, "report_id": report_id}
+
 
+def _save_evaluation_metrics(metrics, filename):
+    # Get absolute path to the directory where we want to save the results
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    results_dir = os.path.join(base_dir, 'evaluation', 'results')
+
+    # Ensure the directory exists
+    os.makedirs(results_dir, exist_ok=True)
+
+    file_path = os.path.join(results_dir, filename)
+    print(f"Saving results to {file_path}")  # Just for debugging
+
+    # Try to save metrics to a JSON file in the specified directory
+    try:
+        with open(file_path, 'w') as f:
+            json.dump(metrics, f, indent=4)
+        print(f"Results saved to {file_path}")
+    except Exception as e:
+        print(f"Failed to save results to {file_path}: {e}")
+
+
+def _prioritize_nmap_cves(data, task_id=None):
+    # CVEs often show up on several ports, so every CVE is only enriched once per scan
+    enrichments = {}
 
-def _prioritize_nmap_cves(data):
     for ip_address in data.keys():
         for port in data[ip_address].keys():
-            if not data[ip_address][port]["vulnerabilities"]:
+            vulnerabilities = data[ip_address][port]["vulnerabilities"]
+            if not vulnerabilities:
                 continue
 
-            cve_priority_details = cve_prioritizer_wrapper.prioritize_cves(
-                data[ip_address][port]["vulnerabilities"].keys())
+            missing_cves = [cve for cve in vulnerabilities.keys() if cve not in enrichments]
+            record_cache_lookup("cve_enrichment", True, len(vulnerabilities) - len(missing_cves))
+            record_cache_lookup("cve_enrichment", False, len(missing_cves))
+            enrichments.update(cve_prioritizer_wrapper.enrich_cves(missing_cves))
+
+            cve_priority_details = cve_prioritizer_wrapper.apply_thresholds(
+                {cve: enrichments[cve] for cve in vulnerabilities.keys() if cve in enrichments})
 
-            vulnerabilities = data[ip_address][port]["vulnerabilities"]
             for cve in cve_priority_details.keys():
                 vulnerabilities[cve]["priority_details"] = cve_priority_details[cve]
 
-            data = {
-                **data,
-                ip_address: {
-                    **data[ip_address],
-                    port: {
-                        **data[ip_address][port],
-                        "vulnerabilities": vulnerabilities
-                    }
-
-                }
-            }
+    _store_cve_enrichments(task_id, enrichments)
 
 
-def _prioritize_technology_cves(data, cves_list):
-    cve_priority_details = cve_prioritizer_wrapper.prioritize_cves(cves_list)
+def _prioritize_technology_cves(data, cves_list, task_id=None):
+    enrichments = cve_prioritizer_wrapper.enrich_cves(cves_list)
+    cve_priority_details = cve_prioritizer_wrapper.apply_thresholds(enrichments)
 
     for cve, details in cve_priority_details.items():
         data["vulnerabilities"][cve] = details
 
+    _store_cve_enrichments(task_id, enrichments)
     return data
+
+
+def _store_scan_run(task, result):
+    # the result is stored in the database, the result backend only keeps a reference to it
+    if task.request.id is None:
+        # called directly instead of as a task
+        return result
+    return store_scan_result(task.request.id, task.name, result, stopped=cancellation.stopped())
+
+
+def _store_cve_enrichments(task_id, enrichments):
+    if task_id is None or not enrichments:
+        return
+
+    CveEnrichment.objects.bulk_create(
+        [
+            CveEnrichment(
+                task_id=task_id,
+                cve_id=cve,
+                epss=enrichment["epss"],
+                percentile=enrichment["percentile"],
+                cvss_base_score=enrichment["cvss_baseScore"],
+                cvss_version=enrichment["cvss_version"],
+                cvss_severity=enrichment["cvss_severity"],
+                cisa_kev=enrichment["cisa_kev"],
+            )
+            for cve, enrichment in enrichments.items()
+        ],
+        # the same CVE can be reported for several technologies of one scan
+        ignore_conflicts=True,
+    )
@@ -1,3 +1,1485 @@
-from django.test import TestCase
+import csv
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from pypdf import PdfReader
+from django.test import SimpleTestCase, TestCase, override_settings
+from kombu.serialization import dumps, loads
+import redis
+import requests
+from prometheus_client import CONTENT_TYPE_LATEST
+from rest_framework.test import APIClient
+
+from backend.celery import WORKER_PROFILES, app as celery_app, apply_worker_profile, debug_task
+from compliance.tasks import generate_report_task, ping_ips_task, refresh_kev_catalog_task, \
+    technologies_vulnerability_scan_task
+from compliance.utils import instrumentation, tracing
+from compliance.utils.reports import merge_pdfs, render_pdf
+from compliance.utils.cancellation import DEADLINE_HEADER, TaskStopped, cancel, communicate, task_scope
+from compliance.utils.deduplication import fingerprint, submit_scan
+from compliance.utils.metrics import TASKS, CeleryQueueCollector
+from compliance.utils.results import ResultPolicyTask, delete_expired_result_files, load_result, offload_result
+from compliance.utils.scan_results import scan_result, scan_runs_with_results, store_scan_result, summarize_scan_runs
+from compliance.utils.scheduling import BULK_PRIORITY, _dispatch_queue, dispatch_chunks, submit_bulk_scan
+from compliance.utils.utils import check_technology_for_cves
+from compliance.models import Company, Certificate, Requirement, Assessment, AssessmentRequirement, AssessmentScan, \
+    CveEnrichment, Finding, ScanChunk, ScanRun
+from cve_prioritizer.cve_prioritizer.scripts import kev
+from cve_prioritizer.cve_prioritizer.scripts.constants import CISA_KEV_RELOAD_INTERVAL, NVD_TIMEOUT, OUTPUT_FIELDS
+from cve_prioritizer.cve_prioritizer.scripts.helpers import classify_cve, enrich_cve, nist_check, stream_prioritize, \
+    worker
+from cve_prioritizer.cve_prioritizer.scripts.output_writer import OutputWriter
+from cve_prioritizer.cve_prioritizer.scripts.rate_limiter import RateLimiter
+
+
+class CveReprioritizationTests(TestCase):
+    def setUp(self):
+        CveEnrichment.objects.bulk_create([
+            CveEnrichment(task_id="scan", cve_id="CVE-2021-1", epss=0.5, cvss_base_score=9.0),
+            CveEnrichment(task_id="scan", cve_id="CVE-2021-2", epss=0.1, cvss_base_score=9.8),
+            CveEnrichment(task_id="scan", cve_id="CVE-2021-3", epss=0.01, cisa_kev=True),
+            # not enriched by EPSS, i.e., it cannot be prioritized
+            CveEnrichment(task_id="scan", cve_id="CVE-2021-4", cvss_base_score=7.5),
+            CveEnrichment(task_id="other", cve_id="CVE-2021-5", epss=0.9, cvss_base_score=10.0),
+        ])
+
+    def reprioritize(self, task_id, **thresholds):
+        return APIClient().post(f"/tasks/{task_id}/reprioritize/", thresholds, format="json")
+
+    @mock.patch("cve_prioritizer.cve_prioritizer.scripts.helpers.requests.get")
+    def test_stored_enrichments_are_reprioritized(self, get):
+        response = self.reprioritize("scan")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({key: response.json()[key] for key in ["task_id", "epss", "cvss"]},
+                         {"task_id": "scan", "epss": 0.2, "cvss": 6.0})
+        self.assertEqual([(cve["cve_id"], cve["priority"]) for cve in response.json()["results"]], [
+            ("CVE-2021-3", "Priority 1+"), ("CVE-2021-1", "Priority 1"), ("CVE-2021-2", "Priority 2"),
+        ])
+
+        # within the same priority, the higher EPSS comes first
+        response = self.reprioritize("scan", epss=0.05)
+        self.assertEqual([(cve["cve_id"], cve["priority"]) for cve in response.json()["results"]], [
+            ("CVE-2021-3", "Priority 1+"), ("CVE-2021-1", "Priority 1"), ("CVE-2021-2", "Priority 1"),
+        ])
+
+        response = self.reprioritize("scan", epss="0.6", cvss="9.5")
+        self.assertEqual([(cve["cve_id"], cve["priority"]) for cve in response.json()["results"]], [
+            ("CVE-2021-3", "Priority 1+"), ("CVE-2021-2", "Priority 2"), ("CVE-2021-1", "Priority 4"),
+        ])
+
+        # neither NVD nor EPSS are queried again
+        get.assert_not_called()
+
+    def test_unknown_task(self):
+        self.assertEqual(self.reprioritize("unknown").status_code, 404)
+
+    def test_invalid_thresholds(self):
+        self.assertEqual(self.reprioritize("scan", epss="high").status_code, 400)
+
+
+class KevCatalogTests(SimpleTestCase):
+    def setUp(self):
+        kev_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(kev_dir.cleanup)
+        self.path = os.path.join(kev_dir.name, "known_exploited_vulnerabilities.json")
+        self.write_catalog(["CVE-2021-44228", "cve-2023-1"])
+
+        # the in-memory catalog of the other tests is restored afterwards
+        for patcher in [mock.patch.multiple(kev, _kev_cves=frozenset(), _kev_file_mtime=None, _kev_last_checked=None),
+                        mock.patch.dict(os.environ, {"CISA_KEV_FILE": self.path})]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def write_catalog(self, cve_ids, mtime=None):
+        with open(self.path, "w") as f:
+            json.dump({"vulnerabilities": [{"cveID": cve_id} for cve_id in cve_ids] + [{"cveID": None}]}, f)
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    def test_catalog_is_loaded_on_the_first_lookup(self):
+        self.assertTrue(kev.is_kev("cve-2021-44228"))
+        self.assertTrue(kev.is_kev("CVE-2023-1"))
+        self.assertFalse(kev.is_kev("CVE-2021-1"))
+
+    def test_replaced_catalog_is_reloaded(self):
+        self.assertTrue(kev.is_kev("CVE-2021-44228"))
+        self.write_catalog(["CVE-2021-1"], mtime=time.time() + 10)
+
+        # the file is checked at most every CISA_KEV_RELOAD_INTERVAL seconds
+        self.assertFalse(kev.is_kev("CVE-2021-1"))
+
+        kev._kev_last_checked -= CISA_KEV_RELOAD_INTERVAL
+        self.assertTrue(kev.is_kev("CVE-2021-1"))
+        self.assertFalse(kev.is_kev("CVE-2021-44228"))
+
+    @mock.patch("cve_prioritizer.cve_prioritizer.scripts.kev.requests.get")
+    def test_refresh_replaces_the_local_copy(self, get):
+        get.return_value = mock.Mock(json=lambda: {"vulnerabilities": [{"cveID": "CVE-2024-1"}]})
+
+        self.assertEqual(kev.refresh_kev_catalog(), 1)
+        self.assertTrue(kev.is_kev("CVE-2024-1"))
+        with open(self.path) as f:
+            self.assertEqual(json.load(f), {"vulnerabilities": [{"cveID": "CVE-2024-1"}]})
+
+    @mock.patch("cve_prioritizer.cve_prioritizer.scripts.kev.requests.get",
+                side_effect=requests.exceptions.ConnectionError("CISA unavailable"))
+    def test_failed_download_keeps_the_local_copy(self, get):
+        with mock.patch("builtins.print"):
+            self.assertEqual(kev.refresh_kev_catalog(), 2)
+        self.assertTrue(kev.is_kev("CVE-2021-44228"))
+
+    @mock.patch("cve_prioritizer.cve_prioritizer.scripts.kev.requests.get",
+                side_effect=requests.exceptions.ConnectionError("CISA unavailable"))
+    def test_failed_download_without_a_local_copy(self, get):
+        os.remove(self.path)
+
+        with mock.patch("builtins.print"):
+            self.assertEqual(refresh_kev_catalog_task.apply().get(), 0)
+        self.assertFalse(kev.is_kev("CVE-2021-44228"))
+
+    @mock.patch("cve_prioritizer.cve_prioritizer.scripts.helpers.requests.get")
+    def test_listed_cves_are_not_looked_up_in_nvd(self, get):
+        epss = {"total": 1, "data": [{"epss": "0.01", "percentile": "0.1"}]}
+        get.return_value = mock.Mock(status_code=200, json=lambda: epss)
+
+        enrichment = enrich_cve("CVE-2021-44228")
+
+        self.assertTrue(enrichment["cisa_kev"])
+        self.assertEqual(classify_cve(enrichment, 6.0, 0.2)["priority"], "Priority 1+")
+        # only EPSS
+        self.assertEqual(get.call_count, 1)
+        self.assertIn("epss", get.call_args.args[0])
+
+    @mock.patch("cve_prioritizer.cve_prioritizer.scripts.helpers.requests.get")
+    def test_listed_cves_are_printed_verbosely(self, get):
+        epss = {"total": 1, "data": [{"epss": "0.01", "percentile": "0.1"}]}
+        get.return_value = mock.Mock(status_code=200, json=lambda: epss)
+        rows = []
+
+        with mock.patch("builtins.print") as print_:
+            worker("CVE-2021-44228", 6.0, 0.2, True, threading.Semaphore(), SimpleNamespace(write=rows.append))
+
+        # without NVD data, the CVSS columns are N/A
+        [line] = print_.call_args.args
+        self.assertIn("N/A", line)
+        self.assertEqual([(row["cve_id"], row["priority"], row["cvss"]) for row in rows],
+                         [("CVE-2021-44228", "Priority 1+", None)])
+
+
+class RateLimiterTests(SimpleTestCase):
+    def test_calls_within_the_period_are_limited(self):
+        clock = SimpleNamespace(now=0.0)
+
+        def sleep(seconds):
+            clock.now += seconds
+
+        limiter = RateLimiter(2, 30)
+        calls = []
+        with mock.patch("cve_prioritizer.cve_prioritizer.scripts.rate_limiter.time.monotonic", lambda: clock.now), \
+                mock.patch("cve_prioritizer.cve_prioritizer.scripts.rate_limiter.time.sleep", side_effect=sleep):
+            for _ in range(5):
+                limiter.acquire()
+                calls.append(clock.now)
+                clock.now += 1
+
+        # a sliding window, i.e., a slot is free again 30 seconds after the call that took it
+        self.assertEqual(calls, [0, 1, 30, 31, 60])
+
+    def test_threads_share_the_limit(self):
+        limiter = RateLimiter(3, 0.2)
+        calls = []
+
+        def acquire():
+            limiter.acquire()
+            calls.append(time.monotonic())
+
+        threads = [threading.Thread(target=acquire) for _ in range(7)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        calls.sort()
+        for first, fourth in zip(calls, calls[3:]):
+            self.assertGreaterEqual(fourth - first, 0.2)
+
+
+class StreamPrioritizeTests(SimpleTestCase):
+    def setUp(self):
+        self.rows = []
+        self.output_writer = SimpleNamespace(write=self.rows.append)
+        patcher = mock.patch("builtins.print")
+        self.print = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch("cve_prioritizer.cve_prioritizer.scripts.helpers.enrich_cve")
+    def test_every_valid_cve_is_written(self, enrich_cve):
+        enrich_cve.side_effect = lambda cve_id: {
+            "epss": 0.5, "cvss_baseScore": 9.0 if cve_id.endswith("1") else None, "cisa_kev": False,
+        }
+
+        lines = ["CVE-2021-1\n", "\n", "not a cve\n", "cve-2021-2\n", "CVEs.txt\n", "CVE-2021-3-1\n", "CVE-2021-11"]
+        self.assertEqual(stream_prioritize(lines, 6.0, 0.2, False, 2, self.output_writer), 0)
+
+        self.assertEqual(sorted(call.args[0] for call in enrich_cve.call_args_list),
+                         ["CVE-2021-1", "CVE-2021-11", "CVE-2021-2"])
+        # CVE-2021-2 has no CVSS score, i.e., it cannot be prioritized
+        self.assertEqual(sorted((row["cve_id"], row["priority"]) for row in self.rows),
+                         [("CVE-2021-1", "Priority 1"), ("CVE-2021-11", "Priority 1")])
+
+    @mock.patch("cve_prioritizer.cve_prioritizer.scripts.helpers.enrich_cve")
+    def test_input_is_read_while_cves_are_processed(self, enrich_cve):
+        release = threading.Event()
+        read = []
+
+        def enrich(cve_id):
+            release.wait()
+            return {"epss": 0.5, "cvss_baseScore": 9.0}
+
+        enrich_cve.side_effect = enrich
+
+        def lines():
+            for index in range(20):
+                read.append(index)
+                yield f"CVE-2021-{index}"
+
+        streaming = threading.Thread(target=stream_prioritize, args=(lines(), 6.0, 0.2, False, 2, self.output_writer))
+        streaming.start()
+        time.sleep(0.2)
+        # at most 2 * threads CVEs are in flight, the next line waits for one of them
+        self.assertEqual(len(read), 5)
+
+        release.set()
+        streaming.join()
+        self.assertEqual(len(read), 20)
+        self.assertEqual(len(self.rows), 20)
+
+    @mock.patch("cve_prioritizer.cve_prioritizer.scripts.helpers.worker")
+    def test_failed_cves_are_counted(self, worker):
+        def work(cve_id, cvss_score, epss_score, verbose_print, sem, output_writer):
+            sem.release()
+            if cve_id == "CVE-2021-3":
+                raise RuntimeError("Worker crashed")
+            return cve_id != "CVE-2021-1"
+
+        worker.side_effect = work
+        lines = ["CVE-2021-1", "CVE-2021-2", "CVE-2021-3", "CVE-2021-4"]
+
+        # both a CVE reported by the worker and an exception of the worker count
+        self.assertEqual(stream_prioritize(lines, 6.0, 0.2, False, 2, self.output_writer), 2)
+        self.print.assert_called_once_with("Error: RuntimeError: Worker crashed")
+
+    @mock.patch("cve_prioritizer.cve_prioritizer.scripts.helpers.enrich_cve",
+                return_value={"epss": 0.5, "cvss_baseScore": 9.0})
+    def test_rows_are_written_before_printing(self, enrich_cve):
+        self.print.side_effect = [BrokenPipeError("stdout closed"), None]
+        sem = threading.Semaphore(0)
+
+        self.assertFalse(worker("CVE-2021-1", 6.0, 0.2, False, sem, self.output_writer))
+        self.assertEqual([row["cve_id"] for row in self.rows], ["CVE-2021-1"])
+        self.assertIn("BrokenPipeError", self.print.call_args.args[0])
+        self.assertTrue(sem.acquire(blocking=False))
+
+    @mock.patch("cve_prioritizer.cve_prioritizer.scripts.helpers.enrich_cve")
+    def test_failed_cves_are_reported(self, enrich_cve):
+        enrich_cve.side_effect = lambda cve_id: {"epss": "0.5" if cve_id == "CVE-2021-2" else 0.5,
+                                                 "cvss_baseScore": 9.0}
+        sem = threading.Semaphore(0)
+
+        self.assertTrue(worker("CVE-2021-1", 6.0, 0.2, False, sem, self.output_writer))
+        # e.g., an unexpected EPSS value of the API
+        self.assertFalse(worker("CVE-2021-2", 6.0, 0.2, False, sem, self.output_writer))
+
+        self.assertEqual([row["cve_id"] for row in self.rows], ["CVE-2021-1"])
+        self.assertTrue(self.print.call_args.args[0].startswith("CVE-2021-2"))
+        self.assertIn("TypeError", self.print.call_args.args[0])
+        # the slots of both CVEs are released
+        self.assertTrue(sem.acquire(blocking=False) and sem.acquire(blocking=False))
+
+
+class OutputWriterTests(SimpleTestCase):
+    def setUp(self):
+        output_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(output_dir.cleanup)
+        self.output_dir = output_dir.name
+
+    def row(self, index):
+        return {"cve_id": f"CVE-2021-{index}", "priority": "Priority 1", "epss": 0.5, "cvss": 9.0,
+                "cvss_version": "CVSS 3.1", "cvss_severity": "CRITICAL", "cisa_kev": "FALSE"}
+
+    def test_rows_of_all_threads_are_written(self):
+        for output_format in ["csv", "jsonl"]:
+            with self.subTest(output_format=output_format):
+                path = os.path.join(self.output_dir, f"output.{output_format}")
+                with OutputWriter(path, output_format, batch_size=7) as writer:
+                    def write_rows(start):
+                        for index in range(start, start + 25):
+                            writer.write(self.row(index))
+
+                    # like the worker threads of the CLI
+                    threads = [threading.Thread(target=write_rows, args=(start,)) for start in range(0, 100, 25)]
+                    for thread in threads:
+                        thread.start()
+                    for thread in threads:
+                        thread.join()
+
+                with open(path, newline="") as f:
+                    if output_format == "csv":
+                        rows = list(csv.DictReader(f))
+                        self.assertEqual(list(rows[0]), OUTPUT_FIELDS)
+                    else:
+                        rows = [json.loads(line) for line in f]
+                self.assertEqual(sorted(row["cve_id"] for row in rows),
+                                 sorted(f"CVE-2021-{index}" for index in range(100)))
+
+    def test_rows_are_flushed_while_waiting(self):
+        path = os.path.join(self.output_dir, "output.jsonl")
+        with OutputWriter(path, "jsonl", flush_interval=0.05) as writer:
+            writer.write(self.row(1))
+            time.sleep(0.3)
+            with open(path) as f:
+                self.assertEqual([json.loads(line)["cve_id"] for line in f], ["CVE-2021-1"])
+
+    def test_write_errors_are_raised_on_close(self):
+        writer = OutputWriter(os.path.join(self.output_dir, "missing", "output.csv"))
+        writer.start()
+        writer.write(self.row(1))
+        with self.assertRaises(FileNotFoundError):
+            writer.close()
+
+    def test_unsupported_format(self):
+        with self.assertRaises(ValueError):
+            OutputWriter(os.path.join(self.output_dir, "output.xml"), "xml")
+
+
+class TaskEventTests(TestCase):
+    @mock.patch("builtins.print")
+    @mock.patch("compliance.utils.utils.httpx.get", return_value=mock.Mock(status_code=404, text="Not found"))
+    def test_event_of_a_finished_task(self, get, print):
+        events_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(events_dir.cleanup)
+        events_file = os.path.join(events_dir.name, "events.jsonl")
+
+        with override_settings(INSTRUMENTATION_EVENTS_FILE=events_file):
+            technologies_vulnerability_scan_task.apply(
+                args=[[{"product": "nginx", "version": "1.18.0", "vendor": "f5"}]], task_id="scan"
+            )
+
+        with open(events_file) as f:
+            [event] = [json.loads(line) for line in f]
+        self.assertEqual({key: event[key] for key in ["event", "task_name", "task_id", "state"]}, {
+            "event": "task_finished", "task_name": technologies_vulnerability_scan_task.name, "task_id": "scan",
+            "state": "SUCCESS",
+        })
+        self.assertEqual(event["api_calls"], {"nvd": 1})
+        # a 404 counts as an error of the API
+        self.assertEqual(event["api_errors"], {"nvd": 1})
+        self.assertEqual([stage["name"] for stage in event["stages"]], ["nvd_lookup"])
+        self.assertGreaterEqual(event["wall_time"], event["stages"][0]["wall_time"])
+
+    def test_api_calls_without_response_are_errors(self):
+        metrics = instrumentation.TaskMetrics("test")
+        token = instrumentation._current_metrics.set(metrics)
+        try:
+            with instrumentation.api_call("epss") as call:
+                call.status_code = 200
+            with self.assertRaises(ConnectionError), instrumentation.api_call("epss"):
+                raise ConnectionError("EPSS unavailable")
+        finally:
+            instrumentation._current_metrics.reset(token)
+
+        self.assertEqual(dict(metrics.api_calls), {"epss": 2})
+        self.assertEqual(dict(metrics.api_errors), {"epss": 1})
+
+
+class PrometheusMetricsTests(SimpleTestCase):
+    def broker(self, lengths):
+        client = mock.Mock()
+        client.llen.side_effect = lambda key: lengths.get(key, 0)
+        return mock.patch("compliance.utils.metrics.redis.Redis.from_url", return_value=client)
+
+    def test_queue_length_includes_every_priority(self):
+        collector = CeleryQueueCollector("redis://broker", ["api", "pdf"], priority_steps=[0, 3, 6, 9])
+        with self.broker({"api": 2, "api:3": 1, "api:9": 4, "pdf:6": 1, "nmap": 7}):
+            [queue_length] = collector.collect()
+
+        self.assertEqual({sample.labels["queue"]: sample.value for sample in queue_length.samples},
+                         {"api": 7, "pdf": 1})
+
+    def test_unavailable_broker_is_skipped(self):
+        collector = CeleryQueueCollector("redis://broker", ["api"])
+        with mock.patch("compliance.utils.metrics.redis.Redis.from_url",
+                        side_effect=redis.exceptions.ConnectionError("Broker unavailable")):
+            self.assertEqual(list(collector.collect()), [])
+
+    def test_metrics_endpoint(self):
+        TASKS.labels("compliance.tasks.ping_ips_task", "SUCCESS").inc()
+        with self.broker({"api": 3, "nmap:9": 1}):
+            response = APIClient().get("/metrics")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], CONTENT_TYPE_LATEST)
+        content = response.content.decode()
+        self.assertIn('certsec_tasks_total{state="SUCCESS",task="compliance.tasks.ping_ips_task"}', content)
+        self.assertIn('certsec_celery_queue_length{queue="api"} 3.0', content)
+        self.assertIn('certsec_celery_queue_length{queue="nmap"} 1.0', content)
+
+
+class TracingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.exporter = tracing.InMemorySpanExporter()
+        # the exporter of the settings is restored afterwards
+        patcher = mock.patch.multiple(tracing, _exporter=self.exporter, _exporter_configured=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def spans(self):
+        return {span["name"]: span for span in self.exporter.get_finished_spans()}
+
+    def test_requests_are_traced_by_route(self):
+        response = APIClient().get("/companies/")
+        self.assertEqual(response.status_code, 200)
+
+        span = self.spans()["GET companies/"]
+        self.assertEqual(span["kind"], "server")
+        self.assertIsNone(span["parent_id"])
+        self.assertEqual(span["status"], "ok")
+        self.assertEqual(span["attributes"],
+                         {"http.method": "GET", "http.target": "/companies/", "http.status_code": 200})
+
+    def test_trace_of_the_client_is_continued(self):
+        trace_id, parent_id = "4bf92f3577b34da6a3ce929d0e0e4736", "00f067aa0ba902b7"
+        APIClient().get("/companies/", HTTP_TRACEPARENT=f"00-{trace_id}-{parent_id}-01")
+
+        span = self.spans()["GET companies/"]
+        self.assertEqual((span["trace_id"], span["parent_id"]), (trace_id, parent_id))
+
+    @mock.patch("compliance.tasks.ping", return_value=0.01)
+    def test_tasks_are_children_of_the_request(self, ping):
+        ping_ips_task.app.conf.task_always_eager = True
+        self.addCleanup(setattr, ping_ips_task.app.conf, "task_always_eager", False)
+
+        APIClient().post("/ping/", {"ip_addresses": ["10.0.0.1"]}, format="json")
+
+        spans = self.spans()
+        request_span, task_span = spans["POST ping/"], spans[f"celery.task {ping_ips_task.name}"]
+        self.assertEqual(task_span["trace_id"], request_span["trace_id"])
+        self.assertEqual(task_span["parent_id"], request_span["span_id"])
+        self.assertEqual(task_span["attributes"]["celery.state"], "SUCCESS")
+
+    def test_traceparent_is_added_to_published_tasks(self):
+        headers = {}
+        with tracing.span("request") as request_span:
+            tracing._inject_traceparent(headers=headers)
+
+        self.assertEqual(headers, {"traceparent": request_span.traceparent})
+        self.assertEqual(tracing.parse_traceparent(headers["traceparent"]),
+                         (request_span.trace_id, request_span.span_id))
+        self.assertEqual(tracing.parse_traceparent("invalid"), (None, None))
+
+    def test_exceptions_are_recorded(self):
+        with self.assertRaises(ValueError), tracing.span("outer"), tracing.span("inner"):
+            raise ValueError("Invalid target")
+
+        spans = self.spans()
+        self.assertEqual(spans["inner"]["parent_id"], spans["outer"]["span_id"])
+        self.assertEqual(spans["inner"]["status"], "error")
+        self.assertEqual(spans["inner"]["attributes"], {"exception.type": "ValueError",
+                                                        "exception.message": "Invalid target"})
+
+    def test_memory_exporter_keeps_the_last_spans(self):
+        exporter = tracing.InMemorySpanExporter(max_spans=2)
+        tracing.set_exporter(exporter)
+        for name in ["first", "second", "third"]:
+            with tracing.span(name):
+                pass
+
+        spans = exporter.get_finished_spans()
+        self.assertEqual([span["name"] for span in spans], ["second", "third"])
+        self.assertEqual(exporter.get_finished_spans(trace_id=spans[0]["trace_id"]), spans[:1])
+
+    def test_file_exporter_of_the_settings(self):
+        traces_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(traces_dir.cleanup)
+        path = os.path.join(traces_dir.name, "traces.jsonl")
+
+        tracing._exporter_configured = False
+        with override_settings(TRACING_EXPORTER="file", TRACING_EXPORT_FILE=path):
+            self.assertIsInstance(tracing.get_exporter(), tracing.FileSpanExporter)
+        with tracing.span("nmap_scan", targets=2):
+            pass
+
+        with open(path) as f:
+            [span] = [json.loads(line) for line in f]
+        self.assertEqual((span["name"], span["attributes"]), ("nmap_scan", {"targets": 2}))
+        self.assertGreaterEqual(span["duration"], 0)
+
+
+class QueryBudgetTests(TestCase):
+    '''
+    The number of queries of the read endpoints may not grow with the number of
+    assessments, requirements or certificates
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        # the certificates, categories and requirements are created by the 0002_seed_db migration
+        technical = Certificate.objects.get(name="Technical Baseline")
+        requirements = list(Requirement.objects.filter(category__certificate=technical))
+        cls.requirement_count = len(requirements)
+
+        for i in range(10):
+            company = Company.objects.create(name=f"Company {i}")
+            assessment = Assessment.objects.create(company=company, certificate=technical)
+            AssessmentRequirement.objects.bulk_create([
+                AssessmentRequirement(assessment=assessment, requirement=requirement, fulfilled=j % 2 == 0)
+                for j, requirement in enumerate(requirements)
+            ])
+        cls.assessment = assessment
+
+    def setUp(self):
+        self.client = APIClient()
+        # measure the queries of the uncached catalog endpoints
+        cache.clear()
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_certificates(self):
+        with self.assertNumQueries(2):
+            certificates = self.get("/certificates/")
+
+        technical = next(certificate for certificate in certificates if certificate["name"] == "Technical Baseline")
+        self.assertEqual(technical["next_certificate"]["name"], "Cost-Aware Baseline")
+        self.assertEqual(technical["next_certificate"]["next_certificate"]["name"], "Comprehensive Baseline")
+        # the end of the chain is serialized as before, i.e., as an empty certificate
+        self.assertEqual(technical["next_certificate"]["next_certificate"]["next_certificate"],
+                         {"name": "", "description": ""})
+
+    def test_categories(self):
+        with self.assertNumQueries(3):
+            categories = self.get("/categories/?type=tb")
+
+        technical = Certificate.objects.get(name="Technical Baseline")
+        self.assertEqual(len(categories), technical.categories.count())
+        for category in categories:
+            for requirement in category["requirements"]:
+                self.assertEqual(requirement["category"]["id"], category["id"])
+
+    def test_requirements(self):
+        with self.assertNumQueries(1):
+            requirements = self.get("/requirements/")
+        self.assertEqual(len(requirements), Requirement.objects.count())
+
+    def test_assessment_requirements(self):
+        with self.assertNumQueries(1):
+            assessment_requirements = self.get("/assessment-requirements/")
+        self.assertEqual(len(assessment_requirements), 10 * self.requirement_count)
+
+    def test_assessment(self):
+        with self.assertNumQueries(3):
+            assessment = self.get(f"/assessments/{self.assessment.id}")
+
+        self.assertEqual(assessment["company"], {"name": "Company 9"})
+        self.assertEqual(assessment["certificate"]["next_certificate"]["name"], "Cost-Aware Baseline")
+        self.assertEqual(len(assessment["assessment_requirements"]), self.requirement_count)
+        self.assertIn("name", assessment["assessment_requirements"][0]["requirement"]["category"])
+
+    def test_assessments_page(self):
+        with self.assertNumQueries(2):
+            page = self.get("/assessments/?page_size=4&fields=id,company")
+
+        self.assertEqual(len(page["results"]), 4)
+        self.assertEqual(set(page["results"][0]), {"id", "company"})
+        self.assertIsNotNone(page["next"])
+
+    def test_assessments(self):
+        with self.assertNumQueries(3):
+            assessments = self.get("/assessments/")
+
+        self.assertEqual(len(assessments), 10)
+        self.assertEqual(len(assessments[0]["assessment_requirements"]), self.requirement_count)
+
+    def test_assessments_are_filtered(self):
+        company = Company.objects.get(name="Company 3")
+        assessments = self.get(f"/assessments/?company={company.id}&fields=id")
+        self.assertEqual(assessments, [{"id": Assessment.objects.get(company=company).id}])
+
+
+class AssessmentSubmissionTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.company = Company.objects.create(name="Company")
+        self.certificate = Certificate.objects.get(name="Technical Baseline")
+        self.requirements = list(Requirement.objects.filter(category__certificate=self.certificate))
+
+    def submit(self, user_responses):
+        return self.client.post("/assessments/", {
+            "company_id": self.company.id,
+            "certificate_id": self.certificate.id,
+            "user_responses": user_responses,
+        }, format="json")
+
+    def test_query_count_is_independent_of_questionnaire_size(self):
+        # in_bulk, the assessment and the bulk insert of its requirements, plus the savepoint of atomic()
+        for requirements in [self.requirements[:1], self.requirements]:
+            with self.assertNumQueries(5):
+                response = self.submit({str(requirement.id): "yes" for requirement in requirements})
+            self.assertEqual(response.status_code, 201)
+
+    def test_assessment_is_stored(self):
+        responses = {str(requirement.id): "yes" for requirement in self.requirements}
+        responses[str(self.requirements[0].id)] = "no"
+        response = self.submit(responses)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(response.json()["passed"])
+        assessment = Assessment.objects.get(id=response.json()["assessment_id"])
+        self.assertIsNone(assessment.valid_until)
+        self.assertEqual(assessment.assessment_requirements.count(), len(self.requirements))
+        self.assertEqual(assessment.assessment_requirements.filter(fulfilled=False).count(), 1)
+
+    def test_unknown_requirement_is_rejected(self):
+        response = self.submit({str(self.requirements[0].id): "yes", "999999": "yes"})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Assessment.objects.exists())
+
+
+class ListEndpointTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.certificate = Certificate.objects.get(name="Technical Baseline")
+        self.companies = [Company.objects.create(name=f"Company {i}") for i in range(5)]
+        requirement = Requirement.objects.filter(category__certificate=self.certificate).first()
+        for company in self.companies:
+            assessment = Assessment.objects.create(company=company, certificate=self.certificate)
+            AssessmentRequirement.objects.create(assessment=assessment, requirement=requirement)
+
+    def test_without_pagination_the_whole_list_is_returned(self):
+        response = self.client.get("/companies/")
+        self.assertEqual(response.json(), [{"name": company.name} for company in self.companies])
+
+    def test_cursor_pagination(self):
+        names = []
+        url = "/companies/?page_size=2"
+        while url:
+            page = self.client.get(url).json()
+            self.assertLessEqual(len(page["results"]), 2)
+            names += [company["name"] for company in page["results"]]
+            url = page["next"]
+
+        self.assertEqual(names, [company.name for company in reversed(self.companies)])
+
+    def test_filters(self):
+        company = self.companies[2]
+        response = self.client.get(f"/assessment-requirements/?company={company.id}&fields=id,assessment")
+        self.assertEqual(response.json(), [{
+            "id": AssessmentRequirement.objects.get(assessment__company=company).id,
+            "assessment": Assessment.objects.get(company=company).id,
+        }])
+
+        response = self.client.get(f"/requirements/?certificate={self.certificate.id}&automated=true&fields=id")
+        self.assertEqual(
+            [requirement["id"] for requirement in response.json()],
+            list(Requirement.objects.filter(category__certificate=self.certificate, is_automated_requirement=True)
+                 .values_list("id", flat=True))
+        )
+
+    def test_invalid_filter_is_rejected(self):
+        self.assertEqual(self.client.get("/assessment-requirements/?attempted_after=yesterday").status_code, 400)
+        self.assertEqual(self.client.get("/requirements/?category=abc").status_code, 400)
+
+
+class CatalogCacheTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        cache.clear()
+
+    def test_catalog_is_cached(self):
+        for url in ["/certificates/", "/categories/?type=cab", "/requirements/"]:
+            first = self.client.get(url)
+            with self.assertNumQueries(0):
+                second = self.client.get(url)
+            self.assertEqual(first.json(), second.json())
+
+    def test_not_modified(self):
+        response = self.client.get("/categories/?type=tb")
+        etag = response["ETag"]
+
+        with self.assertNumQueries(0):
+            response = self.client.get("/categories/?type=tb", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_saving_a_requirement_invalidates_the_catalog(self):
+        response = self.client.get("/requirements/")
+        etag = response["ETag"]
+
+        requirement = Requirement.objects.first()
+        requirement.description = "Changed"
+        requirement.save()
+
+        response = self.client.get("/requirements/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertIn("Changed", [requirement["description"] for requirement in response.json()])
+
+    def test_unknown_certificate_type(self):
+        self.assertEqual(self.client.get("/categories/?type=unknown").status_code, 400)
+
+
+@override_settings(REPORT_LLM_BACKEND="stub")
+class ReportTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        reports_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(reports_dir.cleanup)
+        settings_override = override_settings(REPORTS_DIR=reports_dir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        generate_report_task.app.conf.task_always_eager = True
+        self.addCleanup(setattr, generate_report_task.app.conf, "task_always_eager", False)
+
+        certificate = Certificate.objects.get(name="Technical Baseline")
+        self.company = Company.objects.create(name="Company")
+        self.requirements = list(Requirement.objects.filter(category__certificate=certificate)[:2])
+        self.assessments = []
+        for _ in range(2):
+            assessment = Assessment.objects.create(company=self.company, certificate=certificate)
+            AssessmentRequirement.objects.bulk_create([
+                AssessmentRequirement(assessment=assessment, requirement=requirement)
+                for requirement in reversed(self.requirements)
+            ])
+            self.assessments.append(assessment)
+
+    def request_report(self, assessment, **data):
+        return self.client.post(f"/assessments/{assessment.id}/report/", data, format="json")
+
+    def download(self, report_id):
+        response = self.client.get(f"/reports/{report_id}/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/pdf")
+        self.assertTrue(b"".join(response.streaming_content).startswith(b"%PDF"))
+
+    def test_report_is_generated_in_the_background_and_downloaded(self):
+        response = self.request_report(self.assessments[0])
+        self.assertEqual(response.status_code, 202)
+
+        # executed eagerly, i.e., the report is available right away
+        response = self.request_report(self.assessments[0])
+        self.assertEqual(response.status_code, 200)
+        self.download(response.json()["report_id"])
+
+    @mock.patch("compliance.utils.reports._stub_recommendations", return_value="<p>Recommendations</p>")
+    def test_same_report_is_generated_once(self, stub_recommendations):
+        self.assertEqual(self.request_report(self.assessments[0]).status_code, 202)
+
+        # one request per unfulfilled requirement
+        self.assertEqual(stub_recommendations.call_count, 2)
+
+        # same company, certificate and unfulfilled requirements
+        response = self.request_report(self.assessments[1])
+        self.assertEqual(response.status_code, 200)
+        self.download(response.json()["report_id"])
+        self.assertEqual(stub_recommendations.call_count, 2)
+
+        self.assertEqual(self.request_report(self.assessments[1], force_refresh=True).status_code, 202)
+        self.assertEqual(stub_recommendations.call_count, 4)
+
+    @mock.patch("compliance.utils.reports._stub_recommendations", return_value="<p>Recommendations</p>")
+    def test_fragments_are_reused_across_companies(self, stub_recommendations):
+        self.request_report(self.assessments[0])
+
+        # another company with one of the requirements and a new one
+        assessment = Assessment.objects.create(company=Company.objects.create(name="Other company"),
+                                               certificate=self.assessments[0].certificate)
+        new_requirement = Requirement.objects.filter(category__certificate=assessment.certificate)[2]
+        AssessmentRequirement.objects.bulk_create([
+            AssessmentRequirement(assessment=assessment, requirement=self.requirements[0]),
+            AssessmentRequirement(assessment=assessment, requirement=new_requirement),
+        ])
+
+        stub_recommendations.reset_mock()
+        self.assertEqual(self.request_report(assessment).status_code, 202)
+        self.assertEqual(stub_recommendations.call_count, 1)
+        self.assertIn(new_requirement.description, stub_recommendations.call_args.args[0]["user_msg"])
+
+    @mock.patch("compliance.utils.reports.APPENDIX_CHUNK_SIZE", 50)
+    @mock.patch("compliance.utils.reports._stub_recommendations", return_value="<p>Recommendations</p>")
+    def test_appendix_is_rendered_in_chunks(self, stub_recommendations):
+        CveEnrichment.objects.bulk_create([
+            CveEnrichment(task_id="scan", cve_id=f"CVE-2023-{index:05}", epss=0.1, cvss_base_score=7.5)
+            for index in range(120)
+        ])
+        store_scan_result("scan", "compliance.tasks.nmap_vulners_scan_task", {})
+
+        response = self.request_report(self.assessments[0])
+        self.assertEqual(response.status_code, 202)
+        response = self.request_report(self.assessments[0], scan_task_ids=["scan"])
+        self.assertEqual(response.status_code, 202)
+
+        response = self.request_report(self.assessments[0], scan_task_ids=["scan"])
+        self.assertEqual(response.status_code, 200)
+        download = self.client.get(f"/reports/{response.json()['report_id']}/")
+        pages = PdfReader(io.BytesIO(b"".join(download.streaming_content))).pages
+        text = "".join(page.extract_text() for page in pages)
+        # the report itself and the CVEs of all three chunks
+        self.assertIn("Recommendations", text)
+        self.assertIn("CVE-2023-00000", text)
+        self.assertIn("CVE-2023-00119", text)
+
+    @mock.patch("compliance.utils.reports._stub_recommendations", return_value="<p>Recommendations</p>")
+    def test_appendix_tables_of_the_scan_results(self, stub_recommendations):
+        store_scan_result("https", "compliance.tasks.check_https_connection_task", {
+            "example.com": {"protocol": "http", "description": "Not secure connection"},
+        })
+
+        response = self.request_report(self.assessments[0], scan_task_ids=["https", "running"])
+        self.assertEqual(response.status_code, 202)
+        response = self.request_report(self.assessments[0], scan_task_ids=["https"])
+        self.assertEqual(response.status_code, 200)
+        download = self.client.get(f"/reports/{response.json()['report_id']}/")
+        text = "".join(
+            page.extract_text() for page in PdfReader(io.BytesIO(b"".join(download.streaming_content))).pages
+        )
+        self.assertIn("HTTPS Checks", text)
+        self.assertIn("example.com", text)
+
+    def test_merging_the_appendix_uses_constant_memory(self):
+        parts_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(parts_dir.cleanup)
+        part = os.path.join(parts_dir.name, "part.pdf")
+        render_pdf("<p>Report</p>", part, [[
+            {"cve_id": f"CVE-2023-{index:05}", "epss": 0.1, "cvss_base_score": 7.5} for index in range(100)
+        ]])
+        part_pages = len(PdfReader(part).pages)
+
+        peaks = {}
+        for parts in [5, 20]:
+            merged = os.path.join(parts_dir.name, f"merged_{parts}.pdf")
+            tracemalloc.start()
+            try:
+                merge_pdfs([part] * parts, merged)
+                peaks[parts] = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+            pages = PdfReader(merged).pages
+            self.assertEqual(len(pages), parts * part_pages)
+            self.assertIn("CVE-2023-00099", pages[-1].extract_text())
+
+        # four times the parts, but only the offsets of their objects are kept
+        self.assertLess(peaks[20], peaks[5] * 1.2)
+
+    def test_scans_of_the_assessment_are_used_by_default(self):
+        store_scan_result("https", "compliance.tasks.check_https_connection_task", {
+            "example.com": {"protocol": "http", "description": "Not secure connection"},
+        })
+        AssessmentScan.objects.create(assessment=self.assessments[0], task_id="https")
+        AssessmentScan.objects.create(assessment=self.assessments[0], task_id="running")
+
+        self.assertEqual(self.request_report(self.assessments[0]).status_code, 202)
+        self.assertEqual(self.request_report(self.assessments[0], scan_task_ids=["https"]).status_code, 200)
+
+        # the report is generated again once the other scan has finished
+        store_scan_result("running", "compliance.tasks.check_https_connection_task", {})
+        self.assertEqual(self.request_report(self.assessments[0]).status_code, 202)
+
+    def test_invalid_scan_task_ids(self):
+        response = self.request_report(self.assessments[0], scan_task_ids="scan")
+        self.assertEqual(response.status_code, 400)
+
+    def test_unknown_assessment(self):
+        self.assertEqual(self.client.post("/assessments/999999/report/").status_code, 404)
+
+    def test_unknown_report(self):
+        self.assertEqual(self.client.get(f"/reports/{'0' * 64}/").status_code, 404)
+
+
+def _cve(priority):
+    return {"type": "cve", "cvss": 7.5, "is_exploit": False, "priority_details": {"priority": priority}}
+
+
+class ScanResultTests(TestCase):
+    def test_results_are_rebuilt_from_the_database(self):
+        CveEnrichment.objects.create(task_id="ips", cve_id="CVE-2021-1", epss=0.3, cvss_base_score=7.5,
+                                     cvss_version="CVSS 3.1", cvss_severity="HIGH")
+        priority_details = {"priority": "Priority 1", "epss": 0.3, "cvss_baseScore": 7.5, "cvss_version": "CVSS 3.1",
+                            "cvss_severity": "HIGH", "cisa_kev": "FALSE"}
+        results = {
+            "ping_ips_task": {"10.0.0.1": {"connection_established": "True", "description": "Reachable"}},
+            "check_https_connection_task": {
+                "example.com": {"protocol": "https", "description": "Secure connection"},
+                "example.org": {"protocol": "undefined", "error": "Timeout", "raw_error": "ReadTimeout"},
+            },
+            "nmap_top_ports_scan_task": {"10.0.0.1": [
+                {"portid": "22", "protocol": "tcp", "state": "open", "reason": "syn-ack", "service": {"name": "ssh"}},
+            ]},
+            "nmap_vulners_scan_task": {
+                "10.0.0.1": {"80": {"protocol": "tcp", "service": {"name": "http", "product": "nginx", "version": "1.18.0"},
+                                    "vulnerabilities": {
+                                        "CVE-2021-1": {"type": "cve", "cvss": 7.5, "is_exploit": True,
+                                                       "priority_details": priority_details},
+                                        "CVE-2021-2": {"type": "cve", "cvss": 5.0, "is_exploit": False},
+                                    }}},
+                "10.0.0.2": {},
+            },
+            "technologies_vulnerability_scan_task": [
+                {"product": "http_server", "version": "2.4.49", "vendor": "apache",
+                 "vulnerabilities": {"CVE-2021-1": priority_details}},
+                {"product": "unknown", "version": "1", "vendor": "unknown", "vulnerabilities": {}, "error": "Not found"},
+            ],
+        }
+
+        for task, result in results.items():
+            with self.subTest(task=task):
+                task_id = "ips" if task in ["nmap_vulners_scan_task", "technologies_vulnerability_scan_task"] else task
+                reference = store_scan_result(task_id, f"compliance.tasks.{task}", result)
+                with self.assertNumQueries(5):
+                    scan_run = scan_runs_with_results(ScanRun.objects.filter(id=reference["scan_run_id"])).get()
+                    self.assertEqual(scan_result(scan_run), result)
+
+    def test_retried_task_replaces_its_result(self):
+        result = {"10.0.0.1": {"80": {"protocol": "tcp", "service": {}, "vulnerabilities": {"CVE-2021-1": _cve("Priority 1")}}}}
+        store_scan_result("ips", "compliance.tasks.nmap_vulners_scan_task", result)
+        store_scan_result("ips", "compliance.tasks.nmap_vulners_scan_task", result)
+
+        self.assertEqual(ScanRun.objects.count(), 1)
+        self.assertEqual(Finding.objects.count(), 1)
+
+    def submit_assessment(self, scan_task_ids):
+        certificate = Certificate.objects.get(name="Technical Baseline")
+        requirement = Requirement.objects.filter(category__certificate=certificate).first()
+        response = APIClient().post("/assessments/", {
+            "company_id": Company.objects.get_or_create(name="Company")[0].id,
+            "certificate_id": certificate.id,
+            "user_responses": {str(requirement.id): "yes"},
+            "scan_task_ids": scan_task_ids,
+        }, format="json")
+        self.assertEqual(response.status_code, 201)
+        return response.json()["assessment_id"]
+
+    def test_scans_are_linked_to_the_submitted_assessment(self):
+        store_scan_result("https", "compliance.tasks.check_https_connection_task", {})
+
+        # the other scan is still running, i.e., it has no ScanRun yet
+        assessment_id = self.submit_assessment(["https", "running", "https"])
+
+        self.assertEqual(
+            sorted(AssessmentScan.objects.filter(assessment_id=assessment_id).values_list("task_id", flat=True)),
+            ["https", "running"]
+        )
+
+    def test_shared_scan_is_linked_to_every_assessment(self):
+        # e.g., identical scan requests of two assessments that have been deduplicated
+        assessment_ids = [self.submit_assessment(["shared"]) for _ in range(2)]
+        store_scan_result("shared", "compliance.tasks.check_https_connection_task", {})
+
+        for assessment_id in assessment_ids:
+            self.assertEqual(list(AssessmentScan.objects.filter(assessment_id=assessment_id)
+                                  .values_list("task_id", flat=True)), ["shared"])
+        self.assertEqual(ScanRun.objects.get().task_id, "shared")
+
+    def test_findings_are_aggregated_per_priority_host_and_port(self):
+        store_scan_result("ports", "compliance.tasks.nmap_top_ports_scan_task", {
+            "10.0.0.1": [{"portid": "22", "protocol": "tcp", "service": {"name": "ssh"}}],
+        })
+        store_scan_result("ips", "compliance.tasks.nmap_vulners_scan_task", {
+            "10.0.0.1": {
+                "80": {"protocol": "tcp", "service": {"name": "http", "product": "nginx", "version": "1.18.0"},
+                       "vulnerabilities": {"CVE-2021-1": _cve("Priority 1"), "CVE-2021-2": _cve("Priority 2")}},
+                "443": {"protocol": "tcp", "service": {"name": "https"},
+                        "vulnerabilities": {"CVE-2021-1": _cve("Priority 1"), "CVE-2021-3": {"type": "cve"}}},
+            },
+            "10.0.0.2": {},
+        })
+        store_scan_result("technologies", "compliance.tasks.technologies_vulnerability_scan_task", [
+            {"vendor": "apache", "product": "http_server", "version": "2.4.49",
+             "vulnerabilities": {"CVE-2021-41773": {"priority": "Priority 1+"}}},
+        ])
+
+        # scan runs, hosts, ports, findings and CVE enrichments
+        with self.assertNumQueries(5):
+            summary = summarize_scan_runs(["ports", "ips", "technologies"])
+
+        self.assertEqual(summary["priorities"], [
+            {"priority": "Priority 1+", "findings": 1, "cves": 1},
+            {"priority": "Priority 1", "findings": 2, "cves": 1},
+            {"priority": "Priority 2", "findings": 1, "cves": 1},
+            {"priority": "Not prioritized", "findings": 1, "cves": 1},
+        ])
+        self.assertEqual(summary["hosts"], [
+            {"host": "10.0.0.1", "ports": 3, "findings": 4, "highest_priority": "Priority 1"},
+            {"host": "10.0.0.2", "ports": 0, "findings": 0, "highest_priority": None},
+        ])
+        self.assertEqual([(port["port"], port["service"], port["findings"]) for port in summary["ports"]],
+                         [("22", "ssh", 0), ("80", "nginx 1.18.0", 2), ("443", "https", 2)])
+        self.assertEqual(summary["technologies"][0]["technology"], "apache http_server 2.4.49")
+        self.assertEqual(summary["technologies"][0]["highest_priority"], "Priority 1+")
+
+    def test_no_stored_scan_runs(self):
+        self.assertIsNone(summarize_scan_runs(["unknown"]))
+
+
+class CvePrioritizerHookTests(SimpleTestCase):
+    def test_standalone_tool_does_not_import_the_app(self):
+        script = (
+            "import sys\n"
+            "from cve_prioritizer.cve_prioritizer.scripts import helpers\n"
+            "print(sorted(m for m in sys.modules if m.split('.')[0] in ('compliance', 'django', 'celery')))\n"
+        )
+        env = {key: value for key, value in os.environ.items() if key != "DJANGO_SETTINGS_MODULE"}
+        output = subprocess.run([sys.executable, "-c", script], cwd=settings.BASE_DIR, env=env,
+                                capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.strip(), "[]")
+
+    @mock.patch("cve_prioritizer.cve_prioritizer.scripts.helpers.requests.get")
+    def test_installed_hooks_record_the_api_calls(self, get):
+        from cve_prioritizer.cve_prioritizer.scripts import hooks
+        from cve_prioritizer.cve_prioritizer.scripts.helpers import epss_check
+        from compliance.utils import instrumentation
+
+        get.return_value = mock.Mock(status_code=200, json=lambda: {"total": 1, "data": [{"epss": "0.5", "percentile": "0.9"}]})
+        self.assertIs(hooks.api_call, instrumentation.api_call)
+
+        metrics = instrumentation.TaskMetrics("test")
+        token = instrumentation._current_metrics.set(metrics)
+        try:
+            self.assertEqual(epss_check("CVE-2021-44228"), {"epss": 0.5, "percentile": 90})
+        finally:
+            instrumentation._current_metrics.reset(token)
+        self.assertEqual(dict(metrics.api_calls), {"epss": 1})
+
+
+class TracingWithoutDjangoTests(SimpleTestCase):
+    def test_spans_outside_of_django(self):
+        # e.g., benchmark_hot_paths.py, which calls the instrumented functions without Django settings
+        script = (
+            "from compliance.utils import instrumentation, tracing\n"
+            "with tracing.span('outer'), instrumentation.api_call('nvd') as call:\n"
+            "    call.status_code = 200\n"
+            "exporter = tracing.InMemorySpanExporter()\n"
+            "tracing.set_exporter(exporter)\n"
+            "with tracing.span('exported'):\n"
+            "    pass\n"
+            "print([span['name'] for span in exporter.get_finished_spans()])\n"
+        )
+        env = {key: value for key, value in os.environ.items() if key != "DJANGO_SETTINGS_MODULE"}
+        output = subprocess.run([sys.executable, "-c", script], cwd=settings.BASE_DIR, env=env,
+                                capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.strip(), "['exported']")
+
+
+class TaskInstrumentationTests(SimpleTestCase):
+    def run_task(self):
+        with mock.patch("compliance.utils.instrumentation.emit_event") as emit_event, \
+                mock.patch("builtins.print"):
+            debug_task.apply()
+        return emit_event.call_args.args[0]
+
+    def test_task_of_a_process_pool(self):
+        event = self.run_task()
+
+        self.assertFalse(event["shared_process"])
+        self.assertGreater(event["peak_rss"], 0)
+
+    @override_settings(INSTRUMENTATION_TRACEMALLOC=True)
+    def test_task_of_a_thread_pool(self):
+        # e.g., the api workers, whose tasks share the process
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            event = executor.submit(self.run_task).result()
+
+        self.assertTrue(event["shared_process"])
+        self.assertIsNone(event["peak_rss"])
+        self.assertIsNone(event["rss_growth"])
+        self.assertIsNone(event["python_peak_memory"])
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_cpu_time_of_the_thread(self):
+        metrics = instrumentation.TaskMetrics("test", shared_process=True)
+        metrics.start()
+        # CPU time of another thread is not counted
+        busy = threading.Thread(target=lambda: sum(range(20_000_000)))
+        busy.start()
+        busy.join()
+        metrics.finish()
+
+        self.assertLess(metrics.cpu_time, 0.05)
+
+
+class CompactSerializerTests(SimpleTestCase):
+    def test_scan_results_are_decoded_unchanged(self):
+        details = {"priority": "Priority 1", "epss": 0.3, "cvss_baseScore": 7.5, "cvss_version": "CVSS 3.1",
+                   "cvss_severity": "HIGH", "cisa_kev": "FALSE"}
+        result = {"10.0.0.1": {
+            "80": {"protocol": "tcp", "service": {"name": "http", "product": "nginx", "version": "1.18.0"},
+                   "vulnerabilities": {f"CVE-2021-{index}": {"type": "cve", "cvss": 7.5, "is_exploit": False,
+                                                              "priority_details": details} for index in range(200)}},
+            "443": {"protocol": "tcp", "service": {}, "vulnerabilities": {"CVE-2021-1": {"type": "cve"}}},
+        }, "10.0.0.2": {}}
+
+        content_type, content_encoding, data = dumps(result, serializer="compact")
+
+        self.assertEqual(loads(data, content_type, content_encoding), result)
+        # the keys of the CVEs are stored once per table instead of once per CVE
+        self.assertLess(len(data), len(dumps(result, serializer="json")[2]) / 5)
+
+    def test_records_with_different_keys_are_not_tables(self):
+        value = {"a": {"x": 1}, "b": {"y": 2}, "c": {"x": 1, "y": 2}, "d": [{"x": (1, 2)}], 1: None}
+
+        content_type, content_encoding, data = dumps(value, serializer="compact")
+
+        self.assertEqual(loads(data, content_type, content_encoding),
+                         {"a": {"x": 1}, "b": {"y": 2}, "c": {"x": 1, "y": 2}, "d": [{"x": [1, 2]}], 1: None})
+
+
+class ResultPolicyTests(TestCase):
+    def setUp(self):
+        results_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(results_dir.cleanup)
+        settings_override = override_settings(RESULTS_DIR=results_dir.name, RESULT_OFFLOAD_THRESHOLD=100)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_large_results_are_offloaded_to_files(self):
+        small_result = {"10.0.0.1": []}
+        large_result = {f"10.0.0.{index}": [] for index in range(20)}
+
+        self.assertEqual(offload_result("compliance.tasks.ping_ips_task", "id", small_result), small_result)
+        reference = offload_result("compliance.tasks.ping_ips_task", "id", large_result)
+        self.assertEqual(reference, {"result_file": "compliance.tasks.ping_ips_task/id"})
+        self.assertEqual(load_result(reference), large_result)
+        self.assertEqual(load_result(small_result), small_result)
+
+    def test_tasks_offload_their_results(self):
+        self.assertIsInstance(generate_report_task, ResultPolicyTask)
+        with mock.patch("compliance.tasks.generate_report", return_value="f" * 64):
+            result = generate_report_task.apply(args=[1]).get()
+        self.assertEqual(load_result(result), {"assessment_id": 1, "report_id": "f" * 64})
+        self.assertIn("result_file", result)
+
+    @mock.patch("compliance.tasks.ping", return_value=0.01)
+    def test_bound_tasks_see_their_request(self, ping):
+        result = ping_ips_task.apply(args=[["10.0.0.1"]], task_id="ping")
+
+        self.assertEqual(result.get(), {"scan_run_id": ScanRun.objects.get(task_id="ping").id})
+
+    @override_settings(CELERY_RESULT_EXPIRES=60, RESULT_EXPIRES_PER_TASK={"compliance.tasks.generate_report_task": 10})
+    def test_expired_result_files_are_deleted(self):
+        reference = offload_result("compliance.tasks.generate_report_task", "id", {"result": "x" * 100})
+        other_reference = offload_result("compliance.tasks.ping_ips_task", "id", {"result": "x" * 100})
+        self.assertEqual(delete_expired_result_files(), 0)
+
+        # older than the expiry of generate_report_task, but not than the default
+        for result in [reference, other_reference]:
+            path = os.path.join(settings.RESULTS_DIR, f"{result['result_file']}.json")
+            os.utime(path, (os.path.getmtime(path) - 30,) * 2)
+
+        self.assertEqual(delete_expired_result_files(), 1)
+        with self.assertRaises(FileNotFoundError):
+            load_result(reference)
+        self.assertEqual(load_result(other_reference), {"result": "x" * 100})
+
+    def test_invalid_references_are_rejected(self):
+        with self.assertRaises(ValueError):
+            load_result({"result_file": "../../id"})
+
+
+class TaskRoutingTests(SimpleTestCase):
+    def queue(self, task_name):
+        return celery_app.amqp.router.route({}, task_name)["queue"]
+
+    def test_tasks_are_routed_by_workload(self):
+        for task_name, queue in [
+            ("compliance.tasks.nmap_vulners_scan_task", "nmap"),
+            ("compliance.tasks.ping_ips_task", "api"),
+            ("compliance.tasks.technologies_vulnerability_scan_task", "api"),
+            ("compliance.tasks.generate_report_task", "pdf"),
+            ("compliance.tasks.delete_expired_results_task", "celery"),
+        ]:
+            with self.subTest(task=task_name):
+                self.assertEqual(self.queue(task_name).name, queue)
+                # the routing key selects the queue the message is delivered to
+                self.assertEqual(self.queue(task_name).routing_key, queue)
+
+    def test_worker_profile(self):
+        self.assertEqual(sorted(WORKER_PROFILES), sorted(settings.CELERY_METRICS_QUEUES))
+
+        app = mock.Mock()
+        apply_worker_profile(app, "api")
+
+        configuration = app.conf.update.call_args
+        self.assertEqual(configuration.args[0]["worker_pool"], "threads")
+        self.assertEqual([queue.name for queue in configuration.kwargs["task_queues"]], ["api"])
+        with self.assertRaises(ValueError):
+            apply_worker_profile(app, "unknown")
+
+
+class ScanDeduplicationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        ping_ips_task.app.conf.task_always_eager = True
+        self.addCleanup(setattr, ping_ips_task.app.conf, "task_always_eager", False)
+
+    def ping(self, ip_addresses):
+        response = self.client.post("/ping/", {"ip_addresses": ip_addresses}, format="json")
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_fingerprint_of_normalized_targets(self):
+        self.assertEqual(fingerprint("ping", ["10.0.0.2", " 10.0.0.1", "10.0.0.2"]), fingerprint("ping", ["10.0.0.1", "10.0.0.2"]))
+        self.assertNotEqual(fingerprint("ping", ["10.0.0.1"]), fingerprint("https", ["10.0.0.1"]))
+        self.assertNotEqual(fingerprint("scan", ["10.0.0.1"]), fingerprint("scan", ["10.0.0.1"], epss=0.5))
+        self.assertEqual(fingerprint("technologies", [{"product": "Nginx", "version": "1.18"}]),
+                         fingerprint("technologies", [{"version": "1.18", "product": "nginx"}]))
+
+    @mock.patch("compliance.tasks.ping", return_value=0.01)
+    def test_identical_requests_share_the_scan(self, ping):
+        first = self.ping(["10.0.0.1", "10.0.0.2"])
+        second = self.ping(["10.0.0.2", "10.0.0.1"])
+
+        self.assertFalse(first["deduplicated"])
+        self.assertTrue(second["deduplicated"])
+        self.assertEqual(first["task_id"], second["task_id"])
+        self.assertEqual(ping.call_count, 2)
+
+        self.assertFalse(self.ping(["10.0.0.3"])["deduplicated"])
+
+    @mock.patch("compliance.tasks.ping_ips_task.apply_async")
+    def test_deadline_is_part_of_the_fingerprint(self, apply_async):
+        without_deadline, _ = submit_scan(ping_ips_task, ["10.0.0.1"])
+        with_deadline, deduplicated = submit_scan(ping_ips_task, ["10.0.0.1"], deadline=60)
+        self.assertFalse(deduplicated)
+        self.assertNotEqual(with_deadline, without_deadline)
+
+        self.assertEqual(submit_scan(ping_ips_task, ["10.0.0.1"], deadline=60), (with_deadline, True))
+        self.assertFalse(submit_scan(ping_ips_task, ["10.0.0.1"], deadline=30)[1])
+
+    @mock.patch("compliance.tasks.ping_ips_task.apply_async")
+    def test_fingerprint_expires_with_the_task(self, apply_async):
+        task_id, _ = submit_scan(ping_ips_task, ["10.0.0.1"], deadline=60)
+        self.assertEqual(apply_async.call_args.kwargs["expires"], 60)
+
+        # not started until the deadline, i.e., discarded by the workers
+        with mock.patch("time.time", return_value=time.time() + 61):
+            new_task_id, deduplicated = submit_scan(ping_ips_task, ["10.0.0.1"], deadline=60)
+
+        self.assertFalse(deduplicated)
+        self.assertNotEqual(new_task_id, task_id)
+
+    @mock.patch("compliance.tasks.ping", return_value=0.01)
+    def test_finished_scans_are_reused_for_a_while(self, ping):
+        with override_settings(SCAN_DEDUPLICATION_RECENT=0):
+            first = self.ping(["10.0.0.1"])
+
+        self.assertNotEqual(self.ping(["10.0.0.1"])["task_id"], first["task_id"])
+
+    @mock.patch("compliance.tasks.store_scan_result", side_effect=RuntimeError("Database unavailable"))
+    @mock.patch("compliance.tasks.ping", return_value=0.01)
+    def test_failed_scans_are_not_reused(self, ping, store_scan_result):
+        first = self.ping(["10.0.0.1"])
+        second = self.ping(["10.0.0.1"])
+
+        self.assertFalse(second["deduplicated"])
+        self.assertNotEqual(first["task_id"], second["task_id"])
+
+
+@override_settings(SCAN_CHUNK_SIZE=2, SCAN_CHUNK_CONCURRENCY={"api": 1})
+class FairShareSchedulingTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.big = Company.objects.create(name="Big")
+        self.small = Company.objects.create(name="Small")
+
+    def eager(self):
+        ping_ips_task.app.conf.task_always_eager = True
+        self.addCleanup(setattr, ping_ips_task.app.conf, "task_always_eager", False)
+
+    @mock.patch("compliance.tasks.ping", return_value=0.01)
+    def test_chunks_are_interleaved_across_companies(self, ping):
+        # stored while no slot is free, i.e., the big scan has been submitted first
+        with override_settings(SCAN_CHUNK_CONCURRENCY={"api": 0}):
+            submit_bulk_scan(ping_ips_task, self.big, [f"10.0.0.{i}" for i in range(6)])
+            submit_bulk_scan(ping_ips_task, self.small, ["10.1.0.1", "10.1.0.2", "10.1.0.3"])
+
+        self.eager()
+        dispatch_chunks()
+
+        scanned = [call.args[0] for call in ping.call_args_list]
+        self.assertEqual(scanned, [
+            "10.0.0.0", "10.0.0.1", "10.1.0.1", "10.1.0.2", "10.0.0.2", "10.0.0.3", "10.1.0.3",
+            "10.0.0.4", "10.0.0.5",
+        ])
+        self.assertFalse(ScanChunk.objects.exclude(status=ScanChunk.Status.DONE).exists())
+
+    @mock.patch("compliance.tasks.ping_ips_task.apply_async")
+    def test_only_free_slots_are_queued_with_the_bulk_priority(self, apply_async):
+        with override_settings(SCAN_CHUNK_CONCURRENCY={"api": 0}):
+            batch = submit_bulk_scan(ping_ips_task, self.big, [f"10.0.0.{i}" for i in range(6)])
+            submit_bulk_scan(ping_ips_task, self.small, ["10.1.0.1"])
+        with override_settings(SCAN_CHUNK_CONCURRENCY={"api": 2}):
+            dispatch_chunks()
+
+        self.assertEqual(apply_async.call_count, 2)
+        self.assertEqual({call.kwargs["priority"] for call in apply_async.call_args_list}, {BULK_PRIORITY})
+        # the second slot goes to the other company instead of the second chunk of the first one
+        self.assertEqual([call.kwargs["args"] for call in apply_async.call_args_list],
+                         [[["10.0.0.0", "10.0.0.1"]], [["10.1.0.1"]]])
+        self.assertEqual(batch.chunks.filter(status=ScanChunk.Status.PENDING).count(), 2)
+
+    def test_dispatchers_of_a_queue_are_serialized(self):
+        events = []
+
+        def claim_chunks(queue, concurrency):
+            events.append("counted")
+            # another dispatcher would count the same free slots in the meantime without the lock
+            time.sleep(0.1)
+            events.append("claimed")
+            return []
+
+        with mock.patch("compliance.utils.scheduling._claim_chunks", side_effect=claim_chunks):
+            dispatchers = [threading.Thread(target=_dispatch_queue, args=("api", 1)) for _ in range(2)]
+            for dispatcher in dispatchers:
+                dispatcher.start()
+            for dispatcher in dispatchers:
+                dispatcher.join()
+
+        self.assertEqual(events, ["counted", "claimed", "counted", "claimed"])
+
+    @mock.patch("compliance.tasks.ping_ips_task.apply_async")
+    def test_lost_chunks_free_their_slot(self, apply_async):
+        batch = submit_bulk_scan(ping_ips_task, self.big, [f"10.0.0.{i}" for i in range(4)])
+        with override_settings(SCAN_CHUNK_TIMEOUT=-1):
+            dispatch_chunks()
+
+        self.assertEqual(apply_async.call_count, 2)
+        self.assertEqual(batch.chunks.filter(status=ScanChunk.Status.FAILED).count(), 1)
+
+    @mock.patch("compliance.tasks.ping", return_value=0.01)
+    def test_bulk_scan_endpoint(self, ping):
+        self.eager()
+        response = self.client.post("/scans/bulk/", {
+            "company_id": self.big.id, "scan": "ping", "targets": ["10.0.0.1", "10.0.0.2", "10.0.0.3"],
+        }, format="json")
+
+        self.assertEqual(response.status_code, 202)
+        task_ids = response.json()["task_ids"]
+        self.assertEqual(len(task_ids), 2)
+        self.assertEqual(set(ScanRun.objects.values_list("task_id", flat=True)), set(task_ids))
+
+        batch = self.client.get(f"/scans/bulk/{response.json()['batch_id']}").json()
+        self.assertEqual(batch["chunks"], {"pending": 0, "queued": 0, "done": 2, "failed": 0, "cancelled": 0})
+
+    def test_invalid_bulk_scans(self):
+        self.assertEqual(self.client.post("/scans/bulk/", {"company_id": self.big.id, "scan": "unknown",
+                                                           "targets": ["10.0.0.1"]}, format="json").status_code, 400)
+        self.assertEqual(self.client.post("/scans/bulk/", {"company_id": self.big.id, "scan": "ping",
+                                                           "targets": []}, format="json").status_code, 400)
+        self.assertEqual(self.client.post("/scans/bulk/", {"company_id": 0, "scan": "ping",
+                                                           "targets": ["10.0.0.1"]}, format="json").status_code, 404)
+
+
+@mock.patch("celery.app.control.Control.revoke")
+class CancellationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        ping_ips_task.app.conf.task_always_eager = True
+        self.addCleanup(setattr, ping_ips_task.app.conf, "task_always_eager", False)
+
+    def test_cancelled_scan_stores_a_partial_result(self, revoke):
+        task_ids = []
+
+        def cancelled_after_first_host(ip):
+            self.client.post(f"/tasks/{task_ids[0]}/cancel/")
+            return 0.01
+
+        with mock.patch("compliance.tasks.ping", side_effect=cancelled_after_first_host), \
+                mock.patch("compliance.utils.deduplication.uuid.uuid4", side_effect=["first", "second"]):
+            task_ids.append("first")
+            self.client.post("/ping/", {"ip_addresses": ["10.0.0.1", "10.0.0.2", "10.0.0.3"]}, format="json")
+            revoke.assert_called_once_with("first")
+
+            scan_run = ScanRun.objects.get(task_id="first")
+            self.assertEqual(scan_run.stopped, "cancelled")
+            self.assertEqual(list(scan_result(scan_run)), ["10.0.0.1"])
+
+            # the partial result is not reused for the same request
+            second = self.client.post("/ping/", {"ip_addresses": ["10.0.0.1", "10.0.0.2", "10.0.0.3"]}, format="json")
+        self.assertEqual(second.json(), {"task_id": "second", "deduplicated": False})
+
+    def test_retries_stop_at_the_deadline(self, revoke):
+        request = SimpleNamespace(id=None, headers={DEADLINE_HEADER: time.time() + 0.2})
+        rate_limited = mock.Mock(status_code=429, text="Too many requests")
+
+        start = time.monotonic()
+        with mock.patch("compliance.utils.utils.httpx.get", return_value=rate_limited) as get, \
+                task_scope(request, "compliance.tasks.technologies_vulnerability_scan_task"):
+            result = check_technology_for_cves("nginx", "1.18.0", "f5")
+
+        self.assertIn("deadline", result["error"])
+        self.assertEqual(get.call_count, 1)
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_enrichment_stops_at_the_deadline(self, revoke):
+        request = SimpleNamespace(id=None, headers={DEADLINE_HEADER: time.time() + 0.2})
+        rate_limited = mock.Mock(status_code=429)
+
+        with mock.patch("cve_prioritizer.cve_prioritizer.scripts.helpers.requests.get",
+                        return_value=rate_limited) as get, \
+                task_scope(request, "compliance.tasks.technologies_vulnerability_scan_task"):
+            self.assertIsNone(enrich_cve("CVE-2099-0001"))
+
+        # NVD once, but not EPSS anymore
+        self.assertEqual(get.call_count, 1)
+        self.assertIn("nvd", get.call_args.args[0])
+
+    @mock.patch("cve_prioritizer.cve_prioritizer.scripts.helpers.requests.get", return_value=mock.Mock(status_code=404))
+    def test_nvd_requests_time_out_outside_of_tasks(self, get, revoke):
+        self.assertIn("error", nist_check("CVE-2099-0001"))
+        self.assertEqual(get.call_args.kwargs["timeout"], NVD_TIMEOUT)
+
+    def test_subprocess_is_killed_once_cancelled(self, revoke):
+        process = subprocess.Popen(["sleep", "30"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        cancel("scan")
+
+        with task_scope(SimpleNamespace(id="scan", headers={}), "compliance.tasks.nmap_vulners_scan_task"), \
+                self.assertRaises(TaskStopped) as stopped:
+            communicate(process)
+
+        self.assertEqual(stopped.exception.reason, "cancelled")
+        self.assertIsNotNone(process.poll())
+
+    @override_settings(SCAN_CHUNK_SIZE=1, SCAN_CHUNK_CONCURRENCY={"api": 0})
+    def test_pending_chunks_are_never_queued(self, revoke):
+        company = Company.objects.create(name="Big")
+        batch = submit_bulk_scan(ping_ips_task, company, ["10.0.0.1", "10.0.0.2", "10.0.0.3"])
+        first_task_id = batch.chunks.order_by("id").first().task_id
+
+        self.client.post(f"/tasks/{first_task_id}/cancel/")
+        self.assertEqual(ScanChunk.objects.get(task_id=first_task_id).status, ScanChunk.Status.CANCELLED)
+
+        response = self.client.post(f"/scans/bulk/{batch.id}/cancel/")
+        self.assertEqual(response.json()["chunks"]["cancelled"], 3)
+        self.assertFalse(ScanRun.objects.exists())
+
+    def test_invalid_deadline(self, revoke):
+        response = self.client.post("/ping/", {"ip_addresses": ["10.0.0.1"], "deadline": "soon"}, format="json")
+        self.assertEqual(response.status_code, 400)
@@ -1,4 +1,4 @@
-from django.urls import path
+from django.urls import path, re_path
 from . import views
 
 urlpatterns = [
@@ -7,6 +7,9 @@ urlpatterns = [
     path("scan-ports/", views.nmap_top_ports_scan),
     path("scan-vulners/ips", views.nmap_vulners_scan),
     path("scan-vulners/technologies", views.technology_vulners_scan),
+    path("scans/bulk/", views.bulk_scan),
+    path("scans/bulk/<int:id>", views.get_bulk_scan),
+    path("scans/bulk/<int:id>/cancel/", views.cancel_bulk_scan),
     path("companies/", views.companies),
     path("certificates/", views.get_certificates),
     path("categories/", views.get_categories),
@@ -15,5 +18,9 @@ urlpatterns = [
     path("assessments/", views.assessments),
     path("assessments/<int:id>", views.get_assessment),
     path("assessments/<int:id>/report/", views.generate_report),
+    re_path(r"^reports/(?P<report_id>[0-9a-f]{64})/$", views.download_report),
     path("tasks/", views.get_background_process_status),
+    path("tasks/<str:id>/cancel/", views.cancel_task),
+    path("tasks/<str:id>/reprioritize/", views.reprioritize_cves),
+    path("metrics", views.metrics),
 ]
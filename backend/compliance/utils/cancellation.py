@@ -0,0 +1,179 @@
+"""
+Cancellation and deadlines of the tasks.
+
+cancel() sets a flag in the cache (settings.CACHES, i.e., shared by the API and the workers) and revokes
+the task, i.e., a worker that has not started it yet discards it. A running task is not killed, since
+its results collected so far would be lost. Instead, the scans check stop_reason() between their
+targets, in the retry loops of the NVD requests (check_technology_for_cves and nist_check) and while
+waiting for nmap, which is killed then. They store what they have scanned until then, i.e., a partial
+result, with the reason ("cancelled" or "deadline") in ScanRun.stopped.
+
+Every task runs until its deadline: the one of its DEADLINE_HEADER, e.g., requested by the client, or
+settings.TASK_DEADLINES after it has started. Timeouts of requests and subprocesses are capped by
+remaining(), so that a task never waits beyond its deadline.
+
+The deadline of the running task is kept in a context variable, i.e., it is also seen by the threads
+that run in a copy of the task's context, e.g., the CVE enrichment of cve_prioritizer.
+"""
+import contextlib
+import contextvars
+import os
+import subprocess
+import time
+
+import nmap3
+from celery import current_app
+from django.conf import settings
+from django.core.cache import cache
+
+CANCELLED = "cancelled"
+DEADLINE = "deadline"
+# custom header of the task message with the deadline (UNIX timestamp) of the task
+DEADLINE_HEADER = "deadline"
+# seconds between two checks of the cancel flag while sleeping or waiting for a subprocess
+POLL_INTERVAL = 1
+
+
+class TaskStopped(Exception):
+    def __init__(self, reason):
+        super().__init__(f"Task stopped: {reason}")
+        self.reason = reason
+
+
+class _TaskScope:
+    def __init__(self, task_id, deadline):
+        self.task_id = task_id
+        self.deadline = deadline
+        # set once the task has noticed that it has to stop
+        self.reason = None
+
+
+_current_scope = contextvars.ContextVar("current_task_scope", default=None)
+
+
+def request_header(request, name):
+    # custom headers are attributes of the request in a worker, but only part of its headers if run eagerly
+    return getattr(request, name, None) or (request.headers or {}).get(name)
+
+
+def _cancel_key(task_id):
+    return f"cancelled:{task_id}"
+
+
+def cancel(task_id):
+    """
+    Marks the task as cancelled and revokes it, i.e., a worker that has not started it discards it
+    """
+    # kept as long as the task can run at most
+    cache.set(_cancel_key(task_id), True, timeout=max(settings.TASK_DEADLINES.values()))
+    current_app.control.revoke(task_id)
+
+
+def is_cancelled(task_id):
+    return cache.get(_cancel_key(task_id), False)
+
+
+@contextlib.contextmanager
+def task_scope(request, task_name):
+    """
+    Makes the deadline and the cancel flag of the task available to stop_reason() while it runs
+    """
+    deadlines = [request_header(request, DEADLINE_HEADER)]
+    if task_name in settings.TASK_DEADLINES:
+        deadlines.append(time.time() + settings.TASK_DEADLINES[task_name])
+    deadlines = [float(deadline) for deadline in deadlines if deadline is not None]
+
+    scope = _TaskScope(request.id, min(deadlines) if deadlines else None)
+    token = _current_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _current_scope.reset(token)
+
+
+def stop_reason():
+    """
+    "cancelled" or "deadline" if the current task has to stop, None if it can go on or outside of a task
+    """
+    scope = _current_scope.get()
+    if scope is None:
+        return None
+    if scope.reason is None:
+        if scope.deadline is not None and time.time() >= scope.deadline:
+            scope.reason = DEADLINE
+        elif scope.task_id is not None and is_cancelled(scope.task_id):
+            scope.reason = CANCELLED
+    return scope.reason
+
+
+def stopped():
+    """
+    The reason why the current task has stopped early, None if it has not noticed any
+    """
+    scope = _current_scope.get()
+    return scope.reason if scope is not None else None
+
+
+def remaining(timeout=None):
+    """
+    Seconds until the deadline of the current task, at most timeout, e.g., of a request
+    """
+    scope = _current_scope.get()
+    if scope is None or scope.deadline is None:
+        return timeout
+    # at least a moment, since requests does not accept timeouts of 0
+    left = max(scope.deadline - time.time(), 0.01)
+    return left if timeout is None else min(left, timeout)
+
+
+def sleep(seconds):
+    """
+    Sleeps like time.sleep, but returns False right away once the current task has to stop
+    """
+    end = time.monotonic() + seconds
+    while not stop_reason():
+        left = end - time.monotonic()
+        if left <= 0:
+            return True
+        # wakes up at the deadline at the latest
+        time.sleep(remaining(min(left, POLL_INTERVAL)))
+    return False
+
+
+def communicate(process, timeout=None):
+    """
+    Popen.communicate, but kills the process and raises TaskStopped once the current task has to stop
+    """
+    end = None if timeout is None else time.monotonic() + timeout
+    while True:
+        wait = POLL_INTERVAL if end is None else min(POLL_INTERVAL, max(end - time.monotonic(), 0))
+        try:
+            return process.communicate(timeout=wait)
+        except subprocess.TimeoutExpired:
+            reason = stop_reason()
+            if reason is None and (end is None or time.monotonic() < end):
+                continue
+            process.kill()
+            process.communicate()
+            if reason is None:
+                raise
+            raise TaskStopped(reason)
+
+
+class StoppableNmap(nmap3.Nmap):
+    """
+    nmap3.Nmap whose nmap subprocess is killed once the current task has to stop
+    """
+
+    def run_command(self, cmd, timeout=None):
+        if not os.path.exists(self.nmaptool):
+            raise nmap3.exceptions.NmapNotInstalledError()
+        if stop_reason():
+            raise TaskStopped(stop_reason())
+        sub_proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, errs = communicate(sub_proc, remaining(timeout))
+        if sub_proc.returncode != 0:
+            raise nmap3.exceptions.NmapExecutionError(
+                'Error during command: "' + " ".join(cmd) + '"\n\n' + errs.decode("utf8")
+            )
+        return output.decode("utf8").strip()
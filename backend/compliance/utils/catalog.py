@@ -0,0 +1,55 @@
+"""
+Cache of the serialized certificate/category/requirement catalog.
+
+The catalog only changes when the seed data is edited, so its serialized form is cached
+(settings.CACHES) under a version that is replaced whenever a Certificate, Category or
+Requirement is saved or deleted (see compliance/signals.py). The version doubles as the ETag,
+i.e., a client that already has the current catalog gets a 304 without any query or serialization.
+Changes made without model signals (QuerySet.update(), raw SQL) require invalidate_catalog().
+"""
+import uuid
+
+from django.core.cache import cache
+from rest_framework import status
+from rest_framework.response import Response
+
+CATALOG_VERSION_KEY = "catalog:version"
+
+
+def catalog_version():
+    # a random version instead of a counter, so that ETags stay unique after the cache is cleared
+    return cache.get_or_set(CATALOG_VERSION_KEY, lambda: uuid.uuid4().hex, timeout=None)
+
+
+def invalidate_catalog():
+    cache.set(CATALOG_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+def _etag_matches(request, etag):
+    if_none_match = request.headers.get("If-None-Match")
+    if not if_none_match:
+        return False
+    return etag in [tag.strip() for tag in if_none_match.split(",")]
+
+
+def catalog_response(request, name, build, not_found_error="Not found"):
+    """
+    Returns the cached catalog part name or, on a cache miss, the data returned by build.
+    If build returns None (e.g., a certificate does not exist), a 404 is returned and nothing is cached.
+    """
+    version = catalog_version()
+    etag = f'"{version}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+    if _etag_matches(request, etag):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    key = f"catalog:{version}:{name}"
+    data = cache.get(key)
+    if data is None:
+        data = build()
+        if data is None:
+            return Response({"error": not_found_error}, status.HTTP_404_NOT_FOUND)
+        cache.set(key, data, timeout=None)
+
+    return Response(data, headers=headers)
@@ -0,0 +1,90 @@
+"""
+Deduplication of identical scan requests.
+
+A scan request is identified by a fingerprint of the task and its normalized targets (sorted,
+without duplicates) and parameters. The first request adds the fingerprint to the cache
+(settings.CACHES, i.e., Redis in production) with cache.add, which is atomic, and starts the task.
+Identical requests get the task id of the running scan instead of starting another one.
+
+Once the task has finished successfully, the fingerprint is kept for SCAN_DEDUPLICATION_RECENT
+seconds, i.e., identical requests get the result of the recent scan. If the task fails, the
+fingerprint is deleted right away, so that the next request starts a new scan.
+
+A requested deadline is part of the fingerprint, i.e., a request never gets a scan that runs longer
+or shorter than requested. The task of such a request is discarded without running if it has not
+been started until its deadline, so its fingerprint expires at the deadline as well instead of
+attaching identical requests to a task that never runs.
+"""
+import hashlib
+import json
+import math
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+from compliance.utils.cancellation import DEADLINE_HEADER, is_cancelled, request_header
+
+# custom header of the task message with the cache key of its fingerprint
+FINGERPRINT_HEADER = "scan_fingerprint"
+
+
+def normalize_target(target):
+    if isinstance(target, dict):
+        # e.g., technologies with vendor, product and version
+        return {str(key): normalize_target(value) for key, value in target.items()}
+    return str(target).strip().lower()
+
+
+def fingerprint(task_name, targets, **parameters):
+    normalized_targets = sorted({json.dumps(normalize_target(target), sort_keys=True) for target in targets})
+    key = json.dumps({"task": task_name, "targets": normalized_targets, "parameters": parameters}, sort_keys=True)
+    return f"scan:{hashlib.sha256(key.encode()).hexdigest()}"
+
+
+def submit_scan(task, targets, deadline=None, **parameters):
+    """
+    Starts the task for the targets unless an identical scan is running or has finished recently.
+    Returns the task id and whether it belongs to an earlier request. A new task stops after deadline
+    seconds, see cancellation.py.
+    """
+    if deadline is None:
+        key = fingerprint(task.name, targets, **parameters)
+        timeout = settings.SCAN_DEDUPLICATION_TIMEOUT
+    else:
+        key = fingerprint(task.name, targets, deadline=deadline, **parameters)
+        # the task neither runs nor is started after its deadline
+        timeout = min(math.ceil(deadline), settings.SCAN_DEDUPLICATION_TIMEOUT)
+    task_id = str(uuid.uuid4())
+
+    # a duplicate can only attach to a task that has been reserved with add before, and it expires
+    # at the latest after SCAN_DEDUPLICATION_TIMEOUT, e.g., if the worker running the scan crashed
+    if not cache.add(key, task_id, timeout=timeout):
+        existing_task_id = cache.get(key)
+        # a cancelled task that has not been started never releases the fingerprint itself
+        if existing_task_id is not None and not is_cancelled(existing_task_id):
+            return existing_task_id, True
+        # expired or cancelled in the meantime
+        cache.set(key, task_id, timeout=timeout)
+
+    headers = {FINGERPRINT_HEADER: key}
+    if deadline is not None:
+        # discarded by the workers if it has not been started until the deadline
+        headers[DEADLINE_HEADER] = time.time() + deadline
+    task.apply_async(args=[targets], kwargs=parameters, task_id=task_id, headers=headers, expires=deadline)
+    return task_id, False
+
+
+def scan_finished(request, successful):
+    """
+    Called by the task once it has finished, keeps the fingerprint of a successful scan for a while
+    """
+    key = request_header(request, FINGERPRINT_HEADER)
+    # the fingerprint may belong to another task by now, e.g., if the scan took longer than the timeout
+    if key is None or cache.get(key) != request.id:
+        return
+    if successful:
+        cache.touch(key, settings.SCAN_DEDUPLICATION_RECENT)
+    else:
+        cache.delete(key)
@@ -0,0 +1,286 @@
+"""
+Per-task resource instrumentation for the Celery tasks.
+
+Every task gets a TaskMetrics object (wall time, CPU time, peak RSS, network bytes and calls to
+external APIs) that is created and finished by Celery's task_prerun/task_postrun signals. The code
+running inside a task adds to it through stage() and api_call(). Once the task has finished, the
+metrics are emitted as one structured (JSON) event to the "compliance.instrumentation" logger and,
+if settings.INSTRUMENTATION_EVENTS_FILE is set, appended to that file (JSON lines). Task durations
+and API calls are additionally exported as Prometheus metrics (see metrics.py), and every stage
+and API call is traced as a span (see tracing.py).
+
+A task that does not run in the main thread shares its process with other tasks, e.g., in the thread
+pool of the api workers (WORKER_PROFILES in backend/celery.py). Its CPU time is then the one of its
+thread (RUSAGE_THREAD), i.e., without the threads it starts itself, and the process-wide RSS and
+tracemalloc are not measured, since they would include the concurrent tasks. Its event has
+shared_process set and None as peak_rss, rss_growth and python_peak_memory.
+"""
+import collections
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import psutil
+from celery.signals import task_prerun, task_postrun, task_retry
+
+from compliance.utils import metrics as prometheus_metrics
+from compliance.utils import tracing
+
+logger = logging.getLogger("compliance.instrumentation")
+
+_current_metrics = contextvars.ContextVar("current_task_metrics", default=None)
+_events_file_lock = threading.Lock()
+
+
+def _cpu_time(thread=False):
+    # RUSAGE_THREAD is only available on Linux, the whole process is measured elsewhere
+    who = resource.RUSAGE_THREAD if thread and hasattr(resource, "RUSAGE_THREAD") else resource.RUSAGE_SELF
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _network_bytes():
+    # psutil only provides system-wide counters, i.e., concurrent traffic of other processes is included
+    counters = psutil.net_io_counters()
+    return counters.bytes_sent, counters.bytes_recv
+
+
+class PeakRssSampler:
+    """
+    Samples the RSS of the current process in a background thread. ru_maxrss cannot be used,
+    since it is the high-water mark of the whole process lifetime and not of a single task.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.initial_rss = 0
+        self.peak_rss = 0
+        self._process = psutil.Process(os.getpid())
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        self.initial_rss = self.peak_rss = self._process.memory_info().rss
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+    def _sample(self):
+        self.peak_rss = max(self.peak_rss, self._process.memory_info().rss)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._sample()
+            self._stop.wait(self.interval)
+
+
+class TaskMetrics:
+    def __init__(self, task_name, task_id=None, use_tracemalloc=False, shared_process=False):
+        self.task_name = task_name
+        self.task_id = task_id
+        # other tasks run in the same process, i.e., only the thread of the task is measured
+        self.shared_process = shared_process
+        self.use_tracemalloc = use_tracemalloc and not shared_process
+        self.api_calls = collections.Counter()
+        self.api_errors = collections.Counter()
+        self.api_time = collections.defaultdict(float)
+        self.stages = []
+        self._lock = threading.Lock()
+        self._rss_sampler = None if shared_process else PeakRssSampler()
+
+    def cpu_time_now(self):
+        return _cpu_time(thread=self.shared_process)
+
+    def start(self):
+        self.started_at = datetime.now(timezone.utc)
+        self._start_wall = time.perf_counter()
+        self._start_cpu = self.cpu_time_now()
+        self._start_network = _network_bytes()
+        if self._rss_sampler is not None:
+            self._rss_sampler.start()
+        if self.use_tracemalloc:
+            tracemalloc.start()
+
+    def finish(self, state=None):
+        self.state = state
+        self.python_peak_memory = None
+        if self.use_tracemalloc:
+            self.python_peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        if self._rss_sampler is not None:
+            self._rss_sampler.stop()
+        self.wall_time = time.perf_counter() - self._start_wall
+        self.cpu_time = self.cpu_time_now() - self._start_cpu
+        self.network_bytes_sent, self.network_bytes_received = (
+            end - start for start, end in zip(self._start_network, _network_bytes())
+        )
+
+    def snapshot(self):
+        """
+        Metrics of the task up to now, in the format of the evaluation results
+        """
+        wall_time = time.perf_counter() - self._start_wall
+        cpu_time = self.cpu_time_now() - self._start_cpu
+        if self._rss_sampler is not None:
+            self._rss_sampler._sample()
+        return {
+            "cpu_percent": cpu_time / wall_time * 100 if wall_time else 0,
+            "memory_used": self._rss_growth(),
+            "execution_time": wall_time,
+        }
+
+    def _rss_growth(self):
+        if self._rss_sampler is None:
+            return None
+        return self._rss_sampler.peak_rss - self._rss_sampler.initial_rss
+
+    def add_stage(self, name, wall_time, cpu_time):
+        with self._lock:
+            self.stages.append({"name": name, "wall_time": wall_time, "cpu_time": cpu_time})
+
+    def add_api_call(self, service, duration, failed):
+        with self._lock:
+            self.api_calls[service] += 1
+            self.api_time[service] += duration
+            if failed:
+                self.api_errors[service] += 1
+
+    def as_event(self):
+        return {
+            "event": "task_finished",
+            "task_name": self.task_name,
+            "task_id": self.task_id,
+            "state": self.state,
+            "started_at": self.started_at.isoformat(),
+            "wall_time": self.wall_time,
+            "cpu_time": self.cpu_time,
+            "shared_process": self.shared_process,
+            "peak_rss": self._rss_sampler.peak_rss if self._rss_sampler is not None else None,
+            "rss_growth": self._rss_growth(),
+            "python_peak_memory": self.python_peak_memory,
+            "network_bytes_sent": self.network_bytes_sent,
+            "network_bytes_received": self.network_bytes_received,
+            "api_calls": dict(self.api_calls),
+            "api_errors": dict(self.api_errors),
+            "api_time": dict(self.api_time),
+            "stages": self.stages,
+        }
+
+
+def current_metrics():
+    return _current_metrics.get()
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Records wall and CPU time of a part of a task, e.g., with stage("nmap_scan"): ...
+    """
+    metrics = current_metrics()
+    cpu_time = metrics.cpu_time_now if metrics is not None else _cpu_time
+    start_wall = time.perf_counter()
+    start_cpu = cpu_time()
+    try:
+        with tracing.span(name):
+            yield
+    finally:
+        if metrics is not None:
+            metrics.add_stage(name, time.perf_counter() - start_wall, cpu_time() - start_cpu)
+
+
+class ApiCall:
+    def __init__(self, service):
+        self.service = service
+        self.status_code = None
+
+
+@contextlib.contextmanager
+def api_call(service):
+    """
+    Counts a request to an external API (e.g., "nvd" or "epss") of the current task. Set the
+    status_code of the yielded object, responses with a status code >= 400 count as errors.
+    """
+    call = ApiCall(service)
+    start = time.perf_counter()
+    failed = True
+    try:
+        with tracing.span(f"{service} request", kind="client", service=service) as span:
+            try:
+                yield call
+            finally:
+                span.set_attribute("http.status_code", call.status_code)
+        failed = call.status_code is None or call.status_code >= 400
+    finally:
+        duration = time.perf_counter() - start
+        prometheus_metrics.API_REQUEST_DURATION.labels(service).observe(duration)
+        prometheus_metrics.API_REQUESTS.labels(service, call.status_code or "error").inc()
+
+        metrics = current_metrics()
+        if metrics is not None:
+            metrics.add_api_call(service, duration, failed)
+
+
+def record_api_retry(service):
+    prometheus_metrics.API_RETRIES.labels(service).inc()
+
+
+def emit_event(event):
+    from django.conf import settings
+
+    line = json.dumps(event, default=str)
+    logger.info(line)
+
+    events_file = getattr(settings, "INSTRUMENTATION_EVENTS_FILE", None)
+    if events_file:
+        with _events_file_lock, open(events_file, "a") as f:
+            f.write(line + "\n")
+
+
+@task_prerun.connect
+def _start_task_metrics(task_id=None, task=None, **kwargs):
+    from django.conf import settings
+
+    # e.g., the thread pool of the api workers, whereas prefork runs every task in the main thread of its process
+    shared_process = threading.current_thread() is not threading.main_thread()
+    metrics = TaskMetrics(task.name, task_id, getattr(settings, "INSTRUMENTATION_TRACEMALLOC", False), shared_process)
+    metrics.start()
+    task.request.instrumentation_token = _current_metrics.set(metrics)
+
+
+@task_postrun.connect
+def _finish_task_metrics(task_id=None, task=None, state=None, **kwargs):
+    metrics = current_metrics()
+    token = getattr(task.request, "instrumentation_token", None)
+    if metrics is None or token is None:
+        return
+
+    _current_metrics.reset(token)
+    metrics.finish(state)
+    prometheus_metrics.TASK_DURATION.labels(task.name).observe(metrics.wall_time)
+    prometheus_metrics.TASKS.labels(task.name, state).inc()
+    try:
+        emit_event(metrics.as_event())
+    except Exception as e:
+        logger.warning(f"Failed to emit instrumentation event of task {task_id}: {e}")
+
+
+@task_retry.connect
+def _count_task_retry(sender=None, **kwargs):
+    prometheus_metrics.TASK_RETRIES.labels(sender.name).inc()
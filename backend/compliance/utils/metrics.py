@@ -0,0 +1,112 @@
+"""
+Prometheus metrics of the Django API and the Celery workers.
+
+Celery's prefork pool runs the tasks in several processes, so the metrics need to be collected
+in prometheus_client's multiprocess mode: set PROMETHEUS_MULTIPROC_DIR to an (empty) directory
+shared by all processes of a host before starting Django or Celery. The API serves its metrics
+at /metrics, every worker at settings.CELERY_METRICS_PORT.
+"""
+import os
+
+import redis
+from celery.signals import worker_init, worker_process_shutdown
+from prometheus_client import CollectorRegistry, Counter, Histogram, REGISTRY, generate_latest, start_http_server
+from prometheus_client import multiprocess
+from prometheus_client.core import GaugeMetricFamily
+
+TASK_DURATION = Histogram(
+    "certsec_task_duration_seconds",
+    "Duration of Celery tasks",
+    ["task"],
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200),
+)
+TASKS = Counter("certsec_tasks_total", "Finished Celery tasks", ["task", "state"])
+TASK_RETRIES = Counter("certsec_task_retries_total", "Retried Celery tasks", ["task"])
+
+API_REQUEST_DURATION = Histogram(
+    "certsec_api_request_duration_seconds",
+    "Duration of requests to external APIs",
+    ["service"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+# status is the HTTP status code, or "error" if no response has been received
+API_REQUESTS = Counter("certsec_api_requests_total", "Requests to external APIs", ["service", "status"])
+API_RETRIES = Counter("certsec_api_retries_total", "Retried requests to external APIs", ["service"])
+
+CACHE_REQUESTS = Counter("certsec_cache_requests_total", "Cache lookups", ["cache", "result"])
+
+REPORT_GENERATION_DURATION = Histogram(
+    "certsec_report_generation_duration_seconds",
+    "Duration of the report generation stages",
+    ["stage"],
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 20, 40, 60, 120, 300),
+)
+
+
+def record_cache_lookup(cache, hit, count=1):
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc(count)
+
+
+class CeleryQueueCollector:
+    """
+    Reports the number of messages waiting in the Redis broker at scrape time
+    """
+
+    def __init__(self, broker_url, queues, priority_steps=(0,), sep=":"):
+        self.broker_url = broker_url
+        self.queues = queues
+        # Redis keeps a list per queue and priority, "<queue><sep><priority>" except for priority 0
+        self.priority_steps = priority_steps
+        self.sep = sep
+
+    def _queue_length(self, client, queue):
+        return sum(
+            client.llen(f"{queue}{self.sep}{priority}" if priority else queue) for priority in self.priority_steps
+        )
+
+    def collect(self):
+        queue_length = GaugeMetricFamily(
+            "certsec_celery_queue_length", "Messages waiting in the Celery queues", labels=["queue"]
+        )
+        try:
+            client = redis.Redis.from_url(self.broker_url, socket_timeout=1)
+            for queue in self.queues:
+                queue_length.add_metric([queue], self._queue_length(client, queue))
+        except redis.exceptions.RedisError:
+            return
+        yield queue_length
+
+
+def get_registry():
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def generate_latest_metrics(broker_url, queues, transport_options=None):
+    """
+    Metrics in the Prometheus text format, including the current length of the Celery queues
+    """
+    transport_options = transport_options or {}
+    queue_registry = CollectorRegistry()
+    queue_registry.register(CeleryQueueCollector(
+        broker_url, queues, transport_options.get("priority_steps", (0,)), transport_options.get("sep", ":")
+    ))
+    return generate_latest(get_registry()) + generate_latest(queue_registry)
+
+
+@worker_init.connect
+def _start_worker_metrics_server(**kwargs):
+    from django.conf import settings
+
+    port = getattr(settings, "CELERY_METRICS_PORT", None)
+    if port:
+        start_http_server(int(port), registry=get_registry())
+
+
+@worker_process_shutdown.connect
+def _mark_worker_process_dead(pid=None, **kwargs):
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(pid or os.getpid())
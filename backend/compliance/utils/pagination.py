@@ -0,0 +1,70 @@
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
+
+
+class IdCursorPagination(CursorPagination):
+    # newest rows first, the id is unique and never changes, i.e., a stable cursor
+    ordering = "-id"
+    page_size = 100
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+
+
+def _parse_value(value, kind):
+    if kind == "int":
+        try:
+            return int(value)
+        except ValueError:
+            return None
+    if kind == "bool":
+        return {"true": True, "false": False}.get(value.lower())
+    if kind == "date":
+        # a date or a datetime, e.g., 2023-07-01 or 2023-07-01T12:00:00Z
+        try:
+            return parse_datetime(value) or parse_date(value)
+        except ValueError:
+            return None
+    return value
+
+
+def filter_queryset(request, queryset, filters):
+    """
+    Applies the filters given as query parameters. filters maps a query parameter to a
+    (lookup, kind) tuple, e.g., {"company": ("company_id", "int")}, kind is one of
+    "int", "bool", "date" or "str". Invalid values are rejected with a 400.
+    """
+    lookups = {}
+    for parameter, (lookup, kind) in filters.items():
+        value = request.query_params.get(parameter)
+        if value is None:
+            continue
+        parsed_value = _parse_value(value, kind)
+        if parsed_value is None:
+            raise ValidationError({parameter: f"Invalid value: {value}"})
+        lookups[lookup] = parsed_value
+    return queryset.filter(**lookups)
+
+
+def requested_fields(request):
+    """
+    Fields selected with ?fields=id,name or None, if all fields are requested
+    """
+    fields = request.query_params.get("fields")
+    if not fields:
+        return None
+    return [field.strip() for field in fields.split(",") if field.strip()]
+
+
+def list_response(request, queryset, serializer_class, **serializer_kwargs):
+    """
+    Serializes a list endpoint. The whole queryset is returned as a plain list, as expected by
+    the existing clients, unless a page is requested with ?page_size=... or ?cursor=...
+    """
+    if "page_size" not in request.query_params and "cursor" not in request.query_params:
+        return Response(serializer_class(queryset, many=True, **serializer_kwargs).data)
+
+    paginator = IdCursorPagination()
+    page = paginator.paginate_queryset(queryset, request)
+    return paginator.get_paginated_response(serializer_class(page, many=True, **serializer_kwargs).data)
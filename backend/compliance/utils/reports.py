@@ -0,0 +1,344 @@
+"""
+Generation of the PDF reports with recommendations for the unfulfilled requirements of an assessment.
+
+The reports are generated by generate_report_task (compliance/tasks.py), since the LLM requests and
+the PDF rendering take tens of seconds. They are content-addressed: the report id is a hash of
+everything the report depends on (certificate, unfulfilled requirements, company name, scan tasks
+and REPORT_TEMPLATE_VERSION), so the HTML and PDF stored in settings.REPORTS_DIR are reused by every
+later request for the same report. Only the date in the report is then the one of its generation.
+
+The recommendations are requested from the LLM per requirement (at most settings.REPORT_LLM_CONCURRENCY
+at a time) and stored as HTML fragments per requirement and REPORT_TEMPLATE_VERSION, independent of the
+company. A new report therefore only requests the requirements that no earlier report contained, and
+pdf_report_template.html assembles the fragments with the header and the conclusion.
+
+Reports can include appendices generated from the stored results of the given scan tasks: tables
+aggregated per priority, host and port (see scan_results.py), and the CVEs found by the vulnerability
+scans (CveEnrichment). The CVEs are read from the database and rendered in chunks of
+APPENDIX_CHUNK_SIZE rows, each into its own PDF, which are merged afterwards part by part (see
+merge_pdfs). The memory used for rendering and merging therefore does not grow with the number of CVEs.
+
+settings.REPORT_LLM_BACKEND selects the LLM: "openai" or "stub", which returns a placeholder
+without any request, e.g., for tests and offline development.
+"""
+import contextvars
+import gc
+import hashlib
+import html as html_lib
+import itertools
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+from django.conf import settings
+from django.template.loader import get_template
+from django.utils import timezone
+from pypdf import PdfReader
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject, NullObject
+from xhtml2pdf import pisa
+
+from compliance.models import Assessment, AssessmentRequirement, CveEnrichment
+from compliance.utils import instrumentation
+from compliance.utils.metrics import REPORT_GENERATION_DURATION, record_cache_lookup
+from compliance.utils.scan_results import summarize_scan_runs
+from compliance.utils.utils import prepare_gpt_messages
+
+# Increase whenever the prompt or the report template changes, which invalidates all stored reports
+REPORT_TEMPLATE_VERSION = 3
+# Attempts per requirement, e.g., if the LLM stops before the recommendations are complete
+FRAGMENT_ATTEMPTS = 2
+# Rows of the appendix that are rendered at once
+APPENDIX_CHUNK_SIZE = 500
+
+
+class ReportGenerationError(Exception):
+    pass
+
+
+def report_path(report_id, extension="pdf"):
+    return os.path.join(settings.REPORTS_DIR, f"{report_id}.{extension}")
+
+
+def _fragments_dir():
+    return os.path.join(settings.REPORTS_DIR, "fragments")
+
+
+def fragment_path(requirement_id):
+    return os.path.join(_fragments_dir(), f"{requirement_id}-v{REPORT_TEMPLATE_VERSION}.html")
+
+
+def report_id(assessment, unfulfilled_requirements, scan_task_ids=None):
+    # the results of a scan task never change, i.e., its id identifies the content of the appendix
+    key = json.dumps({
+        "certificate": assessment.certificate_id,
+        "requirements": sorted(requirement.id for requirement in unfulfilled_requirements),
+        "company": assessment.company.name,
+        "scan_task_ids": sorted(scan_task_ids or []),
+        "template_version": REPORT_TEMPLATE_VERSION,
+    }, sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def _load_assessment(assessment_id):
+    assessment = Assessment.objects.select_related("company", "certificate").get(id=assessment_id)
+
+    # Fetch all the unfulfilled requirements that belong to this assessment
+    # and prefetch the related Requirement objects
+    unfulfilled_assessment_requirements = AssessmentRequirement.objects.filter(
+        assessment=assessment,
+        fulfilled=False
+    ).select_related('requirement')
+
+    # Extract the Requirement objects from the AssessmentRequirement objects
+    unfulfilled_requirements = [ar.requirement for ar in unfulfilled_assessment_requirements]
+    return assessment, unfulfilled_requirements
+
+
+def cached_report_id(assessment_id, scan_task_ids=None):
+    """
+    Id of the stored report of the assessment or None, if it has not been generated yet
+    """
+    assessment, unfulfilled_requirements = _load_assessment(assessment_id)
+    cached_id = report_id(assessment, unfulfilled_requirements, scan_task_ids)
+    hit = os.path.exists(report_path(cached_id))
+    record_cache_lookup("report", hit)
+    return cached_id if hit else None
+
+
+def _write_atomically(path, content):
+    # written into a temporary file first, so that a partially written report is never read
+    with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path), suffix=".tmp", delete=False) as f:
+        f.write(content)
+    os.replace(f.name, path)
+
+
+def _stub_recommendations(prompt):
+    return (
+        '<div style="page-break-before: always; padding: 10mm;">'
+        "<p>Generated without an LLM (REPORT_LLM_BACKEND=stub) for the following request:</p>"
+        f"<pre>{html_lib.escape(prompt['user_msg'])}</pre>"
+        "</div>"
+    )
+
+
+def request_recommendations(prompt):
+    """
+    Returns the HTML recommendations of the LLM for a prompt of prepare_gpt_messages
+    """
+    if getattr(settings, "REPORT_LLM_BACKEND", "openai") == "stub":
+        return _stub_recommendations(prompt)
+
+    openai.api_key = os.getenv("OPEN_AI_API")
+    with REPORT_GENERATION_DURATION.labels("llm").time(), instrumentation.stage("llm"), \
+            instrumentation.api_call("openai") as call:
+        response = openai.ChatCompletion.create(model="gpt-3.5-turbo-16k",
+                                                messages=[{"role": "system", "content": prompt["system_msg"]},
+                                                          {"role": "user", "content": prompt["user_msg"]}])
+        call.status_code = 200
+
+    finish_reason = response["choices"][0]["finish_reason"]
+    if finish_reason != "stop":
+        raise ReportGenerationError(f"The recommendations are incomplete, finish reason: {finish_reason}")
+    return response["choices"][0]["message"]["content"]
+
+
+def appendix_chunks(scan_task_ids):
+    """
+    CVEs found by the scan tasks in chunks of APPENDIX_CHUNK_SIZE rows, read with a database cursor
+    """
+    rows = CveEnrichment.objects.filter(task_id__in=scan_task_ids).order_by("cve_id", "task_id").values(
+        "cve_id", "cvss_base_score", "cvss_severity", "epss", "cisa_kev"
+    ).iterator(chunk_size=APPENDIX_CHUNK_SIZE)
+    while True:
+        chunk = list(itertools.islice(rows, APPENDIX_CHUNK_SIZE))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _render_part(html, path):
+    with open(path, "wb") as f:
+        pisa_status = pisa.CreatePDF(html, dest=f)
+    if pisa_status.err:
+        raise ReportGenerationError(f"Failed to render the PDF ({pisa_status.err} errors)")
+
+
+def _renumber(obj, reference):
+    # replaces the references of the part by the ones of the merged PDF, in place
+    if isinstance(obj, IndirectObject):
+        return reference(obj)
+    if isinstance(obj, DictionaryObject):
+        for key, value in list(dict.items(obj)):
+            dict.__setitem__(obj, key, _renumber(value, reference))
+    elif isinstance(obj, ArrayObject):
+        for index, value in enumerate(list.__iter__(obj)):
+            list.__setitem__(obj, index, _renumber(value, reference))
+    return obj
+
+
+def _write_part(f, part, offsets, kids):
+    # objects of the part by their number in the merged PDF, which is their index in offsets + 1
+    reader = PdfReader(part)
+    numbers = {}
+    pending = []
+
+    def reference(indirect):
+        if indirect.pdf is None:
+            # renumbered before, e.g., the resources that all pages inherit from the page tree
+            return indirect
+        key = (indirect.idnum, indirect.generation)
+        if key not in numbers:
+            offsets.append(None)
+            numbers[key] = len(offsets)
+            pending.append(indirect)
+        return IndirectObject(numbers[key], 0, None)
+
+    for page in reader.pages:
+        # the page tree of the part is not copied, the attributes inherited from it are set on the page
+        page.indirect_reference.get_object()[NameObject("/Parent")] = IndirectObject(1, 0, None)
+        kids.append(reference(page.indirect_reference).idnum)
+
+    while pending:
+        indirect = pending.pop()
+        obj = indirect.get_object()
+        number = numbers[(indirect.idnum, indirect.generation)]
+        offsets[number - 1] = f.tell()
+        f.write(f"{number} 0 obj\n".encode())
+        _renumber(obj if obj is not None else NullObject(), reference).write_to_stream(f)
+        f.write(b"\nendobj\n")
+
+
+def merge_pdfs(parts, path):
+    """
+    Writes the pages of the PDFs into a new one. Every part is written and released before the next
+    one is read, only the offsets of the written objects and the page numbers are kept until the
+    cross-reference table is written at the end. Other than PdfWriter.append, which keeps all pages
+    until the merged PDF is written, the memory used therefore does not grow with the number of parts.
+    """
+    # 1: the page tree, 2: the catalog, both written once all pages are known
+    offsets = [None, None]
+    kids = []
+    with open(path, "wb") as f:
+        f.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        for part in parts:
+            _write_part(f, part, offsets, kids)
+            # the objects of the part reference each other, i.e., they are only freed by the garbage collector
+            gc.collect()
+
+        offsets[0] = f.tell()
+        f.write(f"1 0 obj\n<< /Type /Pages /Count {len(kids)} /Kids [".encode())
+        f.write(" ".join(f"{kid} 0 R" for kid in kids).encode())
+        f.write(b"] >>\nendobj\n")
+        offsets[1] = f.tell()
+        f.write(b"2 0 obj\n<< /Type /Catalog /Pages 1 0 R >>\nendobj\n")
+
+        xref = f.tell()
+        f.write(f"xref\n0 {len(offsets) + 1}\n0000000000 65535 f \n".encode())
+        for offset in offsets:
+            f.write(f"{offset:010} 00000 n \n".encode())
+        f.write(f"trailer\n<< /Size {len(offsets) + 1} /Root 2 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+
+
+def render_pdf(html, path, appendix=()):
+    """
+    Renders the report and every chunk of the appendix into separate PDFs and merges them into path
+    """
+    with REPORT_GENERATION_DURATION.labels("pdf").time(), instrumentation.stage("pdf"), \
+            tempfile.TemporaryDirectory(dir=os.path.dirname(path)) as parts_dir:
+        parts = [os.path.join(parts_dir, "report.pdf")]
+        _render_part(html, parts[0])
+
+        appendix_template = get_template('pdf_report_appendix_template.html')
+        for index, rows in enumerate(appendix):
+            parts.append(os.path.join(parts_dir, f"appendix_{index}.pdf"))
+            _render_part(appendix_template.render({'rows': rows, 'first': index == 0}), parts[-1])
+
+        if len(parts) == 1:
+            os.replace(parts[0], path)
+            return
+
+        # merged into the temporary directory first, so that a partially written report is never downloaded
+        merged = os.path.join(parts_dir, "merged.pdf")
+        merge_pdfs(parts, merged)
+        os.replace(merged, path)
+
+
+def requirement_fragment(certificate, requirement, force_refresh=False):
+    """
+    HTML recommendations for a single requirement, requested from the LLM unless stored before
+    """
+    path = fragment_path(requirement.id)
+    hit = not force_refresh and os.path.exists(path)
+    record_cache_lookup("report_fragment", hit)
+    if hit:
+        with open(path, "r") as f:
+            return f.read()
+
+    prompt = prepare_gpt_messages(certificate, requirement)
+    for attempt in range(1, FRAGMENT_ATTEMPTS + 1):
+        try:
+            fragment = request_recommendations(prompt)
+            break
+        except ReportGenerationError as e:
+            print(f"Attempt {attempt} for requirement {requirement.id} failed: {e}")
+            if attempt == FRAGMENT_ATTEMPTS:
+                raise
+
+    _write_atomically(path, fragment)
+    return fragment
+
+
+def generate_fragments(certificate, requirements, force_refresh=False):
+    """
+    Fragments of the requirements in the given order. If a requirement fails, the fragments of the
+    others are stored nonetheless, i.e., only the failed one is requested again by the next attempt.
+    """
+    os.makedirs(_fragments_dir(), exist_ok=True)
+    max_workers = getattr(settings, "REPORT_LLM_CONCURRENCY", 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # copy the context, so that the requests are counted and traced as part of the task
+        futures = [
+            executor.submit(contextvars.copy_context().run, requirement_fragment, certificate, requirement, force_refresh)
+            for requirement in requirements
+        ]
+    return [future.result() for future in futures]
+
+
+def generate_report(assessment_id, force_refresh=False, scan_task_ids=None):
+    """
+    Generates the report of the assessment, unless it has been stored before, and returns its id.
+    With force_refresh, the LLM is asked again for every requirement and the stored report is replaced.
+    The CVEs found by the given scan tasks are listed in the appendix.
+    """
+    assessment, unfulfilled_requirements = _load_assessment(assessment_id)
+    print(f"Number of unfulfilled requirements: {len(unfulfilled_requirements)}")
+
+    generated_id = report_id(assessment, unfulfilled_requirements, scan_task_ids)
+    pdf_path = report_path(generated_id)
+    html_path = report_path(generated_id, "html")
+    os.makedirs(settings.REPORTS_DIR, exist_ok=True)
+
+    if not force_refresh and os.path.exists(pdf_path):
+        return generated_id
+
+    if not force_refresh and os.path.exists(html_path):
+        # e.g., the rendering of the PDF failed before
+        with open(html_path, "r") as f:
+            html = f.read()
+    else:
+        with instrumentation.stage("fragments"):
+            fragments = generate_fragments(assessment.certificate, unfulfilled_requirements, force_refresh)
+
+        html = get_template('pdf_report_template.html').render({
+            'company': assessment.company,
+            'certificate': assessment.certificate,
+            'date': timezone.now(),
+            'fragments': fragments,
+            'scan_summary': summarize_scan_runs(scan_task_ids) if scan_task_ids else None,
+        })
+        _write_atomically(html_path, html)
+
+    render_pdf(html, pdf_path, appendix_chunks(scan_task_ids) if scan_task_ids else ())
+    return generated_id
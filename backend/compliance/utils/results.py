@@ -0,0 +1,120 @@
+"""
+Expiry and offloading of the task results, so that the memory of the result backend (Redis) stays
+bounded under sustained load.
+
+ResultPolicyTask is the base class of all tasks (see backend/celery.py):
+- Results expire after settings.CELERY_RESULT_EXPIRES seconds or after the time configured for the
+  task in settings.RESULT_EXPIRES_PER_TASK
+- Results larger than settings.RESULT_OFFLOAD_THRESHOLD bytes (as JSON) are written to a file in
+  settings.RESULTS_DIR, and the result backend only stores a reference to the file.
+  get_background_process_status loads the file only when the result of a finished task is requested
+
+The files are deleted by delete_expired_results_task once the result of their task has expired.
+The fingerprints of deduplicated scans (see deduplication.py) are updated once the task has finished,
+and the slot of a finished chunk of a bulk scan is given to the next one (see scheduling.py). While the
+task runs, its deadline and cancel flag are available to the scans (see cancellation.py).
+"""
+import json
+import os
+import tempfile
+import time
+
+from celery import Task, states
+from celery.backends.base import KeyValueStoreBackend
+from django.conf import settings
+
+from compliance.utils import cancellation
+from compliance.utils.deduplication import scan_finished
+from compliance.utils.scheduling import chunk_finished
+
+# key of the reference returned instead of an offloaded result
+RESULT_FILE_REFERENCE = "result_file"
+
+
+def result_expires(task_name):
+    return settings.RESULT_EXPIRES_PER_TASK.get(task_name, settings.CELERY_RESULT_EXPIRES)
+
+
+def _result_path(reference):
+    task_name, task_id = reference.split("/")
+    # the reference is read from the result backend, it must not point outside of RESULTS_DIR
+    if not task_name or not task_id or os.path.basename(task_name) != task_name or os.path.basename(task_id) != task_id:
+        raise ValueError(f"Invalid result reference: {reference}")
+    return os.path.join(settings.RESULTS_DIR, task_name, f"{task_id}.json")
+
+
+def offload_result(task_name, task_id, result):
+    """
+    Returns the result itself or, if it is larger than the threshold, writes it into a file and
+    returns a reference to it
+    """
+    content = json.dumps(result)
+    if task_id is None or len(content) <= settings.RESULT_OFFLOAD_THRESHOLD:
+        return result
+
+    reference = f"{task_name}/{task_id}"
+    path = _result_path(reference)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # written into a temporary file first, so that a partially written result is never read
+    with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path), suffix=".tmp", delete=False) as f:
+        f.write(content)
+    os.replace(f.name, path)
+    return {RESULT_FILE_REFERENCE: reference}
+
+
+def load_result(result):
+    """
+    The result of a task, loaded from its file if it has been offloaded.
+    Raises FileNotFoundError if the file has already been deleted.
+    """
+    if not isinstance(result, dict) or set(result) != {RESULT_FILE_REFERENCE}:
+        return result
+    with open(_result_path(result[RESULT_FILE_REFERENCE]), "r") as f:
+        return json.load(f)
+
+
+def delete_expired_result_files():
+    """
+    Deletes the offloaded results whose task result has expired, returns the number of deleted files
+    """
+    if not os.path.isdir(settings.RESULTS_DIR):
+        return 0
+
+    deleted = 0
+    now = time.time()
+    for task_name in os.listdir(settings.RESULTS_DIR):
+        task_dir = os.path.join(settings.RESULTS_DIR, task_name)
+        if not os.path.isdir(task_dir):
+            continue
+        expires = result_expires(task_name)
+        for filename in os.listdir(task_dir):
+            path = os.path.join(task_dir, filename)
+            if now - os.path.getmtime(path) > expires:
+                os.remove(path)
+                deleted += 1
+    return deleted
+
+
+class ResultPolicyTask(Task):
+    def __call__(self, *args, **kwargs):
+        # not Task.__call__, which would push a request without the task id and headers on top of the
+        # one pushed by the worker, i.e., self.request.id would be None in the bound tasks
+        with cancellation.task_scope(self.request, self.name) as scope:
+            result = self.run(*args, **kwargs)
+        # the partial result of a stopped scan is never reused for identical requests
+        self.request.stopped = scope.reason
+        if self.ignore_result:
+            return result
+        return offload_result(self.name, self.request.id, result)
+
+    def after_return(self, status, retval, task_id, args, kwargs, einfo):
+        # identical scan requests get this task's result for a while, unless it failed
+        scan_finished(self.request, status == states.SUCCESS and not getattr(self.request, "stopped", None))
+        chunk_finished(self.request, status == states.SUCCESS)
+
+        # called after the result has been stored, the result backend applies CELERY_RESULT_EXPIRES itself
+        expires = result_expires(self.name)
+        if self.request.is_eager or self.ignore_result or expires == settings.CELERY_RESULT_EXPIRES:
+            return
+        if isinstance(self.backend, KeyValueStoreBackend):
+            self.backend.expire(self.backend.get_key_for_task(task_id), expires)
@@ -0,0 +1,357 @@
+"""
+Storage of the scan results in the database instead of the Celery result backend.
+
+When a scan task completes, store_scan_result writes its result normalized (ScanRun, HostResult,
+PortResult, Finding) with one bulk insert per table, and the task returns only a reference to the
+ScanRun. get_background_process_status rebuilds the original result from these rows with
+scan_result, i.e., the clients get the same response as before, while Redis only holds the reference.
+
+The appendix tables of the reports (summarize_scan_runs) are aggregated from the same rows in a single
+pass. The scan runs, hosts, ports, findings and CVE enrichments are read with one query each,
+independent of the number of scans and findings.
+"""
+from collections import Counter, defaultdict
+
+from django.db import transaction
+from django.db.models import Prefetch
+
+from compliance.models import AutomatedRequirementType, CveEnrichment, Finding, HostResult, PortResult, ScanRun
+from cve_prioritizer.cve_prioritizer.scripts.constants import PRIORITIES
+
+NOT_PRIORITIZED = "Not prioritized"
+# key of the reference returned by the scan tasks instead of their result
+SCAN_RUN_REFERENCE = "scan_run_id"
+
+
+def _task(task_name):
+    # task names are registered with their module, e.g., compliance.tasks.ping_ips_task
+    return task_name.rsplit(".", 1)[-1]
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _extras(values, *keys):
+    return {key: value for key, value in values.items() if key not in keys}
+
+
+# Every function converts a task result into a list of (host, findings, ports) with ports as (port, findings)
+
+def _ping_hosts(result):
+    return [
+        (HostResult(host=ip, status=ping.get("connection_established"), description=ping.get("description")), [], [])
+        for ip, ping in result.items()
+    ]
+
+
+def _https_hosts(result):
+    return [
+        (HostResult(host=website, status=check.get("protocol"), description=check.get("description"),
+                    error=check.get("error"), details=_extras(check, "protocol", "description", "error")), [], [])
+        for website, check in result.items()
+    ]
+
+
+def _port_scan_hosts(result):
+    return [
+        (HostResult(host=ip), [], [
+            (PortResult(port=port.get("portid"), protocol=port.get("protocol"), state=port.get("state"),
+                        service_name=port.get("service", {}).get("name"),
+                        service_product=port.get("service", {}).get("product"),
+                        service_version=port.get("service", {}).get("version"),
+                        details=_extras(port, "portid", "protocol", "state")), [])
+            for port in ports
+        ])
+        for ip, ports in result.items()
+    ]
+
+
+def _ip_vulnerability_hosts(result):
+    return [
+        (HostResult(host=ip), [], [
+            (PortResult(port=port_id, protocol=port.get("protocol"),
+                        service_name=port.get("service", {}).get("name"),
+                        service_product=port.get("service", {}).get("product"),
+                        service_version=port.get("service", {}).get("version")), [
+                Finding(cve_id=cve, cvss=_float(vulnerability.get("cvss")), is_exploit=vulnerability.get("is_exploit"),
+                        priority=vulnerability.get("priority_details", {}).get("priority"))
+                for cve, vulnerability in port.get("vulnerabilities", {}).items()
+            ])
+            for port_id, port in ports.items()
+        ])
+        for ip, ports in result.items()
+    ]
+
+
+def _technology_hosts(result):
+    return [
+        (HostResult(host=" ".join(str(technology.get(key)) for key in ("vendor", "product", "version"))[:255],
+                    error=technology.get("error"), details=_extras(technology, "vulnerabilities", "error")), [
+            Finding(cve_id=cve, priority=details.get("priority"))
+            for cve, details in technology.get("vulnerabilities", {}).items()
+        ], [])
+        for technology in result
+    ]
+
+
+# task name (without the module) -> automated requirement, conversion into rows
+SCAN_TASKS = {
+    "ping_ips_task": (AutomatedRequirementType.UNAUTHORIZED_ACCESS_CHECKER, _ping_hosts),
+    "check_https_connection_task": (AutomatedRequirementType.HTTPS_PROTOCOL_CHECKER, _https_hosts),
+    "nmap_top_ports_scan_task": (AutomatedRequirementType.UNAUTHORIZED_ACCESS_CHECKER, _port_scan_hosts),
+    "nmap_vulners_scan_task": (AutomatedRequirementType.VULNERABILITY_CHECKER, _ip_vulnerability_hosts),
+    "technologies_vulnerability_scan_task": (AutomatedRequirementType.VULNERABILITY_CHECKER, _technology_hosts),
+}
+
+
+def store_scan_result(task_id, task_name, result, stopped=None):
+    """
+    Stores the result of a scan task with one bulk insert per table and returns the reference that
+    the task returns instead of the result. stopped is the reason if the result is partial.
+    """
+    automated_requirement_type, to_hosts = SCAN_TASKS[_task(task_name)]
+    hosts = to_hosts(result)
+
+    with transaction.atomic():
+        # a retried task replaces the results of its previous attempt
+        ScanRun.objects.filter(task_id=task_id).delete()
+        scan_run = ScanRun.objects.create(
+            task_id=task_id, task_name=task_name, automated_requirement_type=automated_requirement_type,
+            stopped=stopped
+        )
+
+        for host, _, _ in hosts:
+            host.scan_run = scan_run
+        HostResult.objects.bulk_create([host for host, _, _ in hosts])
+
+        ports = [(host, port, findings) for host, _, host_ports in hosts for port, findings in host_ports]
+        for host, port, _ in ports:
+            port.host = host
+        PortResult.objects.bulk_create([port for _, port, _ in ports], batch_size=1000)
+
+        findings = []
+        for host, port, port_findings in [(host, None, host_findings) for host, host_findings, _ in hosts] + ports:
+            for finding in port_findings:
+                finding.scan_run, finding.host, finding.port = scan_run, host, port
+                findings.append(finding)
+        Finding.objects.bulk_create(findings, batch_size=1000)
+
+        # stored during the prioritization, i.e., before the scan run existed
+        CveEnrichment.objects.filter(task_id=task_id).update(scan_run=scan_run)
+
+    return {SCAN_RUN_REFERENCE: scan_run.id}
+
+
+def scan_runs_with_results(scan_runs):
+    """
+    Prefetches everything read by scan_result and summarize_scan_runs, i.e., five queries in total
+    """
+    return scan_runs.prefetch_related(
+        Prefetch("hosts", HostResult.objects.order_by("id").prefetch_related(
+            Prefetch("ports", PortResult.objects.order_by("id")),
+            Prefetch("findings", Finding.objects.order_by("id")),
+        )),
+        "cve_enrichments",
+    )
+
+
+def _priority_details(finding, enrichment):
+    # same format as returned by cve_prioritizer's apply_thresholds
+    return {
+        "priority": finding.priority,
+        "epss": enrichment.epss if enrichment else None,
+        "cvss_baseScore": enrichment.cvss_base_score if enrichment else None,
+        "cvss_version": enrichment.cvss_version if enrichment else None,
+        "cvss_severity": enrichment.cvss_severity if enrichment else None,
+        "cisa_kev": "TRUE" if enrichment and enrichment.cisa_kev else "FALSE",
+    }
+
+
+def _port_findings(host):
+    findings = defaultdict(list)
+    for finding in host.findings.all():
+        findings[finding.port_id].append(finding)
+    return findings
+
+
+def scan_result(scan_run):
+    """
+    Rebuilds the result that the task of the scan run returned before it was stored in the database
+    """
+    task = _task(scan_run.task_name)
+    hosts = scan_run.hosts.all()
+
+    if task == "ping_ips_task":
+        return {host.host: {"connection_established": host.status, "description": host.description} for host in hosts}
+
+    if task == "check_https_connection_task":
+        return {
+            host.host: {
+                "protocol": host.status,
+                **({"description": host.description} if host.description is not None else {}),
+                **({"error": host.error} if host.error is not None else {}),
+                **host.details,
+            }
+            for host in hosts
+        }
+
+    if task == "nmap_top_ports_scan_task":
+        return {
+            host.host: [
+                {"portid": port.port, "protocol": port.protocol, "state": port.state, **port.details}
+                for port in host.ports.all()
+            ]
+            for host in hosts
+        }
+
+    enrichments = {enrichment.cve_id: enrichment for enrichment in scan_run.cve_enrichments.all()}
+
+    if task == "nmap_vulners_scan_task":
+        result = {}
+        for host in hosts:
+            findings = _port_findings(host)
+            result[host.host] = {}
+            for port in host.ports.all():
+                vulnerabilities = {}
+                for finding in findings[port.id]:
+                    vulnerabilities[finding.cve_id] = {"type": "cve", "cvss": finding.cvss, "is_exploit": finding.is_exploit}
+                    if finding.priority is not None:
+                        vulnerabilities[finding.cve_id]["priority_details"] = _priority_details(
+                            finding, enrichments.get(finding.cve_id)
+                        )
+                result[host.host][port.port] = {
+                    "protocol": port.protocol,
+                    "service": {"name": port.service_name, "product": port.service_product,
+                                "version": port.service_version},
+                    "vulnerabilities": vulnerabilities,
+                }
+        return result
+
+    return [
+        {
+            **host.details,
+            "vulnerabilities": {
+                finding.cve_id: _priority_details(finding, enrichments.get(finding.cve_id))
+                for finding in host.findings.all()
+            },
+            **({"error": host.error} if host.error is not None else {}),
+        }
+        for host in hosts
+    ]
+
+
+def _highest_priority(priorities):
+    ranked = [priority for priority in PRIORITIES if priority in priorities]
+    if ranked:
+        return ranked[0]
+    return NOT_PRIORITIZED if priorities else None
+
+
+def _service(port):
+    # e.g., "nginx 1.18.0" if nmap detected the version, otherwise the name of the service
+    return " ".join(
+        value for value in (port.service_product, port.service_version) if value and value != "Unknown"
+    ) or port.service_name or "Unknown"
+
+
+class _ScanSummary:
+    def __init__(self):
+        self.findings = Counter()
+        self.cves = defaultdict(set)
+        # host -> {"ports": set, "findings": int, "priorities": set}
+        self.hosts = defaultdict(lambda: {"ports": set(), "findings": 0, "priorities": set()})
+        # (host, port) -> {"protocol", "service", "findings", "priorities"}
+        self.ports = {}
+        self.websites = []
+        self.technologies = []
+
+    def _finding(self, finding, *aggregates):
+        priority = finding.priority or NOT_PRIORITIZED
+        self.findings[priority] += 1
+        self.cves[priority].add(finding.cve_id)
+        for aggregate in aggregates:
+            aggregate["findings"] += 1
+            aggregate["priorities"].add(priority)
+
+    def add_https_check(self, host):
+        self.websites.append({"website": host.host, "protocol": host.status, "result": host.description or host.error})
+
+    def add_network_scan(self, host):
+        # hosts without open ports are listed as well
+        host_summary = self.hosts[host.host]
+        findings = _port_findings(host)
+        for port in host.ports.all():
+            host_summary["ports"].add(port.port)
+            port_summary = self.ports.setdefault((host.host, port.port), {
+                "protocol": port.protocol, "service": "Unknown", "findings": 0, "priorities": set()
+            })
+            if _service(port) != "Unknown":
+                port_summary["service"] = _service(port)
+            for finding in findings[port.id]:
+                self._finding(finding, host_summary, port_summary)
+
+    def add_technology(self, host):
+        aggregate = {"findings": 0, "priorities": set()}
+        for finding in host.findings.all():
+            self._finding(finding, aggregate)
+        self.technologies.append({
+            "technology": host.host,
+            "findings": aggregate["findings"],
+            "highest_priority": _highest_priority(aggregate["priorities"]),
+            "error": host.error,
+        })
+
+    def tables(self):
+        priorities = [
+            {"priority": priority, "findings": self.findings[priority], "cves": len(self.cves[priority])}
+            for priority in PRIORITIES + [NOT_PRIORITIZED] if self.findings[priority]
+        ]
+        hosts = [
+            {"host": host, "ports": len(host_summary["ports"]), "findings": host_summary["findings"],
+             "highest_priority": _highest_priority(host_summary["priorities"])}
+            for host, host_summary in sorted(self.hosts.items())
+        ]
+        ports = [
+            {"host": host, "port": port_id, "protocol": port["protocol"], "service": port["service"],
+             "findings": port["findings"], "highest_priority": _highest_priority(port["priorities"])}
+            for (host, port_id), port in sorted(
+                self.ports.items(), key=lambda item: (item[0][0], int(item[0][1]) if item[0][1].isdigit() else 0)
+            )
+        ]
+        return {
+            "priorities": priorities,
+            "hosts": hosts,
+            "ports": ports,
+            "websites": sorted(self.websites, key=lambda website: website["website"]),
+            "technologies": self.technologies,
+        }
+
+
+# task name (without the module) -> method of _ScanSummary that adds a host of its result
+SUMMARIZED_SCAN_TASKS = {
+    "check_https_connection_task": _ScanSummary.add_https_check,
+    "nmap_top_ports_scan_task": _ScanSummary.add_network_scan,
+    "nmap_vulners_scan_task": _ScanSummary.add_network_scan,
+    "technologies_vulnerability_scan_task": _ScanSummary.add_technology,
+}
+
+
+def summarize_scan_runs(scan_task_ids):
+    """
+    Appendix tables of the stored results of the scan tasks, i.e., the findings per priority, host and
+    port, the HTTPS checks and the scanned technologies. Returns None, if none of the tasks has been stored.
+    """
+    summary = _ScanSummary()
+    found = False
+    for scan_run in scan_runs_with_results(ScanRun.objects.filter(task_id__in=scan_task_ids).order_by("created_at")):
+        add_host = SUMMARIZED_SCAN_TASKS.get(_task(scan_run.task_name))
+        if add_host is None:
+            continue
+        found = True
+        for host in scan_run.hosts.all():
+            add_host(summary, host)
+    return summary.tables() if found else None
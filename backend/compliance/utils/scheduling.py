@@ -0,0 +1,209 @@
+"""
+Priorities and fair-share scheduling of the scans across companies.
+
+The scan endpoints queue their task without a priority, i.e., with the highest one. Bulk scans, e.g.,
+rescans of all hosts of a company, are split into chunks of settings.SCAN_CHUNK_SIZE targets
+(ScanBatch and ScanChunk), which are queued with BULK_PRIORITY. The workers therefore take the scans
+of interactive assessments first whenever both are waiting in a queue.
+
+The chunks are not queued all at once: at most settings.SCAN_CHUNK_CONCURRENCY[queue] chunks of a
+queue are queued or running at a time. Whenever a chunk has finished, the free slot goes to the
+company with the fewest queued chunks, on ties to the one that has waited longest, i.e., the chunks
+of the companies are interleaved round-robin and a company scanning 10,000 hosts only delays the
+others by a chunk. Since the concurrency is lower than the one of the workers (WORKER_PROFILES in
+backend/celery.py), some workers are always left for the interactive scans.
+
+Every chunk is a task with its own ScanRun, i.e., it can be polled, linked to an assessment and
+included in a report like the task of any other scan. dispatch_scan_chunks_task queues the chunks
+periodically as well, e.g., after a worker has crashed during a chunk. Cancelled chunks give their slot
+to the next one right away, pending ones are never queued.
+
+Chunks are dispatched by the API, by every finished chunk and periodically, i.e., concurrently. The
+dispatchers of a queue are therefore serialized by a lock in the cache (settings.CACHES, i.e., shared
+by the API and the workers), so that the free slots counted by one of them are not taken by another
+in the meantime. The chunks are sent once the lock has been released.
+"""
+import contextlib
+import time
+import uuid
+from datetime import timedelta
+
+from celery import current_app
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Max, Min
+from django.utils import timezone
+
+from backend.celery import TASK_ROUTES
+from compliance.models import ScanBatch, ScanChunk
+from compliance.utils.cancellation import cancel, request_header
+
+# lower numbers are consumed first by the Redis broker, tasks without a priority count as 0
+BULK_PRIORITY = 9
+# custom header of the task message with the id of its ScanChunk
+CHUNK_HEADER = "scan_chunk"
+# seconds after which the dispatch lock of a queue is released, e.g., if its dispatcher has crashed
+DISPATCH_LOCK_TIMEOUT = 30
+# seconds between two attempts to acquire the dispatch lock
+DISPATCH_LOCK_POLL_INTERVAL = 0.05
+
+
+def chunked(targets, size):
+    return [targets[i:i + size] for i in range(0, len(targets), size)]
+
+
+def _queue_task_names(queue):
+    return [task_name for task_name, route in TASK_ROUTES.items() if route["queue"] == queue]
+
+
+def submit_bulk_scan(task, company, targets, **parameters):
+    """
+    Stores the chunks of the bulk scan and queues as many of them as there are free slots
+    """
+    with transaction.atomic():
+        batch = ScanBatch.objects.create(company=company, task_name=task.name, parameters=parameters)
+        ScanChunk.objects.bulk_create([
+            ScanChunk(batch=batch, task_id=str(uuid.uuid4()), targets=chunk)
+            for chunk in chunked(targets, settings.SCAN_CHUNK_SIZE)
+        ])
+    dispatch_chunks()
+    return batch
+
+
+def _send_chunk(chunk):
+    current_app.tasks[chunk.batch.task_name].apply_async(
+        args=[chunk.targets], kwargs=chunk.batch.parameters, task_id=chunk.task_id, priority=BULK_PRIORITY,
+        headers={CHUNK_HEADER: chunk.id}
+    )
+
+
+@contextlib.contextmanager
+def _dispatch_lock(queue):
+    key = f"scan_chunks_dispatch:{queue}"
+    token = uuid.uuid4().hex
+    # cache.add is atomic, i.e., only one dispatcher acquires the lock
+    while not cache.add(key, token, timeout=DISPATCH_LOCK_TIMEOUT):
+        time.sleep(DISPATCH_LOCK_POLL_INTERVAL)
+    try:
+        yield
+    finally:
+        # unless it has expired and been acquired by another dispatcher
+        if cache.get(key) == token:
+            cache.delete(key)
+
+
+def _dispatch_queue(queue, concurrency):
+    with _dispatch_lock(queue):
+        chunks = _claim_chunks(queue, concurrency)
+    # e.g., eagerly run chunks dispatch the next ones themselves
+    for chunk in chunks:
+        _send_chunk(chunk)
+    return len(chunks)
+
+
+def _claim_chunks(queue, concurrency):
+    """
+    Marks the chunks that get the free slots of the queue as queued and returns them
+    """
+    chunks = ScanChunk.objects.filter(batch__task_name__in=_queue_task_names(queue))
+    free_slots = concurrency - chunks.filter(status=ScanChunk.Status.QUEUED).count()
+    if free_slots <= 0:
+        return []
+
+    # per company: the number of queued chunks, when it has been given a slot the last time and its oldest batch
+    queued = dict(
+        chunks.filter(status=ScanChunk.Status.QUEUED).values_list("batch__company").annotate(Count("id"))
+    )
+    last_queued = dict(chunks.values_list("batch__company").annotate(Max("queued_at")))
+    oldest_batch = dict(
+        chunks.filter(status=ScanChunk.Status.PENDING).values_list("batch__company").annotate(Min("batch"))
+    )
+
+    claimed = []
+    while free_slots > 0 and oldest_batch:
+        company_id = min(oldest_batch, key=lambda company: (
+            queued.get(company, 0), last_queued.get(company) is not None, last_queued.get(company), oldest_batch[company]
+        ))
+        chunk = chunks.filter(status=ScanChunk.Status.PENDING, batch__company=company_id) \
+            .select_related("batch").order_by("batch", "id").first()
+        if chunk is None:
+            del oldest_batch[company_id]
+            continue
+
+        now = timezone.now()
+        # e.g., cancelled in the meantime
+        if not ScanChunk.objects.filter(id=chunk.id, status=ScanChunk.Status.PENDING) \
+                .update(status=ScanChunk.Status.QUEUED, queued_at=now):
+            continue
+        queued[company_id] = queued.get(company_id, 0) + 1
+        last_queued[company_id] = now
+        free_slots -= 1
+        claimed.append(chunk)
+    return claimed
+
+
+def dispatch_chunks():
+    """
+    Queues pending chunks while their queue has free slots, returns the number of queued chunks
+    """
+    # the slot of a chunk whose worker crashed would never be freed otherwise
+    ScanChunk.objects.filter(
+        status=ScanChunk.Status.QUEUED, queued_at__lt=timezone.now() - timedelta(seconds=settings.SCAN_CHUNK_TIMEOUT)
+    ).update(status=ScanChunk.Status.FAILED, finished_at=timezone.now())
+
+    return sum(
+        _dispatch_queue(queue, concurrency) for queue, concurrency in settings.SCAN_CHUNK_CONCURRENCY.items()
+    )
+
+
+def chunk_finished(request, successful):
+    """
+    Called by the task once it has finished, gives the slot of a chunk to the next one
+    """
+    chunk_id = request_header(request, CHUNK_HEADER)
+    if chunk_id is None:
+        return
+    ScanChunk.objects.filter(id=chunk_id, status=ScanChunk.Status.QUEUED).update(
+        status=ScanChunk.Status.DONE if successful else ScanChunk.Status.FAILED, finished_at=timezone.now()
+    )
+    dispatch_chunks()
+
+
+def cancel_scan(task_id):
+    """
+    Cancels the task of a scan, which may be a chunk of a bulk scan
+    """
+    cancel(task_id)
+    if ScanChunk.objects.filter(
+        task_id=task_id, status__in=[ScanChunk.Status.PENDING, ScanChunk.Status.QUEUED]
+    ).update(status=ScanChunk.Status.CANCELLED, finished_at=timezone.now()):
+        dispatch_chunks()
+
+
+def cancel_batch(batch):
+    """
+    Cancels the chunks of the bulk scan that have not finished yet
+    """
+    queued_task_ids = list(batch.chunks.filter(status=ScanChunk.Status.QUEUED).values_list("task_id", flat=True))
+    for task_id in queued_task_ids:
+        cancel(task_id)
+    batch.chunks.filter(status=ScanChunk.Status.PENDING).update(
+        status=ScanChunk.Status.CANCELLED, finished_at=timezone.now()
+    )
+    batch.chunks.filter(task_id__in=queued_task_ids, status=ScanChunk.Status.QUEUED).update(
+        status=ScanChunk.Status.CANCELLED, finished_at=timezone.now()
+    )
+    dispatch_chunks()
+
+
+def batch_status(batch):
+    chunks = list(batch.chunks.order_by("id").values_list("task_id", "status"))
+    return {
+        "batch_id": batch.id,
+        "company_id": batch.company_id,
+        "task_name": batch.task_name,
+        "chunks": {status: sum(1 for _, chunk_status in chunks if chunk_status == status)
+                   for status in ScanChunk.Status.values},
+        "task_ids": [task_id for task_id, _ in chunks],
+    }
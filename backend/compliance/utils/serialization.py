@@ -0,0 +1,68 @@
+"""
+Compact Celery serializer for task arguments and results (settings.CELERY_TASK_SERIALIZER and
+CELERY_RESULT_SERIALIZER "compact").
+
+The payload is packed with msgpack and compressed with zlib. Before that, every dict whose values
+are records with the same keys, e.g., the CVEs of a port or of a technology, is turned into a table
+of columns and rows, so that keys like "cvss_baseScore" or "priority" are stored once per table
+instead of once per CVE. Decoding restores the original dicts, i.e., the tasks and
+get_background_process_status see the same values as with JSON.
+
+The serializer is registered with kombu by backend/celery.py, i.e., in the workers and in Django.
+"""
+import zlib
+
+import msgpack
+from kombu.serialization import register
+
+SERIALIZER_NAME = "compact"
+CONTENT_TYPE = "application/x-certsec-compact"
+# only key of an encoded table: [columns, keys, rows]
+TABLE_KEY = "__table__"
+# smaller dicts are not worth the overhead of a table
+MIN_TABLE_ROWS = 2
+
+
+def _table(value):
+    columns = None
+    for record in value.values():
+        if not isinstance(record, dict):
+            return None
+        if columns is None:
+            columns = list(record)
+        elif len(record) != len(columns) or any(a != b for a, b in zip(record, columns)):
+            return None
+    return columns
+
+
+def _encode(value):
+    if isinstance(value, dict):
+        columns = _table(value) if len(value) >= MIN_TABLE_ROWS else None
+        if columns is not None:
+            rows = [[_encode(record[column]) for column in columns] for record in value.values()]
+            return {TABLE_KEY: [columns, list(value), rows]}
+        return {key: _encode(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(item) for item in value]
+    return value
+
+
+def _decode_table(value):
+    # called by msgpack for every map, innermost first
+    if len(value) == 1 and TABLE_KEY in value:
+        columns, keys, rows = value[TABLE_KEY]
+        return {key: dict(zip(columns, row)) for key, row in zip(keys, rows)}
+    return value
+
+
+def dumps(value):
+    return zlib.compress(msgpack.packb(_encode(value), use_bin_type=True))
+
+
+def loads(data):
+    # keys of the scan results can be numbers, e.g., port ids returned by nmap
+    return msgpack.unpackb(zlib.decompress(data), raw=False, object_hook=_decode_table, strict_map_key=False)
+
+
+def register_compact_serializer():
+    register(SERIALIZER_NAME, dumps, loads, content_type=CONTENT_TYPE, content_encoding="binary")
@@ -0,0 +1,236 @@
+"""
+OpenTelemetry-style tracing of a request across the API, the Celery tasks and the calls to
+external APIs.
+
+Every API request is a span (TracingMiddleware), and so is every Celery task, every stage() and
+every api_call() of instrumentation.py. The current span is kept in a context variable, so spans
+started within another span become its children. When a task is published, the current span is
+added to the message headers in the W3C traceparent format (00-<trace id>-<span id>-01), which
+makes the task span a child of the span of the API request that started it.
+
+Finished spans are passed to an exporter, selected by settings.TRACING_EXPORTER:
+- "file": appended as JSON lines to settings.TRACING_EXPORT_FILE, see summarize_traces.py
+- "memory": kept in memory (the last settings.TRACING_MEMORY_SPANS spans)
+Tracing is disabled, i.e., spans are created but dropped, if no exporter is set or if the Django
+settings are not configured, e.g., in scripts.
+"""
+import collections
+import contextlib
+import contextvars
+import json
+import re
+import secrets
+import threading
+import time
+
+from celery.signals import before_task_publish, task_prerun, task_postrun
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+TRACEPARENT_PATTERN = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+
+class Span:
+    def __init__(self, name, trace_id=None, parent_id=None, kind="internal", attributes=None):
+        self.name = name
+        self.trace_id = trace_id or secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.status = "ok"
+        self.start_time = time.time()
+        self.duration = None
+        self._start = time.perf_counter()
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def record_exception(self, exception):
+        self.status = "error"
+        self.attributes["exception.type"] = type(exception).__name__
+        self.attributes["exception.message"] = str(exception)
+
+    def end(self):
+        if self.duration is None:
+            self.duration = time.perf_counter() - self._start
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "kind": self.kind,
+            "start_time": self.start_time,
+            "duration": self.duration,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class InMemorySpanExporter:
+    def __init__(self, max_spans=10000):
+        self._spans = collections.deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        with self._lock:
+            self._spans.append(span.as_dict())
+
+    def get_finished_spans(self, trace_id=None):
+        with self._lock:
+            return [span for span in self._spans if trace_id is None or span["trace_id"] == trace_id]
+
+    def clear(self):
+        with self._lock:
+            self._spans.clear()
+
+
+class FileSpanExporter:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.as_dict(), default=str)
+        with self._lock, open(self.path, "a") as f:
+            f.write(line + "\n")
+
+
+_exporter = None
+_exporter_configured = False
+
+
+def get_exporter():
+    global _exporter, _exporter_configured
+    if not _exporter_configured:
+        from django.conf import settings
+
+        if not settings.configured:
+            # e.g., in scripts without Django, which can still call set_exporter
+            return None
+        exporter = getattr(settings, "TRACING_EXPORTER", None)
+        if exporter == "file" and getattr(settings, "TRACING_EXPORT_FILE", None):
+            _exporter = FileSpanExporter(settings.TRACING_EXPORT_FILE)
+        elif exporter == "memory":
+            _exporter = InMemorySpanExporter(getattr(settings, "TRACING_MEMORY_SPANS", 10000))
+        _exporter_configured = True
+    return _exporter
+
+
+def set_exporter(exporter):
+    """
+    Replaces the exporter of the settings, e.g., with an InMemorySpanExporter in scripts
+    """
+    global _exporter, _exporter_configured
+    _exporter = exporter
+    _exporter_configured = True
+
+
+def parse_traceparent(traceparent):
+    match = TRACEPARENT_PATTERN.match(traceparent or "")
+    return match.groups() if match else (None, None)
+
+
+def current_span():
+    return _current_span.get()
+
+
+def start_span(name, kind="internal", traceparent=None, attributes=None):
+    """
+    Starts a span that is a child of the given traceparent or, if there is none, of the current span
+    """
+    trace_id, parent_id = parse_traceparent(traceparent)
+    parent = current_span()
+    if trace_id is None and parent is not None:
+        trace_id, parent_id = parent.trace_id, parent.span_id
+    return Span(name, trace_id, parent_id, kind, attributes)
+
+
+def end_span(span):
+    span.end()
+    exporter = get_exporter()
+    if exporter is not None:
+        exporter.export(span)
+
+
+@contextlib.contextmanager
+def span(name, kind="internal", traceparent=None, **attributes):
+    """
+    Traces a block of code as a child of the current span, e.g., with span("nmap_scan"): ...
+    """
+    current = start_span(name, kind, traceparent, attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.record_exception(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        end_span(current)
+
+
+class TracingMiddleware:
+    """
+    Traces every API request. Clients can continue their own trace by sending a traceparent header.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with span(
+            f"{request.method} {request.path}",
+            kind="server",
+            traceparent=request.headers.get("traceparent"),
+            **{"http.method": request.method, "http.target": request.path},
+        ) as request_span:
+            response = self.get_response(request)
+            # name the span after the route (e.g., "GET api/tasks/<str:id>/") to group requests
+            if request.resolver_match is not None:
+                request_span.name = f"{request.method} {request.resolver_match.route}"
+            request_span.set_attribute("http.status_code", response.status_code)
+            if response.status_code >= 500:
+                request_span.status = "error"
+            return response
+
+
+@before_task_publish.connect
+def _inject_traceparent(headers=None, **kwargs):
+    current = current_span()
+    if current is not None and headers is not None:
+        headers.setdefault("traceparent", current.traceparent)
+
+
+@task_prerun.connect
+def _start_task_span(task_id=None, task=None, **kwargs):
+    # custom message headers end up as attributes of the task request. Eagerly executed tasks
+    # are not published and simply continue the current span.
+    task_span = start_span(
+        f"celery.task {task.name}",
+        kind="consumer",
+        traceparent=getattr(task.request, "traceparent", None),
+        attributes={"celery.task_id": task_id, "celery.task_name": task.name},
+    )
+    task.request.tracing_span = task_span
+    task.request.tracing_token = _current_span.set(task_span)
+
+
+@task_postrun.connect
+def _end_task_span(task=None, state=None, **kwargs):
+    task_span = getattr(task.request, "tracing_span", None)
+    token = getattr(task.request, "tracing_token", None)
+    if task_span is None or token is None:
+        return
+
+    _current_span.reset(token)
+    task_span.set_attribute("celery.state", state)
+    if state == "FAILURE":
+        task_span.status = "error"
+    end_span(task_span)
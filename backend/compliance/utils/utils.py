@@ -1,17 +1,19 @@
 import os
 import httpx
-import time
 import http.client
 import ssl
 import socket
 import fnmatch
 import requests
-from datetime import datetime
 from urllib.parse import urlparse, urljoin
 from http import HTTPStatus
 
+from compliance.utils import cancellation, instrumentation
+
 
 NIST_BASE_URL = "https://services.nvd.nist.gov/rest/json/cves/2.0"
+# seconds, httpx's default
+NVD_TIMEOUT = 5
 
 
 # Check NIST NVD for the CVE
@@ -34,9 +36,14 @@ def check_technology_for_cves(product, version, vendor=None):
     final_status_code = ""
 
     while retries < max_retries:
+        # the task has been cancelled or its deadline has passed, i.e., the API quota is not used anymore
+        if cancellation.stop_reason():
+            return {"error": f"Scan stopped ({cancellation.stop_reason()}) before NVD responded"}
         try:
             # Make a GET request to the NVD API
-            nvd_response = httpx.get(nvd_url, headers=headers)
+            with instrumentation.api_call("nvd") as call:
+                nvd_response = httpx.get(nvd_url, headers=headers, timeout=cancellation.remaining(NVD_TIMEOUT))
+                call.status_code = nvd_response.status_code
             # print(f"nvd_response: ", nvd_response)
             # print(f"\n vd_response.json(): \n", nvd_response.json())
 
@@ -48,8 +55,9 @@ def check_technology_for_cves(product, version, vendor=None):
             elif nvd_response.status_code == 429 or nvd_response.status_code == 403:
                 print(f"Status code: {nvd_response.status_code}. Text: {nvd_response.text}")
                 # handle rate limiting by sleeping and retrying
+                instrumentation.record_api_retry("nvd")
                 retries += 1
-                time.sleep(retry_delay)
+                cancellation.sleep(retry_delay)
                 retry_delay *= 2
                 continue
             elif nvd_response.status_code == 404:
@@ -66,8 +74,9 @@ def check_technology_for_cves(product, version, vendor=None):
                 }
         except httpx.HTTPError:
             # handling connection error
+            instrumentation.record_api_retry("nvd")
             retries += 1
-            time.sleep(retry_delay)
+            cancellation.sleep(retry_delay)
             retry_delay *= 2
             continue
 
@@ -101,6 +110,9 @@ def check_https_connections(websites):
     results = {}
 
     for site in websites:
+        # the websites checked so far are returned as a partial result
+        if cancellation.stop_reason():
+            break
         print(f"current website: {site}")
         tmp_site = "https://" + site if "://" not in site else site
 
@@ -109,7 +121,7 @@ def check_https_connections(websites):
         domain = urlparse(site).netloc or urlparse("https://" + site).netloc
 
         try:
-            response = requests.get(tmp_site, timeout=(10, 60), verify=False)
+            response = requests.get(tmp_site, timeout=(10, cancellation.remaining(60)), verify=False)
             # response = requests.get(tmp_site, verify=False)
             print(f"response: {response.url}")
             if response.url.startswith('https://'):
@@ -204,7 +216,12 @@ def check_https_connections(websites):
     return results
 
 
-def prepare_gpt_messages(company, certificate, requirements):
+def prepare_gpt_messages(certificate, requirement):
+    """
+    Prompt for the recommendations of a single requirement. The prompt does not depend on the company,
+    so that the generated recommendations can be reused for every company (see compliance/utils/reports.py).
+    The header and the conclusion of the report are part of pdf_report_template.html.
+    """
     certs_info = {
         "Technical Baseline": "is looking to attain a 'Technical Baseline Certification'. " +\
                               "This certification verifies that an organization has essential technical measures and " +\
@@ -218,42 +235,23 @@ def prepare_gpt_messages(company, certificate, requirements):
     chatbot_role = "Suppose you are a Cybersecurity Expert specializing in Risk Management and Compliance, working as " +\
                      "a consultant for Small and Medium-sized Enterprises (SMEs) that are looking to bolster their cybersecurity measures."
 
-    certificate_information = f"Company {company.name} {certs_info[certificate.name]}\n"
+    certificate_information = f"A company {certs_info[certificate.name]}\n"
 
-    requirements_information = f"To attain this certification, Company {company.name} needs to fulfill the following requirements:\n" + \
-                               "\n".join(f"- {req.description}" for req in requirements)
+    requirement_information = f"To attain this certification, the company needs to fulfill the following requirement:\n" + \
+                              f"- {requirement.description}\n"
 
-    actual_request = f"Please provide detailed guidance, addressed to the management of Company {company.name}, specifying " +\
-                     "actionable steps they can take to fulfill each requirement. Include the benefits of fulfilling these requirements, technologies that would be" +\
+    actual_request = "Please provide detailed guidance, addressed to the management of the company, specifying " +\
+                     "actionable steps they can take to fulfill the requirement. Include the benefits of fulfilling this requirement, technologies that would be" +\
                      "appropriate and a brief explanation of how implementing these steps can improve their cybersecurity posture." +\
                      "Additionally, provide an approximate timeline for each step and any potential challenges they may face during implementation." +\
-                    "Use html tags do define a nice and appealing design of the output. Do not use the following tags: <html>, <body>, <head>, <h1> \n"
+                    "Use html tags do define a nice and appealing design of the output. Do not use the following tags: <html>, <body>, <head>, <h1>, <h2> \n"
 
     report_structure = f"""
-    Your response should follow the following structure:
-    1. Start with the following elements:
-        <div style="font-family: 'Helvetica Neue', 'Helvetica', sans-serif; line-height: 1.5; padding: 20mm; color: #333; max-width: 210mm; margin: 0 auto; box-sizing: border-box;">
-            <!-- Start with following elements -->
-            <h1 style="font-size: 20px; text-align: center; color: #34495E; margin-bottom: 10mm;">CERTSec Cybersecurity Recommendations</h1>
-            <p style="font-size: 12px; margin-bottom: 5mm;">
-                Date:   {datetime.now().strftime('%d.%m.%Y')}<br>
-                To:     {company.name}<br>
-                From:   CERTSec Automated Report Generation Tool
-            </p>
-            <h2 style="font-size: 18px; color: #34495E; margin-bottom: 5mm;"><strong>Subject: Actionable Steps to Fulfill the Remaining {certificate.name} Certification Requirements</strong></h2>
-        
-            <p style="font-size: 14px;">
-                Dear Management of Company <strong>{company.name}</strong>,
-                <br><br>            
-                Congratulations on your decision to pursue the <strong>{certificate.name}</strong> Certification! To fulfill each of the requirements, please find below detailed guidance with actionable steps, benefits, estimated timeline, and potential challenges:
-            </p>
-    2. For the {len(requirements)} requirements provided before, continue with the following elements:
-            <!-- Requirements -->
-            <!-- For EACH requirement listed at the beginning, generate the following information: -->
+    Your response should only consist of the following elements:
             <div style="page-break-before: always; padding: 10mm; border-radius: 4px;">
-                <h3 style="margin: 0; padding-bottom: 2mm; font-size: 16px; color: #174361;">Requirement X: Requirement description</h3>
+                <h3 style="margin: 0; padding-bottom: 2mm; font-size: 16px; color: #174361;">{requirement.description}</h3>
                 <p style="font-size: 14px; margin: 2mm 0;">
-                    To fulfill this requirement, Company X should implement the following steps:
+                    To fulfill this requirement, the company should implement the following steps:
                 </p>
                 <ol style="margin-left: 5mm; font-size: 14px;">
                     <li>List all steps using an ordered list</li>
@@ -266,24 +264,10 @@ def prepare_gpt_messages(company, certificate, requirements):
                     <strong>Potential Challenges:</strong> Describe potential challenges
                 </p>
             </div>
-            <!-- End of Requirement Section -->
-    3. Conclude your response with the following elements:
-            <!-- Conclusion -->
-            <div style="page-break-before: always; padding: 10mm; border-radius: 4px;">
-                <p style="font-size: 14px; margin-top: 10mm;">
-                    We believe that following these actionable steps will significantly improve Company <strong>{company.name}</strong>'s cybersecurity posture and help in achieving the <strong>{certificate.name}</strong> Certification. As with any implementation, challenges may arise, but with proper planning and guidance, these challenges can be overcome effectively.
-                    <br><br>
-                    If you have any further questions or need assistance during the implementation process, please do not hesitate to reach out for professional guidance.
-                    <br><br>
-                    <strong>Best regards,</strong><br>
-                    CERTSec Team
-                </p>
-            </div>
-        </div>
     """
 
     response = {
         "system_msg": chatbot_role,
-        "user_msg": certificate_information + requirements_information + actual_request + report_structure
+        "user_msg": certificate_information + requirement_information + actual_request + report_structure
     }
     return response
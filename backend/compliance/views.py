@@ -1,24 +1,35 @@
 import os
-import openai
-from django.http import HttpResponse
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Prefetch
+from django.utils import timezone
+from django.http import FileResponse, HttpResponse
 from dotenv import load_dotenv
 from rest_framework import status
 from rest_framework.generics import get_object_or_404
 from rest_framework.response import Response
 from rest_framework.decorators import api_view
+from rest_framework.exceptions import ValidationError
 
-from compliance.models import Company, Certificate, Category, Requirement, Assessment, AssessmentRequirement
+from compliance.models import Company, Certificate, Category, Requirement, Assessment, AssessmentRequirement, \
+    AssessmentScan, CveEnrichment, ScanBatch, ScanRun
 from compliance.serializers import CompanySerializer, CertificateSerializer, CategorySerializer, RequirementSerializer, \
-    AssessmentSerializer, AssessmentRequirementSerializer
+    AssessmentSerializer, AssessmentRequirementSerializer, certificates_context
 from compliance.tasks import check_https_connection_task, ping_ips_task, nmap_vulners_scan_task, \
-    technologies_vulnerability_scan_task, nmap_top_ports_scan_task
+    technologies_vulnerability_scan_task, nmap_top_ports_scan_task, generate_report_task
 from celery.result import AsyncResult
-from datetime import datetime
 from dateutil.relativedelta import relativedelta
 
-from compliance.utils.utils import prepare_gpt_messages
-from django.template.loader import get_template
-from xhtml2pdf import pisa
+from compliance.utils.catalog import catalog_response
+from compliance.utils.deduplication import submit_scan
+from compliance.utils.pagination import filter_queryset, list_response, requested_fields
+from compliance.utils.metrics import generate_latest_metrics
+from compliance.utils.reports import cached_report_id, report_path
+from compliance.utils.results import load_result
+from compliance.utils.scan_results import SCAN_RUN_REFERENCE, scan_result, scan_runs_with_results
+from compliance.utils.scheduling import batch_status, cancel_batch, cancel_scan, submit_bulk_scan
+from cve_prioritizer.cve_prioritizer import cve_prioritizer_wrapper
+from prometheus_client import CONTENT_TYPE_LATEST
 
 load_dotenv()
 
@@ -28,60 +39,65 @@ def generate_report(request, id):
     if not assessment_id:
         return Response({'error': 'No assessment id provided'}, status=status.HTTP_400_BAD_REQUEST)
 
-    assessment = get_object_or_404(Assessment, id=assessment_id)
-
-    # Fetch related company and certificate
-    company = assessment.company
-    certificate = assessment.certificate
-
-    # Fetch all the unfulfilled requirements that belong to this assessment
-    # and prefetch the related Requirement objects
-    unfulfilled_assessment_requirements = AssessmentRequirement.objects.filter(
-        assessment=assessment,
-        fulfilled=False
-    ).select_related('requirement')
-
-    # Extract the Requirement objects from the AssessmentRequirement objects
-    unfulfilled_requirements = [ar.requirement for ar in unfulfilled_assessment_requirements]
-    print(f"Number of unfulfilled requirements: {len(unfulfilled_requirements)}")
-
-    prompt = prepare_gpt_messages(company, certificate, unfulfilled_requirements)
-    print(prompt)
+    get_object_or_404(Assessment, id=assessment_id)
+
+    # Reports are stored by content, i.e., a report generated before for the same company, certificate
+    # and unfulfilled requirements can be downloaded right away from reports/<report_id>/
+    force_refresh = str(request.data.get("force_refresh", False)).lower() == "true"
+    # the results of these scans are summarized in the appendix of the report, by default the scans
+    # submitted with the assessment
+    scan_task_ids = request.data.get("scan_task_ids")
+    if scan_task_ids is None:
+        scan_runs = ScanRun.objects.filter(
+            task_id__in=AssessmentScan.objects.filter(assessment_id=assessment_id).values("task_id")
+        )
+    elif isinstance(scan_task_ids, list) and all(isinstance(task_id, str) for task_id in scan_task_ids):
+        scan_runs = ScanRun.objects.filter(task_id__in=scan_task_ids)
+    else:
+        return Response({'error': 'scan_task_ids has to be a list of task ids'}, status=status.HTTP_400_BAD_REQUEST)
+    # only finished scans, so that a report is never stored with the results of a scan that is still running
+    scan_task_ids = sorted(scan_runs.values_list("task_id", flat=True))
 
-    openai.api_key = os.getenv("OPEN_AI_API")
-    response = openai.ChatCompletion.create(model="gpt-3.5-turbo-16k",
-                                            messages=[{"role": "system", "content": prompt["system_msg"]},
-                                                      {"role": "user", "content": prompt["user_msg"]}])
-    if response["choices"][0]["finish_reason"] == "stop":
-        gpt_content = response["choices"][0]["message"]["content"]
-        print(gpt_content)
-        template = get_template('pdf_report_template.html')
+    if not force_refresh:
+        report_id = cached_report_id(assessment_id, scan_task_ids)
+        if report_id is not None:
+            return Response({"report_id": report_id}, status=status.HTTP_200_OK)
 
-        # Render the template with the content
-        html = template.render({'body': gpt_content})
+    # The LLM request and the PDF rendering take tens of seconds, the client polls the task
+    # status, whose result contains the report_id once the task has finished
+    task = generate_report_task.delay(assessment_id, force_refresh, scan_task_ids)
+    return Response({"task_id": task.id}, status=status.HTTP_202_ACCEPTED)
 
-        # Create a HttpResponse object with the PDF
-        response = HttpResponse(content_type='application/pdf')
-        response['Content-Disposition'] = 'attachment; filename="recommendations.pdf"'
 
-        # Generate PDF
-        pisa_status = pisa.CreatePDF(html, dest=response)
+@api_view(["GET"])
+def download_report(request, report_id):
+    path = report_path(report_id)
+    if not os.path.exists(path):
+        return Response({'error': 'Report not found'}, status=status.HTTP_404_NOT_FOUND)
 
-        # Return the response object
-        return response
-    else:
-        print(response["choices"][0]["finish_reason"] == "stop")
-    return Response({'prompt': prompt})
+    return FileResponse(open(path, "rb"), as_attachment=True, filename="recommendations.pdf",
+                        content_type="application/pdf")
 
 
+def metrics(request):
+    # Prometheus scrapes plain text, i.e., no DRF content negotiation
+    return HttpResponse(
+        generate_latest_metrics(
+            settings.CELERY_BROKER_URL, settings.CELERY_METRICS_QUEUES, settings.CELERY_BROKER_TRANSPORT_OPTIONS
+        ),
+        content_type=CONTENT_TYPE_LATEST,
+    )
 
 
 @api_view(["GET", "POST"])
 def companies(request):
     if request.method == "GET":
-        companies = Company.objects.all()
-        serializer = CompanySerializer(companies, many=True)
-        return Response(serializer.data)
+        companies = filter_queryset(request, Company.objects.all(), {
+            "name": ("name__icontains", "str"),
+            "created_after": ("created_at__gte", "date"),
+            "created_before": ("created_at__lt", "date"),
+        })
+        return list_response(request, companies, CompanySerializer, fields=requested_fields(request))
 
     elif request.method == "POST":
         company_name = request.data.get("name")
@@ -111,119 +127,212 @@ def get_background_process_status(request):
 
     # include result if the task has finished
     if task.successful():
-        response_data['result'] = task.result
+        try:
+            # large results are stored in files and only read once they are requested
+            result = load_result(task.result)
+        except FileNotFoundError:
+            return Response({'error': 'Task result has expired'}, status=status.HTTP_404_NOT_FOUND)
+        if isinstance(result, dict) and SCAN_RUN_REFERENCE in result:
+            # scan tasks store their result in the database and only return a reference to it
+            scan_run = scan_runs_with_results(ScanRun.objects.filter(id=result[SCAN_RUN_REFERENCE])).first()
+            if scan_run is None:
+                return Response({'error': 'Scan result not found'}, status=status.HTTP_404_NOT_FOUND)
+            result = scan_result(scan_run)
+            if scan_run.stopped:
+                # cancelled or stopped at its deadline, i.e., the result is partial
+                response_data['stopped'] = scan_run.stopped
+        response_data['result'] = result
 
     return Response(response_data, status=status.HTTP_200_OK)
 
 
-@api_view(["GET"])
-def get_certificates(request):
-    certificates = Certificate.objects.all()
-    serializer = CertificateSerializer(certificates, many=True)
-    return Response(serializer.data)
+@api_view(["POST"])
+def cancel_task(request, id):
+    # A task that has not been started is discarded, a running scan stops as soon as possible and
+    # stores the results collected so far
+    cancel_scan(id)
+    return Response({"task_id": id}, status=status.HTTP_202_ACCEPTED)
+
+
+@api_view(["POST"])
+def reprioritize_cves(request, id):
+    try:
+        epss = float(request.data.get("epss", 0.2))
+        cvss = float(request.data.get("cvss", 6.0))
+    except (TypeError, ValueError):
+        return Response({'error': 'epss and cvss need to be numbers'}, status=status.HTTP_400_BAD_REQUEST)
+
+    # Re-apply the thresholds to the NVD and EPSS data stored during the scan instead of querying the APIs again
+    enrichments = {
+        enrichment.cve_id: enrichment.as_enrichment() for enrichment in CveEnrichment.objects.filter(task_id=id)
+    }
+    if not enrichments:
+        return Response({'error': 'No stored CVE data found for this task'}, status=status.HTTP_404_NOT_FOUND)
+
+    cve_priority_details = cve_prioritizer_wrapper.apply_thresholds(enrichments, epss=epss, cvss=cvss)
+    ranked_cves = cve_prioritizer_wrapper.rank_cves(cve_priority_details)
+
+    return Response({
+        "task_id": id,
+        "epss": epss,
+        "cvss": cvss,
+        "results": [{"cve_id": cve, **details} for cve, details in ranked_cves],
+    }, status=status.HTTP_200_OK)
 
 
 @api_view(["GET"])
-def get_categories(request):
-    certificate_type = request.GET.get("type")
+def get_certificates(request):
+    def build():
+        certificates = Certificate.objects.all()
+        return CertificateSerializer(certificates, many=True, context=certificates_context()).data
 
-    if certificate_type == "tb":
-        try:
-            certificate = Certificate.objects.get(name="Technical Baseline")
-        except Certificate.DoesNotExist:
-            return Response({"error": "Certificate not found"}, status.HTTP_404_NOT_FOUND)
+    return catalog_response(request, "certificates", build)
 
-        categories = certificate.categories.all()
 
-        serializer = CategorySerializer(categories, many=True)
+def _categories_with_requirements(certificate):
+    return certificate.categories.prefetch_related(
+        Prefetch("requirements", queryset=Requirement.objects.select_related("category"))
+    )
 
-        return Response(serializer.data)
-    elif certificate_type == "cab":
-        try:
-            certificate = Certificate.objects.get(name="Cost-Aware Baseline")
-        except Certificate.DoesNotExist:
-            return Response({"error": "Certificate not found"}, status.HTTP_404_NOT_FOUND)
 
-        categories = certificate.categories.all()
+CERTIFICATE_TYPES = {
+    "tb": "Technical Baseline",
+    "cab": "Cost-Aware Baseline",
+    "cob": "Comprehensive Baseline",
+}
 
-        serializer = CategorySerializer(categories, many=True)
 
-        return Response(serializer.data)
-    elif certificate_type == "cob":
+@api_view(["GET"])
+def get_categories(request):
+    certificate_type = request.GET.get("type")
+    if certificate_type not in CERTIFICATE_TYPES:
+        return Response({"error": "Invalid certificate type"}, status.HTTP_400_BAD_REQUEST)
+
+    def build():
         try:
-            certificate = Certificate.objects.get(name="Comprehensive Baseline")
+            certificate = Certificate.objects.get(name=CERTIFICATE_TYPES[certificate_type])
         except Certificate.DoesNotExist:
-            return Response({"error": "Certificate not found"}, status.HTTP_404_NOT_FOUND)
+            return None
 
-        categories = certificate.categories.all()
+        categories = _categories_with_requirements(certificate)
 
         serializer = CategorySerializer(categories, many=True)
 
-        return Response(serializer.data)
+        return serializer.data
+
+    return catalog_response(request, f"categories:{certificate_type}", build, "Certificate not found")
 
 
 @api_view(["GET"])
 def get_requirements(request):
-    requirements = Requirement.objects.all()
-    serializer = RequirementSerializer(requirements, many=True)
-    return Response(serializer.data)
+    requirements = filter_queryset(request, Requirement.objects.select_related("category"), {
+        "category": ("category_id", "int"),
+        "certificate": ("category__certificate_id", "int"),
+        "automated": ("is_automated_requirement", "bool"),
+    })
+    if request.query_params:
+        return list_response(request, requirements, RequirementSerializer, fields=requested_fields(request))
+
+    # the complete list is part of the cached catalog
+    return catalog_response(
+        request, "requirements", lambda: RequirementSerializer(requirements, many=True).data
+    )
+
+
+def _assessments_with_requirements(fields=None):
+    # everything serialized by AssessmentSerializer in three queries, independent of the number of assessments
+    assessments = Assessment.objects.select_related("company", "certificate")
+    if fields is None or "assessment_requirements" in fields:
+        assessments = assessments.prefetch_related(
+            Prefetch(
+                "assessment_requirements",
+                queryset=AssessmentRequirement.objects.select_related("requirement__category")
+            )
+        )
+    return assessments
 
 
-@api_view(["GET"])
-def get_assessments(request):
-    assessments = Assessment.objects.all()
-    serializer = AssessmentSerializer(assessments, many=True)
-    return Response(serializer.data)
+ASSESSMENT_FILTERS = {
+    "company": ("company_id", "int"),
+    "certificate": ("certificate_id", "int"),
+    "passed": ("passed", "bool"),
+    "attempted_after": ("attempted_at__gte", "date"),
+    "attempted_before": ("attempted_at__lt", "date"),
+}
 
 
 @api_view(["GET"])
 def get_assessment(request, id):
     if request.method == "GET":
         try:
-            assessment = Assessment.objects.get(id=id)
+            assessment = _assessments_with_requirements().get(id=id)
         except Assessment.DoesNotExist:
             return Response({'error': 'Assessment not found'}, status=status.HTTP_404_NOT_FOUND)
 
         # Serialize the assessment object including related AssessmentRequirement instances
-        serializer = AssessmentSerializer(assessment)
+        serializer = AssessmentSerializer(assessment, context=certificates_context())
 
         return Response(serializer.data, status=status.HTTP_200_OK)
 
     return Response({'error': 'Invalid Method'}, status=status.HTTP_400_BAD_REQUEST)
 
 
-@api_view(["POST"])
+@api_view(["GET", "POST"])
 def assessments(request):
-    if request.method == "POST":
+    if request.method == "GET":
+        fields = requested_fields(request)
+        assessments = filter_queryset(request, _assessments_with_requirements(fields), ASSESSMENT_FILTERS)
+        return list_response(request, assessments, AssessmentSerializer, fields=fields, context=certificates_context())
+
+    elif request.method == "POST":
         company_id = request.data.get("company_id")
         certificate_id = request.data.get("certificate_id")
         user_responses = request.data.get("user_responses")
+        # the automated checks run for this assessment
+        scan_task_ids = request.data.get("scan_task_ids", [])
 
-        assessment = Assessment.objects.create(
-            company_id=company_id,
-            certificate_id=certificate_id,
-            passed=False
-        )
-
-        all_requirements_passed = True
-        for requirement_id, fulfilled in user_responses.items():
+        if user_responses is None:
+            return Response({'error': 'No user responses provided'}, status=status.HTTP_400_BAD_REQUEST)
 
-            requirement = Requirement.objects.get(pk=requirement_id)
-            if fulfilled == "no":
-                all_requirements_passed = False
+        if not isinstance(scan_task_ids, list) or not all(isinstance(task_id, str) for task_id in scan_task_ids):
+            return Response({'error': 'scan_task_ids has to be a list of task ids'}, status=status.HTTP_400_BAD_REQUEST)
 
-            AssessmentRequirement.objects.create(
-                assessment=assessment,
-                requirement=requirement,
-                fulfilled= True if fulfilled == "yes" else False
+        try:
+            responses = {int(requirement_id): fulfilled for requirement_id, fulfilled in user_responses.items()}
+        except (AttributeError, ValueError):
+            return Response({'error': 'Invalid requirement ids'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Validate all requirement ids with a single query
+        requirements = Requirement.objects.in_bulk(list(responses))
+        unknown_requirement_ids = [requirement_id for requirement_id in responses if requirement_id not in requirements]
+        if unknown_requirement_ids:
+            return Response({'error': f'Requirements not found: {unknown_requirement_ids}'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        all_requirements_passed = all(fulfilled != "no" for fulfilled in responses.values())
+        valid_until = timezone.now() + relativedelta(years=1) if all_requirements_passed else None
+
+        # The assessment and its requirements are inserted in one transaction, i.e., with a constant
+        # number of queries and a single commit, independent of the number of requirements
+        with transaction.atomic():
+            assessment = Assessment.objects.create(
+                company_id=company_id,
+                certificate_id=certificate_id,
+                passed=all_requirements_passed,
+                valid_until=valid_until
             )
-
-        assessment.passed = all_requirements_passed
-        if all_requirements_passed:
-            current_date = datetime.now()
-            valid_until = current_date + relativedelta(years=1)
-            assessment.valid_until = valid_until
-        assessment.save()
+            AssessmentRequirement.objects.bulk_create([
+                AssessmentRequirement(
+                    assessment=assessment,
+                    requirement=requirements[requirement_id],
+                    fulfilled=True if fulfilled == "yes" else False
+                )
+                for requirement_id, fulfilled in responses.items()
+            ])
+            # also the scans that are still running, their results are included in reports once they have finished
+            AssessmentScan.objects.bulk_create([
+                AssessmentScan(assessment=assessment, task_id=task_id) for task_id in dict.fromkeys(scan_task_ids)
+            ])
 
         return Response({
             'assessment_id': assessment.id,
@@ -235,34 +344,56 @@ def assessments(request):
 
 @api_view(["GET"])
 def get_assessment_requirements(request):
-    assessment_requirements = AssessmentRequirement.objects.all()
-    serializer = AssessmentRequirementSerializer(assessment_requirements, many=True)
-    return Response(serializer.data)
+    assessment_requirements = filter_queryset(
+        request,
+        AssessmentRequirement.objects.select_related("requirement__category"),
+        {
+            "assessment": ("assessment_id", "int"),
+            "requirement": ("requirement_id", "int"),
+            "fulfilled": ("fulfilled", "bool"),
+            **{parameter: (f"assessment__{lookup}", kind) for parameter, (lookup, kind) in ASSESSMENT_FILTERS.items()},
+        }
+    )
+    return list_response(request, assessment_requirements, AssessmentRequirementSerializer,
+                         fields=requested_fields(request))
+
+
+def _requested_deadline(request):
+    # seconds after which the scan stops and returns what it has, None for the default of the task
+    deadline = request.data.get("deadline")
+    if deadline is None:
+        return None
+    try:
+        if float(deadline) > 0:
+            return float(deadline)
+    except (TypeError, ValueError):
+        pass
+    raise ValidationError({"error": "deadline has to be a positive number of seconds"})
 
 
 @api_view(["POST"])
 def ping_ip(request):
     ip_addresses = request.data.get("ip_addresses", [])
 
-    task = ping_ips_task.delay(ip_addresses)
-    return Response({"task_id": task.id})
+    task_id, deduplicated = submit_scan(ping_ips_task, ip_addresses, deadline=_requested_deadline(request))
+    return Response({"task_id": task_id, "deduplicated": deduplicated})
 
 
 @api_view(["POST"])
 def nmap_top_ports_scan(request):
     ip_addresses = request.data.get("ip_addresses", [])
 
-    task = nmap_top_ports_scan_task.delay(ip_addresses)
-    return Response({"task_id": task.id})
+    task_id, deduplicated = submit_scan(nmap_top_ports_scan_task, ip_addresses, deadline=_requested_deadline(request))
+    return Response({"task_id": task_id, "deduplicated": deduplicated})
 
 
 @api_view(["POST"])
 def check_https_connection(request):
     websites = request.data.get("websites", [])
 
-    # Start check_https_connection_task as a background process
-    task = check_https_connection_task.delay(websites)
-    return Response({"task_id": task.id})
+    # Start check_https_connection_task as a background process, unless the same websites are checked already
+    task_id, deduplicated = submit_scan(check_https_connection_task, websites, deadline=_requested_deadline(request))
+    return Response({"task_id": task_id, "deduplicated": deduplicated})
 
 
 @api_view(["POST"])
@@ -274,8 +405,8 @@ def nmap_vulners_scan(request):
     if ip_addresses is None:
         return Response({"error": "No IPs provided."}, status=400)
 
-    task = nmap_vulners_scan_task.delay(ip_addresses)
-    return Response({"task_id": task.id})
+    task_id, deduplicated = submit_scan(nmap_vulners_scan_task, ip_addresses, deadline=_requested_deadline(request))
+    return Response({"task_id": task_id, "deduplicated": deduplicated})
 
 
 @api_view(["POST"])
@@ -288,7 +419,48 @@ def technology_vulners_scan(request):
     if not technologies:
         return Response({"error": "No technologies provided."}, status=400)
 
-    task = technologies_vulnerability_scan_task.delay(technologies)
-    return Response({"task_id": task.id})
+    task_id, deduplicated = submit_scan(
+        technologies_vulnerability_scan_task, technologies, deadline=_requested_deadline(request)
+    )
+    return Response({"task_id": task_id, "deduplicated": deduplicated})
+
+
+BULK_SCAN_TASKS = {
+    "ping": ping_ips_task,
+    "ports": nmap_top_ports_scan_task,
+    "https": check_https_connection_task,
+    "vulners": nmap_vulners_scan_task,
+    "technologies": technologies_vulnerability_scan_task,
+}
+
+
+@api_view(["POST"])
+def bulk_scan(request):
+    scan = request.data.get("scan")
+    targets = request.data.get("targets")
 
+    if scan not in BULK_SCAN_TASKS:
+        return Response({"error": f"scan has to be one of {', '.join(BULK_SCAN_TASKS)}"},
+                        status=status.HTTP_400_BAD_REQUEST)
+    if not isinstance(targets, list) or not targets:
+        return Response({"error": "No targets provided."}, status=status.HTTP_400_BAD_REQUEST)
+    company = get_object_or_404(Company, id=request.data.get("company_id"))
 
+    # The targets are scanned in chunks, interleaved with the bulk scans of the other companies and after
+    # the interactive scans. The task ids of the chunks are polled like the ones of the other scans
+    batch = submit_bulk_scan(BULK_SCAN_TASKS[scan], company, targets)
+    return Response(batch_status(batch), status=status.HTTP_202_ACCEPTED)
+
+
+@api_view(["GET"])
+def get_bulk_scan(request, id):
+    batch = get_object_or_404(ScanBatch, id=id)
+    return Response(batch_status(batch), status=status.HTTP_200_OK)
+
+
+@api_view(["POST"])
+def cancel_bulk_scan(request, id):
+    batch = get_object_or_404(ScanBatch, id=id)
+    # the pending chunks are never queued, the queued ones stop like cancelled scans
+    cancel_batch(batch)
+    return Response(batch_status(batch), status=status.HTTP_202_ACCEPTED)
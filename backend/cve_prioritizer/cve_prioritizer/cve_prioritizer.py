@@ -16,11 +16,17 @@ from threading import Semaphore
 
 from dotenv import load_dotenv
 
-from scripts.constants import LOGO
-from scripts.constants import SIMPLE_HEADER
-from scripts.constants import VERBOSE_HEADER
-from scripts.helpers import worker
-from scripts.helpers import cve_trends
+# The helpers are imported relative to the backend directory, i.e., run this script from
+# there with: python -m cve_prioritizer.cve_prioritizer.cve_prioritizer
+from cve_prioritizer.cve_prioritizer.scripts.constants import CVE_PATTERN
+from cve_prioritizer.cve_prioritizer.scripts.constants import LOGO
+from cve_prioritizer.cve_prioritizer.scripts.constants import SIMPLE_HEADER
+from cve_prioritizer.cve_prioritizer.scripts.constants import VERBOSE_HEADER
+from cve_prioritizer.cve_prioritizer.scripts.helpers import worker
+from cve_prioritizer.cve_prioritizer.scripts.helpers import cve_trends
+from cve_prioritizer.cve_prioritizer.scripts.helpers import stream_prioritize
+from cve_prioritizer.cve_prioritizer.scripts.output_writer import OUTPUT_FORMATS
+from cve_prioritizer.cve_prioritizer.scripts.output_writer import OutputWriter
 
 load_dotenv()
 Throttle_msg = ""
@@ -53,7 +59,7 @@ parser.add_argument(
     "-f",
     "--file",
     type=argparse.FileType("r"),
-    help="TXT file with CVEs (One per Line)",
+    help="TXT file with CVEs (One per Line), use - to read from stdin",
     required=False,
     metavar="",
 )
@@ -78,6 +84,19 @@ parser.add_argument(
     default=100,
 )
 parser.add_argument("-v", "--verbose", help="Verbose mode", action="store_true")
+parser.add_argument(
+    "-s",
+    "--stream",
+    help="Read the CVEs of --file lazily and write the results as soon as they are completed",
+    action="store_true",
+)
+parser.add_argument(
+    "--format",
+    type=str,
+    help="Output file format (Default csv)",
+    choices=OUTPUT_FORMATS,
+    default="csv",
+)
 parser.add_argument(
     "-l",
     "--list",
@@ -100,9 +119,43 @@ if __name__ == "__main__":
     # Temporal lists
     cve_list = []
     threads = []
+    failed_cves = []
+
+    def run_worker(cve_id, *worker_args):
+        if not worker(cve_id, *worker_args):
+            failed_cves.append(cve_id)
+
+    # All threads pass their rows to a single writer thread
+    output_writer = None
+    if args.output:
+        output_writer = OutputWriter(args.output, args.format)
+        output_writer.start()
 
     if args.verbose:
         header = VERBOSE_HEADER
+    if args.stream:
+        if not args.file:
+            parser.error("--stream requires --file")
+        if not os.getenv("NIST_API"):
+            print(
+                LOGO
+                + "Warning: Using this tool without specifying a NIST API may result in errors"
+                + "\n\n"
+                + header
+            )
+        else:
+            print(LOGO + header)
+        failed = stream_prioritize(
+            args.file,
+            cvss_threshold,
+            epss_threshold,
+            args.verbose,
+            args.threads,
+            output_writer,
+        )
+        if output_writer:
+            output_writer.close()
+        raise SystemExit(1 if failed else 0)
     if args.cve:
         cve_list.append(args.cve)
         # print(LOGO+header)
@@ -162,31 +215,25 @@ if __name__ == "__main__":
         except json.JSONDecodeError:
             print(f"Unable to connect to CVE Trends")
 
-    if args.output:
-        with open(args.output, "w") as output_file:
-            output_file.write(
-                "cve_id,priority,epss,cvss,cvss_version,cvss_severity,cisa_kev" + "\n"
-            )
-
     for cve in cve_list:
         throttle = 1
         if len(cve_list) > 75 and not os.getenv("NIST_API"):
             throttle = 6
-        if not re.match("(CVE|cve-\d{4}-\d+$)", cve):
+        if not re.match(CVE_PATTERN, cve.strip()):
             print(
                 f"{cve} Error: CVEs should be provided in the standard format CVE-0000-0000*"
             )
         else:
             sem.acquire()
             t = threading.Thread(
-                target=worker,
+                target=run_worker,
                 args=(
                     cve.upper().strip(),
                     cvss_threshold,
                     epss_threshold,
                     args.verbose,
                     sem,
-                    args.output,
+                    output_writer,
                 ),
             )
             threads.append(t)
@@ -195,3 +242,10 @@ if __name__ == "__main__":
 
     for t in threads:
         t.join()
+
+    if output_writer:
+        output_writer.close()
+
+    # e.g., for scripts, any CVE that could not be processed fails the run
+    if failed_cves:
+        raise SystemExit(1)
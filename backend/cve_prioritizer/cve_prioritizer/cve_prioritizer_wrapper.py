@@ -1,32 +1,65 @@
 import concurrent
+import contextvars
 
 from concurrent.futures import ThreadPoolExecutor
 
-from cve_prioritizer.cve_prioritizer.scripts.helpers import worker_v2
+from cve_prioritizer.cve_prioritizer.scripts.constants import PRIORITIES
+from cve_prioritizer.cve_prioritizer.scripts.helpers import enrich_cve, classify_cve
 
 
-def _process_cves(cve_list, cvss_threshold, epss_threshold, max_workers):
+def _process_cves(cve_list, max_workers):
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [
-            executor.submit(
-                worker_v2, cve.upper().strip(), cvss_threshold, epss_threshold
-            )
+        # run every CVE in a copy of the caller's context, so that e.g. the metrics of the
+        # current task are also recorded by the worker threads
+        futures = {
+            executor.submit(contextvars.copy_context().run, enrich_cve, cve.upper().strip()): cve.upper().strip()
             for cve in cve_list
-        ]
+        }
 
-    results = []
+    results = {}
     for future in concurrent.futures.as_completed(futures):
-        result = future.result()
-        if result is not None:
-            results.append(result)
+        # None if the task had to stop before the CVE has been enriched
+        if future.result() is not None:
+            results[futures[future]] = future.result()
 
     return results
 
 
-def prioritize_cves(cve_list, epss=0.2, cvss=6.0, threads=40):
-    results = _process_cves(cve_list, cvss, epss, threads)
+def enrich_cves(cve_list, threads=40):
+    """
+    Fetches the raw NVD and EPSS data of every CVE without applying any thresholds.
+    The returned dict can be persisted and passed to apply_thresholds as often as needed.
+    """
+    return _process_cves(cve_list, threads)
+
+
+def apply_thresholds(enrichments, epss=0.2, cvss=6.0):
+    results_dict = {}
+    for cve, enrichment in enrichments.items():
+        priority_details = classify_cve(enrichment, cvss, epss)
+        if priority_details is not None:
+            results_dict[cve] = priority_details
+
+    return results_dict
 
-    results_dict = {key: value for result in results for key, value in result.items()}
+
+def rank_cves(results_dict):
+    """
+    Orders prioritized CVEs from most to least urgent. Within the same priority,
+    CVEs with a higher EPSS and CVSS score come first.
+    """
+    return sorted(
+        results_dict.items(),
+        key=lambda item: (
+            PRIORITIES.index(item[1]["priority"]),
+            -(item[1]["epss"] or 0),
+            -(item[1]["cvss_baseScore"] or 0),
+        ),
+    )
+
+
+def prioritize_cves(cve_list, epss=0.2, cvss=6.0, threads=40):
+    results_dict = apply_thresholds(enrich_cves(cve_list, threads), epss, cvss)
     print(results_dict)
 
     return results_dict
@@ -6,6 +6,8 @@ __version__ = "1.3.0"
 __maintainer__ = "Mario Rojas"
 __status__ = "Production"
 
+import os
+
 SIMPLE_HEADER = f"{'CVE-ID':<18}Priority" + "\n" + ("-" * 30)
 VERBOSE_HEADER = (
     f"{'CVE-ID':<18}{'PRIORITY':<13}{'EPSS':<9}{'CVSS':<6}{'VERSION':<10}{'SEVERITY':<10}CISA_KEV"
@@ -14,6 +16,22 @@ VERBOSE_HEADER = (
 )
 EPSS_URL = "https://api.first.org/data/v1/epss"
 NIST_BASE_URL = "https://services.nvd.nist.gov/rest/json/cves/2.0"
+CISA_KEV_URL = "https://www.cisa.gov/sites/default/files/feeds/known_exploited_vulnerabilities.json"
+CISA_KEV_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "known_exploited_vulnerabilities.json"
+)
+# Seconds between two checks whether the local KEV catalog file has changed
+CISA_KEV_RELOAD_INTERVAL = 60
+# NVD allows 50 requests within a rolling 30 seconds window with an API key and 5 without
+NVD_RATE_LIMIT_WITH_KEY = (50, 30)
+NVD_RATE_LIMIT = (5, 30)
+# Seconds to wait for a response of NVD, at most until the deadline of the embedding task (see hooks.py)
+NVD_TIMEOUT = 5
+OUTPUT_FIELDS = ["cve_id", "priority", "epss", "cvss", "cvss_version", "cvss_severity", "cisa_kev"]
+# A CVE ID in the standard format, e.g., CVE-2021-44228
+CVE_PATTERN = r"(?i)^CVE-\d{4}-\d+$"
+# Ordered from most to least urgent
+PRIORITIES = ["Priority 1+", "Priority 1", "Priority 2", "Priority 3", "Priority 4"]
 LOGO = (
     """
 #    ______   ______                         
@@ -2,15 +2,25 @@
 # This file contains the functions that create the reports
 
 import os
-import time
+import re
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from threading import Semaphore
 
 import requests
 
 from dotenv import load_dotenv
 from termcolor import colored
 
+from cve_prioritizer.cve_prioritizer.scripts.constants import CVE_PATTERN
 from cve_prioritizer.cve_prioritizer.scripts.constants import EPSS_URL
 from cve_prioritizer.cve_prioritizer.scripts.constants import NIST_BASE_URL
+from cve_prioritizer.cve_prioritizer.scripts.constants import NVD_RATE_LIMIT
+from cve_prioritizer.cve_prioritizer.scripts.constants import NVD_RATE_LIMIT_WITH_KEY
+from cve_prioritizer.cve_prioritizer.scripts.constants import NVD_TIMEOUT
+from cve_prioritizer.cve_prioritizer.scripts import hooks
+from cve_prioritizer.cve_prioritizer.scripts.kev import is_kev
+from cve_prioritizer.cve_prioritizer.scripts.rate_limiter import RateLimiter
 
 __author__ = "Mario Rojas"
 __license__ = "BSD 3-clause"
@@ -20,12 +30,19 @@ __status__ = "Production"
 
 load_dotenv()
 
+# Shared by all threads of a process, so that concurrent workers stay within NVD's quota
+nvd_rate_limiter = RateLimiter(*NVD_RATE_LIMIT_WITH_KEY) if os.getenv("NIST_API") else RateLimiter(*NVD_RATE_LIMIT)
+# Prevents console lines of concurrent workers from being interleaved
+print_lock = Lock()
+
 
 # Collect EPSS Scores
 def epss_check(cve_id):
     try:
         epss_url = EPSS_URL + f"?cve={cve_id}"
-        epss_response = requests.get(epss_url)
+        with hooks.api_call("epss") as call:
+            epss_response = requests.get(epss_url)
+            call.status_code = epss_response.status_code
         epss_status_code = epss_response.status_code
 
         if epss_status_code == 200:
@@ -52,21 +69,28 @@ def nist_check(cve_id):
     retries = 0
 
     while retries < max_retries:
+        # the task has been cancelled or its deadline has passed, i.e., the API quota is not used anymore
+        if hooks.stop_reason():
+            return {"error": f"Scan stopped ({hooks.stop_reason()}) before NVD responded"}
         try:
             nvd_key = os.getenv("NIST_API")
             nvd_url = NIST_BASE_URL + f"?cveId={cve_id}"
             header = {"apiKey": f"{nvd_key}"}
 
+            nvd_rate_limiter.acquire()
+
             # Check if API has been provided
-            if nvd_key:
-                nvd_response = requests.get(nvd_url, headers=header)
-            else:
-                nvd_response = requests.get(nvd_url)
+            with hooks.api_call("nvd") as call:
+                if nvd_key:
+                    nvd_response = requests.get(nvd_url, headers=header, timeout=hooks.remaining(NVD_TIMEOUT))
+                else:
+                    nvd_response = requests.get(nvd_url, timeout=hooks.remaining(NVD_TIMEOUT))
+                call.status_code = nvd_response.status_code
 
             nvd_status_code = nvd_response.status_code
 
             if nvd_status_code == 200:
-                cisa_kev = False
+                cisa_kev = is_kev(cve_id)
                 if nvd_response.json().get("totalResults") > 0:
                     for unique_cve in nvd_response.json().get("vulnerabilities"):
                         # Check if present in CISA's KEV
@@ -127,8 +151,9 @@ def nist_check(cve_id):
                     print(f"{cve_id:<18}Not Found in NIST NVD.")
             elif nvd_status_code == 429 or nvd_status_code == 403:
                 # handle rate limiting by sleeping and retrying
+                hooks.record_api_retry("nvd")
                 retries += 1
-                time.sleep(retry_delay)
+                hooks.sleep(retry_delay)
                 retry_delay *= 2
                 continue
             elif nvd_status_code == 404:
@@ -140,11 +165,12 @@ def nist_check(cve_id):
                 return {
                     "error": f"Error: Received a {nvd_status_code} status code from NVD"
                 }
-        except requests.exceptions.ConnectionError:
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
             print("Unable to connect to NIST NVD. Check your Internet connection or try again.")
             # Handling connection error
+            hooks.record_api_retry("nvd")
             retries += 1
-            time.sleep(retry_delay)
+            hooks.sleep(retry_delay)
             retry_delay *= 2
             continue
 
@@ -166,7 +192,7 @@ def colored_print(priority):
 
 # Function manages the outputs
 def print_and_write(
-    working_file,
+    output_writer,
     cve_id,
     priority,
     epss,
@@ -178,180 +204,169 @@ def print_and_write(
 ):
     color_priority = colored_print(priority)
 
-    if verbose:
-        print(
-            f"{cve_id:<18}{color_priority:<22}{epss:<9}{cvss_base_score:<6}{cvss_version:<10}{cvss_severity:<10}{cisa_kev}"
-        )
-    else:
-        print(f"{cve_id:<18}{color_priority:<22}")
-    if working_file:
-        working_file.write(
-            f"{cve_id},{priority},{epss},{cvss_base_score},{cvss_version},{cvss_severity},{cisa_kev}\n"
+    # written first, so that a row is not lost if it cannot be printed
+    if output_writer:
+        output_writer.write(
+            {
+                "cve_id": cve_id,
+                "priority": priority,
+                "epss": epss,
+                "cvss": cvss_base_score,
+                "cvss_version": cvss_version,
+                "cvss_severity": cvss_severity,
+                "cisa_kev": cisa_kev,
+            }
         )
+    with print_lock:
+        if verbose:
+            # CVEs listed in CISA's KEV catalog are not looked up in NVD, i.e., have no CVSS data
+            base_score, version, severity = (
+                "N/A" if value is None else value for value in (cvss_base_score, cvss_version, cvss_severity)
+            )
+            print(
+                f"{cve_id:<18}{color_priority:<22}{epss:<9}{base_score:<6}{version:<10}{severity:<10}{cisa_kev}"
+            )
+        else:
+            print(f"{cve_id:<18}{color_priority:<22}")
 
 
-# Main function
-def worker(cve_id, cvss_score, epss_score, verbose_print, sem, save_output=None):
-    nist_result = nist_check(cve_id)
-    epss_result = epss_check(cve_id)
-
-    working_file = None
-    if save_output:
-        working_file = open(save_output, "a")
-
-    results = {}
-
+# Main function, returns False if the CVE could not be processed
+def worker(cve_id, cvss_score, epss_score, verbose_print, sem, output_writer=None):
     try:
-        if nist_result.get("cisa_kev"):
+        priority_details = classify_cve(enrich_cve(cve_id), cvss_score, epss_score)
+        if priority_details is not None:
             print_and_write(
-                working_file,
+                output_writer,
                 cve_id,
-                "Priority 1+",
-                epss_result.get("epss"),
-                nist_result.get("cvss_baseScore"),
-                nist_result.get("cvss_version"),
-                nist_result.get("cvss_severity"),
-                "TRUE",
+                priority_details["priority"],
+                priority_details["epss"],
+                priority_details["cvss_baseScore"],
+                priority_details["cvss_version"],
+                priority_details["cvss_severity"],
+                priority_details["cisa_kev"],
                 verbose_print,
             )
-        elif nist_result.get("cvss_baseScore") >= cvss_score:
-            if epss_result.get("epss") >= epss_score:
-                print_and_write(
-                    working_file,
-                    cve_id,
-                    "Priority 1",
-                    epss_result.get("epss"),
-                    nist_result.get("cvss_baseScore"),
-                    nist_result.get("cvss_version"),
-                    nist_result.get("cvss_severity"),
-                    "FALSE",
-                    verbose_print,
-                )
-            else:
-                print_and_write(
-                    working_file,
-                    cve_id,
-                    "Priority 2",
-                    epss_result.get("epss"),
-                    nist_result.get("cvss_baseScore"),
-                    nist_result.get("cvss_version"),
-                    nist_result.get("cvss_severity"),
-                    "FALSE",
-                    verbose_print,
-                )
-        else:
-            if epss_result.get("epss") >= epss_score:
-                print_and_write(
-                    working_file,
-                    cve_id,
-                    "Priority 3",
-                    epss_result.get("epss"),
-                    nist_result.get("cvss_baseScore"),
-                    nist_result.get("cvss_version"),
-                    nist_result.get("cvss_severity"),
-                    "FALSE",
-                    verbose_print,
-                )
-            else:
-                print_and_write(
-                    working_file,
-                    cve_id,
-                    "Priority 4",
-                    epss_result.get("epss"),
-                    nist_result.get("cvss_baseScore"),
-                    nist_result.get("cvss_version"),
-                    nist_result.get("cvss_severity"),
-                    "FALSE",
-                    verbose_print,
-                )
-    except (TypeError, AttributeError):
-        return None
-
-    if working_file:
-        working_file.close()
-
-    sem.release()
+    except Exception as e:
+        # a failed CVE is reported instead of ending its thread, the other CVEs carry on
+        with print_lock:
+            print(f"{cve_id:<18}Error: {type(e).__name__}: {e}")
+        return False
+    finally:
+        sem.release()
+    return True
 
 
 """
 NIST's NVD API allows to make up to 50 requests to the API within any given 30 seconds
-period. To stay within this rate limit we set our max_workers in cve_prioritizer_wrapper.py
-to 50, which means that 50 threads can start almost at the same time.
-
-In case of 50 requests in a 30-second window, we'll need to ensure that the threads wait 
-30/50 = 0.6 seconds on average before making the next API request. To account also for network
-latencies, for example, we play it safe and wait a bit longer (i.e., 0.7s or 0.8s)
+period. nist_check acquires a slot of the shared nvd_rate_limiter before every request, so
+any number of threads can run worker_v2 concurrently without exceeding this rate limit.
 """
 def worker_v2(cve_id, cvss_score, epss_score):
-    time.sleep(1)
+    enrichment = enrich_cve(cve_id)
+    priority_details = classify_cve(enrichment, cvss_score, epss_score)
+
+    if priority_details is None:
+        return None
 
-    nist_result = nist_check(cve_id)
+    return {cve_id: priority_details}
+
+
+# Collects the raw NVD and EPSS data of a CVE without applying any thresholds, so that
+# the result can be stored and re-prioritized later on without querying the APIs again
+def enrich_cve(cve_id):
+    # not enriched at all once the task has to stop, see _process_cves
+    if hooks.stop_reason():
+        return None
+    # CVEs listed in CISA's KEV catalog are always "Priority 1+", i.e., NVD does not need to be queried
+    kev_listed = is_kev(cve_id)
+    hooks.record_cache_lookup("kev", kev_listed)
+    if kev_listed:
+        nist_result = {"cisa_kev": True}
+    else:
+        nist_result = nist_check(cve_id)
+        # e.g., stopped while waiting for NVD, then EPSS is not queried either
+        if hooks.stop_reason():
+            return None
     epss_result = epss_check(cve_id)
 
-    results = {}
+    if not isinstance(nist_result, dict) or "error" in nist_result:
+        nist_result = {}
+    if not isinstance(epss_result, dict):
+        epss_result = {}
 
-    try:
-        if nist_result.get("cisa_kev"):
-            results = {
-                cve_id: {
-                    "priority": "Priority 1+",
-                    "epss": epss_result.get("epss"),
-                    "cvss_baseScore": nist_result.get("cvss_baseScore"),
-                    "cvss_version": nist_result.get("cvss_version"),
-                    "cvss_severity": nist_result.get("cvss_severity"),
-                    "cisa_kev": "TRUE",
-                }
-            }
-        elif nist_result.get("cvss_baseScore") >= cvss_score:
-            if epss_result.get("epss") >= epss_score:
-                results = {
-                    cve_id: {
-                        "priority": "Priority 1",
-                        "epss": epss_result.get("epss"),
-                        "cvss_baseScore": nist_result.get("cvss_baseScore"),
-                        "cvss_version": nist_result.get("cvss_version"),
-                        "cvss_severity": nist_result.get("cvss_severity"),
-                        "cisa_kev": "FALSE",
-                    }
-                }
-            else:
-                results = {
-                    cve_id: {
-                        "priority": "Priority 2",
-                        "epss": epss_result.get("epss"),
-                        "cvss_baseScore": nist_result.get("cvss_baseScore"),
-                        "cvss_version": nist_result.get("cvss_version"),
-                        "cvss_severity": nist_result.get("cvss_severity"),
-                        "cisa_kev": "FALSE",
-                    }
-                }
-        else:
-            if epss_result.get("epss") >= epss_score:
-                results = {
-                    cve_id: {
-                        "priority": "Priority 3",
-                        "epss": epss_result.get("epss"),
-                        "cvss_baseScore": nist_result.get("cvss_baseScore"),
-                        "cvss_version": nist_result.get("cvss_version"),
-                        "cvss_severity": nist_result.get("cvss_severity"),
-                        "cisa_kev": "FALSE",
-                    }
-                }
-            else:
-                results = {
-                    cve_id: {
-                        "priority": "Priority 4",
-                        "epss": epss_result.get("epss"),
-                        "cvss_baseScore": nist_result.get("cvss_baseScore"),
-                        "cvss_version": nist_result.get("cvss_version"),
-                        "cvss_severity": nist_result.get("cvss_severity"),
-                        "cisa_kev": "FALSE",
-                    }
-                }
-    except (TypeError, AttributeError):
+    return {
+        "epss": epss_result.get("epss"),
+        "percentile": epss_result.get("percentile"),
+        "cvss_baseScore": nist_result.get("cvss_baseScore"),
+        "cvss_version": nist_result.get("cvss_version"),
+        "cvss_severity": nist_result.get("cvss_severity"),
+        "cisa_kev": bool(nist_result.get("cisa_kev")),
+    }
+
+
+# Applies the CVSS and EPSS thresholds to the data collected by enrich_cve. Returns None
+# if the data is incomplete, i.e., the CVE cannot be prioritized
+def classify_cve(enrichment, cvss_score, epss_score):
+    epss = enrichment.get("epss")
+    cvss_base_score = enrichment.get("cvss_baseScore")
+
+    if epss is None:
         return None
 
-    return results
+    if enrichment.get("cisa_kev"):
+        priority = "Priority 1+"
+    elif cvss_base_score is None:
+        return None
+    elif cvss_base_score >= cvss_score:
+        priority = "Priority 1" if epss >= epss_score else "Priority 2"
+    else:
+        priority = "Priority 3" if epss >= epss_score else "Priority 4"
+
+    return {
+        "priority": priority,
+        "epss": epss,
+        "cvss_baseScore": cvss_base_score,
+        "cvss_version": enrichment.get("cvss_version"),
+        "cvss_severity": enrichment.get("cvss_severity"),
+        "cisa_kev": "TRUE" if enrichment.get("cisa_kev") else "FALSE",
+    }
+
+
+# Reads CVEs lazily from any iterable of lines (e.g., a file or stdin), prioritizes them using
+# a fixed pool of threads and passes every row to the output writer as soon as it is completed.
+# At most 2 * threads CVEs are in flight, so memory usage does not grow with the size of the input.
+# Returns the number of CVEs that could not be processed
+def stream_prioritize(lines, cvss_score, epss_score, verbose_print, threads, output_writer=None):
+    in_flight = Semaphore(2 * threads)
+    failed_lock = Lock()
+    failed = 0
+
+    def count_failed(future):
+        nonlocal failed
+        if future.exception() is not None:
+            with print_lock:
+                print(f"Error: {type(future.exception()).__name__}: {future.exception()}")
+        elif future.result():
+            return
+        with failed_lock:
+            failed += 1
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for line in lines:
+            cve = line.strip()
+            if not cve:
+                continue
+            if not re.match(CVE_PATTERN, cve):
+                print(f"{cve} Error: CVEs should be provided in the standard format CVE-0000-0000*")
+                continue
+
+            in_flight.acquire()
+            future = executor.submit(
+                worker, cve.upper(), cvss_score, epss_score, verbose_print, in_flight, output_writer
+            )
+            future.add_done_callback(count_failed)
+
+    return failed
 
 
 # Function retrieves data from CVE Trends
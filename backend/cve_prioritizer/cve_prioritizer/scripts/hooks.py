@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# This file contains the hooks through which an application embedding cve_prioritizer observes and
+# stops its requests, e.g., CERTSec installs its metrics and the cancellation of its Celery tasks
+# (see compliance/apps.py). By default they do nothing, i.e., the standalone tool needs none of them.
+
+import contextlib
+import time
+
+
+class ApiCall:
+    def __init__(self, service):
+        self.service = service
+        # set by the caller once the response has been received
+        self.status_code = None
+
+
+# Context manager around a request to an external API ("nvd" or "epss"), yields an ApiCall
+@contextlib.contextmanager
+def api_call(service):
+    yield ApiCall(service)
+
+
+# Called whenever a request is repeated, e.g., after NVD's rate limit has been hit
+def record_api_retry(service):
+    pass
+
+
+# Called with the result of a lookup in a cache, e.g., the KEV catalog
+def record_cache_lookup(cache, hit, count=1):
+    pass
+
+
+# Reason why the requests should stop, e.g., a cancelled task, None to go on
+def stop_reason():
+    return None
+
+
+# Timeout of the next request, at most the given one
+def remaining(timeout=None):
+    return timeout
+
+
+# Sleeps before a retry, returns False if it has been interrupted because the requests should stop
+def sleep(seconds):
+    time.sleep(seconds)
+    return True
+
+
+HOOKS = ("api_call", "record_api_retry", "record_cache_lookup", "stop_reason", "remaining", "sleep")
+
+
+def install(**hooks):
+    unknown_hooks = set(hooks) - set(HOOKS)
+    if unknown_hooks:
+        raise ValueError(f"Unknown hooks: {', '.join(sorted(unknown_hooks))}")
+    globals().update(hooks)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# This file keeps CISA's Known Exploited Vulnerabilities (KEV) catalog in memory
+
+import json
+import os
+import threading
+import time
+
+import requests
+
+from cve_prioritizer.cve_prioritizer.scripts.constants import CISA_KEV_FILE
+from cve_prioritizer.cve_prioritizer.scripts.constants import CISA_KEV_RELOAD_INTERVAL
+from cve_prioritizer.cve_prioritizer.scripts.constants import CISA_KEV_URL
+
+_kev_lock = threading.Lock()
+_kev_cves = frozenset()
+_kev_file_mtime = None
+_kev_last_checked = None
+
+
+def kev_file_path():
+    return os.getenv("CISA_KEV_FILE") or CISA_KEV_FILE
+
+
+# Loads the catalog from the local file and replaces the in-memory set
+def load_kev_catalog(path=None):
+    global _kev_cves, _kev_file_mtime
+
+    path = path or kev_file_path()
+    with open(path, "r") as kev_file:
+        catalog = json.load(kev_file)
+
+    kev_cves = frozenset(
+        vulnerability.get("cveID").upper()
+        for vulnerability in catalog.get("vulnerabilities", [])
+        if vulnerability.get("cveID")
+    )
+
+    with _kev_lock:
+        _kev_cves = kev_cves
+        _kev_file_mtime = os.path.getmtime(path)
+
+    return len(kev_cves)
+
+
+# Downloads the current catalog from CISA and replaces the local file
+def download_kev_catalog(path=None):
+    path = path or kev_file_path()
+
+    response = requests.get(CISA_KEV_URL, timeout=60)
+    response.raise_for_status()
+    # make sure we never persist a broken catalog
+    catalog = response.json()
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as kev_file:
+        json.dump(catalog, kev_file)
+    # atomic, so that other processes never read a partially written file
+    os.replace(tmp_path, path)
+
+
+def refresh_kev_catalog(path=None):
+    try:
+        download_kev_catalog(path)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"Unable to download CISA KEV catalog, keeping the local copy: {e}")
+
+    # e.g., a fresh deployment without a local copy, the next scheduled refresh tries again
+    try:
+        return load_kev_catalog(path)
+    except (OSError, ValueError) as e:
+        print(f"Unable to load CISA KEV catalog from {path or kev_file_path()}: {e}")
+        return 0
+
+
+# Reloads the catalog if another process (e.g., the scheduled refresh) replaced the local file.
+# The file is checked at most once every CISA_KEV_RELOAD_INTERVAL seconds
+def _reload_if_changed():
+    global _kev_last_checked
+
+    now = time.monotonic()
+    if _kev_last_checked is not None and now - _kev_last_checked < CISA_KEV_RELOAD_INTERVAL:
+        return
+    _kev_last_checked = now
+
+    path = kev_file_path()
+    try:
+        if os.path.getmtime(path) != _kev_file_mtime:
+            load_kev_catalog(path)
+    except (OSError, ValueError) as e:
+        print(f"Unable to load CISA KEV catalog from {path}: {e}")
+
+
+def is_kev(cve_id):
+    _reload_if_changed()
+    return cve_id.upper() in _kev_cves
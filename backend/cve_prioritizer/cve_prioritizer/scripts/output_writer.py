@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# This file contains the writer that persists the results of all worker threads
+
+import csv
+import json
+import queue
+import threading
+
+from cve_prioritizer.cve_prioritizer.scripts.constants import OUTPUT_FIELDS
+
+OUTPUT_FORMATS = ["csv", "jsonl", "parquet"]
+
+_CLOSE = object()
+
+
+class OutputWriter:
+    """
+    Single writer thread fed by a queue. Worker threads only enqueue their rows, the writer
+    thread keeps the output file open and writes the rows in batches of up to batch_size rows,
+    or whatever has been queued after flush_interval seconds.
+
+    Parquet output requires pyarrow to be installed.
+    """
+
+    def __init__(self, path, output_format="csv", batch_size=500, flush_interval=1.0):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unsupported output format {output_format}, use one of {OUTPUT_FORMATS}")
+
+        self.path = path
+        self.output_format = output_format
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="cve-output-writer", daemon=True)
+        self._error = None
+
+        if output_format == "parquet":
+            # fail before any CVE has been processed
+            import pyarrow  # noqa: F401
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self):
+        self._thread.start()
+
+    def write(self, row):
+        self._queue.put(row)
+
+    def close(self):
+        self._queue.put(_CLOSE)
+        self._thread.join()
+        if self._error:
+            raise self._error
+
+    def _run(self):
+        closed = False
+        try:
+            with self._open() as sink:
+                while not closed:
+                    batch, closed = self._next_batch()
+                    if batch:
+                        sink.write_rows(batch)
+        except Exception as e:
+            self._error = e
+            # keep draining, otherwise close() would wait forever
+            while not closed:
+                closed = self._queue.get() is _CLOSE
+
+    def _next_batch(self):
+        batch = []
+        try:
+            row = self._queue.get()
+            while True:
+                if row is _CLOSE:
+                    return batch, True
+                batch.append(row)
+                if len(batch) >= self.batch_size:
+                    return batch, False
+                row = self._queue.get(timeout=self.flush_interval)
+        except queue.Empty:
+            return batch, False
+
+    def _open(self):
+        if self.output_format == "jsonl":
+            return _JsonlSink(self.path)
+        if self.output_format == "parquet":
+            return _ParquetSink(self.path)
+        return _CsvSink(self.path)
+
+
+class _CsvSink:
+    def __init__(self, path):
+        self._file = open(path, "w", newline="")
+        self._writer = csv.DictWriter(self._file, fieldnames=OUTPUT_FIELDS)
+        self._writer.writeheader()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._file.close()
+
+    def write_rows(self, rows):
+        self._writer.writerows(rows)
+        self._file.flush()
+
+
+class _JsonlSink:
+    def __init__(self, path):
+        self._file = open(path, "w")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._file.close()
+
+    def write_rows(self, rows):
+        self._file.write("".join(json.dumps(row) + "\n" for row in rows))
+        self._file.flush()
+
+
+class _ParquetSink:
+    def __init__(self, path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        self._schema = pa.schema(
+            [
+                ("cve_id", pa.string()),
+                ("priority", pa.string()),
+                ("epss", pa.float64()),
+                ("cvss", pa.float64()),
+                ("cvss_version", pa.string()),
+                ("cvss_severity", pa.string()),
+                ("cisa_kev", pa.string()),
+            ]
+        )
+        self._writer = pq.ParquetWriter(path, self._schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._writer.close()
+
+    def write_rows(self, rows):
+        # every batch becomes one row group
+        self._writer.write_table(self._pa.Table.from_pylist(rows, schema=self._schema))
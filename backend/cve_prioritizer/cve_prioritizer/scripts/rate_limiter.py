@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# This file contains the rate limiter shared by all threads querying the NVD API
+
+import collections
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Sliding window rate limiter: allows at most max_calls calls of acquire() within any
+    period (in seconds). Threads exceeding the limit block until a slot becomes free.
+    """
+
+    def __init__(self, max_calls, period):
+        self.max_calls = max_calls
+        self.period = period
+        self._calls = collections.deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0] >= self.period:
+                    self._calls.popleft()
+
+                if len(self._calls) < self.max_calls:
+                    self._calls.append(now)
+                    return
+
+                wait = self.period - (now - self._calls[0])
+            time.sleep(wait)
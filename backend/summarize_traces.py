@@ -0,0 +1,80 @@
+import argparse
+import collections
+import json
+
+
+def load_spans(path):
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize(spans):
+    """
+    Aggregates the spans by name. The self time of a span is its duration minus the duration of
+    its direct children, i.e., the time spent in the span itself (children running concurrently,
+    e.g., the NVD/EPSS requests of the CVE prioritization, can make it negative).
+    """
+    children_duration = collections.defaultdict(float)
+    for span in spans:
+        if span["parent_id"]:
+            children_duration[span["parent_id"]] += span["duration"]
+
+    summary = collections.defaultdict(lambda: {"count": 0, "errors": 0, "total": 0.0, "self": 0.0, "max": 0.0})
+    for span in spans:
+        entry = summary[span["name"]]
+        entry["count"] += 1
+        entry["errors"] += span["status"] == "error"
+        entry["total"] += span["duration"]
+        entry["self"] += span["duration"] - children_duration[span["span_id"]]
+        entry["max"] = max(entry["max"], span["duration"])
+    return summary
+
+
+def print_tree(spans):
+    children = collections.defaultdict(list)
+    span_ids = {span["span_id"] for span in spans}
+    for span in sorted(spans, key=lambda span: span["start_time"]):
+        # spans whose parent is not in the file (e.g., of the client) are printed as roots
+        children[span["parent_id"] if span["parent_id"] in span_ids else None].append(span)
+
+    def print_span(span, depth):
+        print(f"{'  ' * depth}{span['name']}  {span['duration'] * 1000:.1f}ms"
+              f"{'  ERROR' if span['status'] == 'error' else ''}")
+        for child in children[span["span_id"]]:
+            print_span(child, depth + 1)
+
+    for root in children[None]:
+        print_span(root, 0)
+
+
+def main():
+    """
+    Shows where the time of a traced request was spent, based on the spans exported with
+    TRACING_EXPORTER=file. Without a trace id, the spans of all traces in the file are summarized.
+
+    Example: python summarize_traces.py spans.jsonl --trace-id 4bf92f3577b34da6a3ce929d0e0e4736 --tree
+    """
+    parser = argparse.ArgumentParser(description="Summarize exported tracing spans")
+    parser.add_argument("file", type=str, help="Span file (TRACING_EXPORT_FILE)")
+    parser.add_argument("--trace-id", type=str, help="Only summarize the spans of this trace")
+    parser.add_argument("--tree", action="store_true", help="Also print the spans as a tree")
+    args = parser.parse_args()
+
+    spans = [span for span in load_spans(args.file) if args.trace_id in [None, span["trace_id"]]]
+    if not spans:
+        print("No spans found")
+        return
+
+    summary = summarize(spans)
+    print(f"{'Span':<60}{'Count':>8}{'Errors':>8}{'Total (s)':>12}{'Self (s)':>12}{'Max (s)':>10}")
+    for name, entry in sorted(summary.items(), key=lambda item: item[1]["total"], reverse=True):
+        print(f"{name[:59]:<60}{entry['count']:>8}{entry['errors']:>8}{entry['total']:>12.3f}"
+              f"{entry['self']:>12.3f}{entry['max']:>10.3f}")
+
+    if args.tree:
+        print()
+        print_tree(spans)
+
+
+if __name__ == "__main__":
+    main()
@@ -256,7 +256,7 @@ const TechnicalBaseline: React.FC<Props> = ({
 
       dispatch({
         type: "SET_TASK_DATA",
-        taskId: vulnersTaskId as string,
+        taskId: technologyVulnersTaskId as string,
         // requirementId: 8,
         automatedRequirementType:
           AutomatedRequirementType.VULNERABILITY_CHECKER,
@@ -378,6 +378,14 @@ const TechnicalBaseline: React.FC<Props> = ({
           certificate_id: certificates?.TB.id,
           company_id: company?.id,
           user_responses: userResponses,
+          // the stored results of the automated checks are linked to the assessment
+          scan_task_ids: [
+            httpsTaskId,
+            vulnersTaskId,
+            pingTaskId,
+            technologyVulnersTaskId,
+            portsTaskId,
+          ].filter((taskId) => typeof taskId === "string"),
         })
         .catch((error) => {
           console.log(
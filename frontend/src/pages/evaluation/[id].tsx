@@ -36,6 +36,8 @@ import CircularProgress from "@mui/material/CircularProgress";
 import { NEXT_CERTIFICATE } from "@/lib/utils/constants";
 import { useRouter } from "next/router";
 
+const REPORT_POLLING_INTERVAL = 2000;
+
 type AssessmentRequirement = {
   assessment: number;
   requirement: Requirement;
@@ -77,9 +79,39 @@ const EvaluationPage = ({
 
     try {
       setIsGeneratingReport(true);
-      const response = await apiClient.post(
+      // The results of the automated checks are summarized in the appendix of the report
+      const vulnerabilityChecks =
+        tasksData?.[AutomatedRequirementType.VULNERABILITY_CHECKER];
+      const scanTaskIds = [
+        tasksData?.[AutomatedRequirementType.HTTPS_PROTOCOL_CHECKER]?.httpsCheck
+          ?.taskId,
+        tasksData?.[AutomatedRequirementType.UNAUTHORIZED_ACCESS_CHECKER]
+          ?.portScan?.taskId,
+        vulnerabilityChecks?.ipVulnerabilities?.taskId,
+        vulnerabilityChecks?.technologyVulnerabilities?.taskId,
+      ].filter((taskId): taskId is string => typeof taskId === "string");
+
+      // Reports generated before are returned right away, new reports are generated in the
+      // background, i.e., their task is polled until the report can be downloaded
+      const { data } = await apiClient.post(
         `/assessments/${assessment.id}/report/`,
-        {},
+        { scan_task_ids: scanTaskIds }
+      );
+
+      let reportId = data.report_id;
+      while (!reportId) {
+        await new Promise((resolve) =>
+          setTimeout(resolve, REPORT_POLLING_INTERVAL)
+        );
+        const task = (await apiClient.get(`tasks/?id=${data.task_id}`)).data;
+        if (task.status === "FAILURE" || task.status === "REVOKED") {
+          throw new Error(`Report generation failed with status ${task.status}`);
+        }
+        reportId = task.result?.report_id;
+      }
+
+      const response = await apiClient.get(
+        `/reports/${reportId}/`,
         { responseType: "blob" } // This ensures that the response data is treated as a Blob
       );
 